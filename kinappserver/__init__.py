@@ -8,7 +8,7 @@ import logging as log
 
 from kinappserver.amqp_publisher import AmqpPublisher
 from stellar_base.network import NETWORKS
-from .encrypt import AESCipher
+from .encrypt import AESCipher, BlindIndex
 
 
 app = Flask(__name__)
@@ -48,12 +48,16 @@ else:
     print('starting the sdk on the public testnet')
     network = config.STELLAR_NETWORK
 
+# the sdk is only used for reads: all the txs are sent by the channel scheduler, which owns the channels
 app.kin_sdk = kin.SDK(secret_key=base_seed,
                       horizon_endpoint_uri=config.STELLAR_HORIZON_URL,
                       network=network,
-                      channel_secret_keys=channel_seeds,
                       kin_asset=kin_asset)
 
+# the payments (and new accounts) are sent on the channels leased by the channel scheduler. the leases are
+# shared by all the processes through redis. with no channels, the txs are sent by the base account
+app.channel_scheduler = stellar.ChannelScheduler(base_seed, channel_seeds, config.STELLAR_HORIZON_URL, network)
+
 # get (and print) the current balance for the account:
 from stellar_base.keypair import Keypair
 log.info('the current KIN balance on the base-seed: %s' % stellar.get_kin_balance(Keypair.from_seed(base_seed).address().decode()))
@@ -67,6 +71,11 @@ for channel in channel_seeds:
 # init encryption util
 key, iv = ssm.get_encrpytion_creds()
 app.encryption = AESCipher(key, iv)
+blind_index_key = ssm.get_blind_index_key()
+if not blind_index_key:
+    log.error('could not get the blind index key - aborting')
+    sys.exit(-1)
+app.phone_blind_index = BlindIndex(blind_index_key)
 
 # SQLAlchemy stuff:
 # create an sqlalchemy engine with "autocommit" to tell sqlalchemy NOT to use un-needed transactions.
@@ -119,6 +128,18 @@ app.rq_fast = Queue('kinappserver-%s-fast' % config.DEPLOYMENT_ENV, connection=r
 app.rq_slow = Queue('kinappserver-%s-slow' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=7200)
 app.rq_push = Queue('kinappserver-%s-push' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=7200)
 
+# the payments pool: by default, one payment worker per stellar channel (and at least one, when there are no
+# channels). drained on shutdown.
+import atexit
+from .payment_dispatcher import PaymentDispatcher
+app.payment_dispatcher = PaymentDispatcher(max(1, config.PAYMENT_WORKERS or len(channel_seeds)), config.PAYMENT_QUEUE_MAX_SIZE)
+atexit.register(app.payment_dispatcher.drain, config.PAYMENT_DRAIN_TIMEOUT_SECS)
+
+# a single poller per process for the txs that the redeem requests wait for
+from .tx_waiter import TxWaiter
+app.tx_waiter = TxWaiter(stellar.get_transaction_data, config.STELLAR_TX_POLL_INTERVAL_MS, config.STELLAR_TIMEOUT_SEC,
+                         config.STELLAR_TX_POLL_MAX_CONCURRENT_LOOKUPS)
+
 #push: init the amqplib: two instances, one for beta and one for release TODO get rid of this eventually
 app.amqp_publisher_beta = AmqpPublisher()
 app.amqp_publisher_release = AmqpPublisher()
@@ -30,6 +30,7 @@ KMS_KEY_AWS_REGION = 'us-east-1'
 
 PHONE_VERIFICATION_REQUIRED = False
 PHONE_VERIFICATION_ENABLED = True
+PHONE_BLIND_INDEX_FALLBACK = True  # also look users up by their encrypted phone number. turn off once backfill_phone_blind_indexes is done
 
 P2P_TRANSFERS_ENABLED = True # leave this on for tests
 P2P_MIN_TASKS = 1
@@ -87,5 +88,33 @@ USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_PREFIX = "USER_TASK_IN_CATEGORY_CACHE_REDI
 
 USER_CATEGORIES_CACHE_REDIS_KEY = 'USER_CATEGORIES_CACHE_REDIS_KEY_%s'
 
-USER_LOCKED_OFFERS_REDIS_KEY = 'REDIS_USER_BLOCKED_OFFERS_LIST_%s'
-ZENDESK_API_TOKEN = "this gets overwritten by the tester code. it acutally uses a temp postgress db on the local disc"
\ No newline at end of file
+USER_LOCKED_OFFERS_REDIS_KEY = 'REDIS_USER_LOCKED_OFFERS_ZSET_%s'  # a sorted set of offer_id: unlock timestamp
+ZENDESK_API_TOKEN = "this gets overwritten by the tester code. it acutally uses a temp postgress db on the local disc"
+
+PAYMENT_WORKERS = 0  # the size of the payments pool in each process. 0 means one worker per stellar channel (at least one)
+PAYMENT_QUEUE_MAX_SIZE = 100  # payments waiting for a worker, per process, before overflowing to rq
+PAYMENT_DRAIN_TIMEOUT_SECS = 30  # how long to wait for pending payments on shutdown
+
+PAYMENT_OUTBOX_BATCH_SIZE = 50  # payments claimed by each run of the outbox worker
+PAYMENT_OUTBOX_RETRY_DELAY_SECS = 60  # pending payments younger than this are left for the request handler
+PAYMENT_OUTBOX_MAX_ATTEMPTS = 5  # failed payments are retried up to this many attempts
+PAYMENT_OUTBOX_SUBMITTED_TIMEOUT_SECS = 600  # submitted payments that weren't confirmed by then are marked as failed
+
+REDEEM_STATUS_TTL_SECS = 3600  # how long the results of async redeem requests are kept for the status endpoint
+STELLAR_TX_POLL_INTERVAL_MS = 500  # how often the tx waiter polls horizon for the txs that requests wait for
+STELLAR_TX_POLL_MAX_CONCURRENT_LOOKUPS = 10  # horizon lookups the tx waiter runs at the same time, per process
+
+STELLAR_CHANNEL_LEASE_TIMEOUT_SECS = 30  # how long a payment waits for a free stellar channel
+STELLAR_CHANNEL_LEASE_TTL_SECS = 60  # a channel lease (in redis) that wasn't released by then expires, say if its process died
+STELLAR_CHANNEL_BAD_SEQ_ATTEMPTS = 3  # a tx is re-sent this many times on tx_bad_seq, with the channel's sequence reloaded every time
+
+GOODS_ALLOCATION_MODE = 'skip_locked'  # 'skip_locked' allocates goods with a single SKIP LOCKED update. 'pool' pops them from a redis list
+GOODS_POOL_REFILL_SIZE = 100  # how many unallocated goods are pushed into an offer's redis pool at a time
+INVENTORY_DRIFT_TTL_SECS = 900  # an inventory drift is corrected if the next reconcile run sees the same drift within this time
+
+ORDER_RELEASE_BATCH_SIZE = 1000  # expired orders released (and deleted) per statement
+
+REDEEMED_GOODS_CACHE_TTL_SECS = 86400  # how long the first page of each user's redeemed goods is cached (it's also invalidated on every redeem)
+
+TX_HISTORY_CACHE_SIZE = 200  # the most recent tx history entries kept in each user's redis list. older pages are read from the db
+TX_HISTORY_CACHE_TTL_SECS = 604800  # how long a user's tx history is cached since it was last filled
\ No newline at end of file
@@ -1,6 +1,7 @@
 '''AWS encrypt and decrypt utilities'''
 import base64
 import hashlib
+import hmac
 from Crypto import Random
 from Crypto.Cipher import AES
 
@@ -32,6 +33,19 @@ class AESCipher(object):
     def _unpad(s):
         return s[:-ord(s[len(s)-1:])]
 
+class BlindIndex(object):
+    """a keyed hash (HMAC-SHA256) of a value, for equality lookups of encrypted values.
+
+    the index of a value can be computed without the encryption key, and is much cheaper than encrypting it
+    """
+
+    def __init__(self, key):
+        self.key = hashlib.sha256(key.encode()).digest()
+
+    def digest(self, raw):
+        return hmac.new(self.key, raw.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
 if __name__ == "__main__":
     o = AESCipher('theforceisstrong', bytes.fromhex('0cc60592a486dabf7aeda283d5e3391f'))
     encrpyted_message = o.encrypt('+9720528802120')
@@ -0,0 +1,132 @@
+# !/usr/bin/python
+"""concurrency benchmark: 100 parallel bookings of the same offer, for each good allocation mode.
+
+for_update:  the original allocation - SELECT ... FOR UPDATE of the first unallocated good, then UPDATE.
+             all the bookers queue on the same row's lock, and the ones that wake up to find it taken get nothing.
+skip_locked: a single UPDATE ... WHERE sid = (SELECT ... FOR UPDATE SKIP LOCKED LIMIT 1) RETURNING sid.
+pool:        pop a sid from a redis list and confirm it with a single conditional UPDATE (needs a redis).
+
+the benchmark runs against its own bench_good table, which is dropped when it's done.
+
+usage: python3 bench_allocate_good.py [num_of_bookers] [redis_host]
+"""
+import sys
+import threading
+import time
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+OFFER_ID = 'bench-offer'
+NUM_OF_GOODS = 1000
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+def setup(conn):
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_good;')
+    cur.execute('CREATE TABLE bench_good (sid serial PRIMARY KEY, offer_id varchar(40) NOT NULL, order_id varchar(40) UNIQUE, updated_at timestamptz);')
+    cur.execute('INSERT INTO bench_good (offer_id) SELECT %s FROM generate_series(1, %s);', (OFFER_ID, NUM_OF_GOODS))
+    conn.commit()
+
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute('UPDATE bench_good SET order_id = NULL;')
+    conn.commit()
+
+
+def allocate_for_update(conn, order_id, redis_conn):
+    cur = conn.cursor()
+    cur.execute('SELECT sid FROM bench_good WHERE offer_id = %s AND order_id IS NULL LIMIT 1 FOR UPDATE;', (OFFER_ID,))
+    row = cur.fetchone()
+    if row is None:
+        conn.commit()
+        return None
+    cur.execute('UPDATE bench_good SET order_id = %s, updated_at = now() WHERE sid = %s;', (order_id, row[0]))
+    conn.commit()
+    return row[0]
+
+
+def allocate_skip_locked(conn, order_id, redis_conn):
+    cur = conn.cursor()
+    cur.execute('''UPDATE bench_good SET order_id = %s, updated_at = now()
+                   WHERE sid = (SELECT sid FROM bench_good WHERE offer_id = %s AND order_id IS NULL ORDER BY sid LIMIT 1 FOR UPDATE SKIP LOCKED)
+                   RETURNING sid;''', (order_id, OFFER_ID))
+    row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def allocate_pool(conn, order_id, redis_conn):
+    cur = conn.cursor()
+    while True:
+        sid = redis_conn.lpop('bench-goods-pool')
+        if sid is None:
+            return None
+        cur.execute('UPDATE bench_good SET order_id = %s, updated_at = now() WHERE sid = %s AND order_id IS NULL RETURNING sid;', (order_id, int(sid)))
+        row = cur.fetchone()
+        conn.commit()
+        if row:
+            return row[0]
+
+
+def run(mode, allocate, num_of_bookers, redis_conn):
+    conns = [psycopg2.connect(get_conn_string()) for i in range(num_of_bookers)]
+    reset(conns[0])
+    if redis_conn:
+        redis_conn.delete('bench-goods-pool')
+        redis_conn.rpush('bench-goods-pool', *range(1, NUM_OF_GOODS + 1))
+
+    latencies = []
+    allocated = []
+    start_barrier = threading.Barrier(num_of_bookers)
+
+    def book(i):
+        start_barrier.wait()
+        start = time.time()
+        sid = allocate(conns[i], 'order-%s' % i, redis_conn)
+        latencies.append(time.time() - start)
+        allocated.append(sid)
+
+    threads = [threading.Thread(target=book, args=(i,)) for i in range(num_of_bookers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_secs = time.time() - start
+
+    for conn in conns:
+        conn.close()
+
+    latencies.sort()
+    failed = len([sid for sid in allocated if sid is None])
+    assert len(set(sid for sid in allocated if sid is not None)) == num_of_bookers - failed  # no good was allocated twice
+    print('%-12s total: %.3f secs, p50: %.1f ms, p99: %.1f ms, max: %.1f ms, bookings/sec: %.0f, failed (with goods available): %s' % (
+        mode, total_secs, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        latencies[-1] * 1000, num_of_bookers / total_secs, failed))
+
+
+if __name__ == '__main__':
+    num_of_bookers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    redis_conn = None
+    if len(sys.argv) > 2:
+        import redis
+        redis_conn = redis.StrictRedis(host=sys.argv[2], port=6379, db=0)
+
+    conn = psycopg2.connect(get_conn_string())
+    setup(conn)
+    try:
+        run('for_update', allocate_for_update, num_of_bookers, None)
+        run('skip_locked', allocate_skip_locked, num_of_bookers, None)
+        if redis_conn:
+            run('pool', allocate_pool, num_of_bookers, redis_conn)
+    finally:
+        conn.cursor().execute('DROP TABLE IF EXISTS bench_good;')
+        conn.commit()
+        conn.close()
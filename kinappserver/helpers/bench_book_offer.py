@@ -0,0 +1,188 @@
+# !/usr/bin/python
+"""concurrency benchmark: booking an offer by many users at once, before and after the one-round-trip booking.
+
+multi_statement: the original booking - the locked offers, the balance (two SUMs over the user's txs), the offer,
+                 the available goods, the user's orders, the good allocation and the order insert, one statement
+                 (and one round trip) at a time.
+one_round_trip:  lock the user's balance row, then check, allocate and insert with a single statement. the locked
+                 offers come from the user's redis set, which isn't part of this benchmark, so none are locked.
+
+the benchmark runs against its own bench_* tables, which are dropped when it's done.
+
+usage: python3 bench_book_offer.py [num_of_bookers] [txs_per_user]
+"""
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+OFFER_ID = '1'
+KIN_COST = 10
+NUM_OF_GOODS = 10000
+MAX_ORDERS = 2
+EXPIRATION_SECS = 15
+LIMIT_DAYS = 30
+
+TABLES = ['bench_offer', 'bench_good', 'bench_order', 'bench_transaction', 'bench_user_balance']
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+def setup(conn, user_ids, txs_per_user):
+    cur = conn.cursor()
+    cur.execute(''.join('DROP TABLE IF EXISTS %s;' % table for table in TABLES))
+    cur.execute('CREATE TABLE bench_offer (offer_id varchar(40) PRIMARY KEY, kin_cost integer, address varchar(80), is_active boolean);')
+    cur.execute('CREATE TABLE bench_good (sid serial PRIMARY KEY, offer_id varchar(40) NOT NULL, order_id varchar(40) UNIQUE, updated_at timestamptz);')
+    cur.execute('CREATE INDEX ix_bench_good_unallocated ON bench_good (offer_id, sid) WHERE order_id IS NULL;')
+    cur.execute('CREATE TABLE bench_order (order_id varchar(40) PRIMARY KEY, offer_id varchar(40), user_id uuid, kin_amount integer, address varchar(80), created_at timestamp);')
+    cur.execute('CREATE INDEX ix_bench_order_user_id ON bench_order (user_id);')
+    cur.execute('CREATE TABLE bench_transaction (tx_hash varchar(100) PRIMARY KEY, user_id uuid, amount integer, incoming_tx boolean, tx_info json, update_at timestamptz);')
+    cur.execute('CREATE INDEX ix_bench_transaction_user_id ON bench_transaction (user_id);')
+    cur.execute('CREATE TABLE bench_user_balance (user_id uuid PRIMARY KEY, earned bigint, spent bigint);')
+
+    cur.execute("INSERT INTO bench_offer VALUES (%s, %s, 'GADDRESS', true);", (OFFER_ID, KIN_COST))
+    cur.execute('INSERT INTO bench_good (offer_id) SELECT %s FROM generate_series(1, %s);', (OFFER_ID, NUM_OF_GOODS))
+    for user_id in user_ids:
+        cur.execute('''INSERT INTO bench_transaction (tx_hash, user_id, amount, incoming_tx, tx_info, update_at)
+                       SELECT %s || '-' || i, %s, 10, false, '{"task_id": "1"}', now() FROM generate_series(1, %s) AS i;''', (user_id, user_id, txs_per_user))
+        cur.execute('INSERT INTO bench_user_balance VALUES (%s, %s, 0);', (user_id, 10 * txs_per_user))
+    conn.commit()
+    cur.execute(''.join('ANALYZE %s;' % table for table in TABLES))
+    conn.commit()
+
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute('DELETE FROM bench_order; UPDATE bench_good SET order_id = NULL WHERE order_id IS NOT NULL;')
+    conn.commit()
+
+
+def book_multi_statement(conn, user_id, order_id):
+    cur = conn.cursor()
+    cur.execute('''SELECT tx_info FROM bench_transaction WHERE user_id = %s AND incoming_tx = true AND update_at > now() - %s * interval '1 day';''', (user_id, LIMIT_DAYS))
+    locked_offers = [row[0]['offer_id'] for row in cur.fetchall()]
+    cur.execute('SELECT sum(amount) FROM bench_transaction WHERE user_id = %s AND incoming_tx = true;', (user_id,))
+    spent = cur.fetchone()[0] or 0
+    cur.execute('SELECT sum(amount) FROM bench_transaction WHERE user_id = %s AND incoming_tx = false;', (user_id,))
+    earned = cur.fetchone()[0] or 0
+    cur.execute('SELECT kin_cost, address, is_active FROM bench_offer WHERE offer_id = %s;', (OFFER_ID,))
+    kin_cost, address, is_active = cur.fetchone()
+    cur.execute('SELECT count(sid) FROM bench_good WHERE offer_id = %s AND order_id IS NULL;', (OFFER_ID,))
+    available = cur.fetchone()[0]
+    conn.commit()
+    if not is_active or not available or earned - spent < kin_cost or OFFER_ID in locked_offers:
+        return None
+
+    cur.execute('SELECT created_at FROM bench_order WHERE user_id = %s;', (user_id,))
+    active_orders = [row for row in cur.fetchall() if (datetime.utcnow() - row[0]).total_seconds() <= EXPIRATION_SECS]
+    conn.commit()
+    if len(active_orders) >= MAX_ORDERS:
+        return None
+
+    cur.execute('SELECT kin_cost, address FROM bench_offer WHERE offer_id = %s;', (OFFER_ID,))
+    cur.fetchone()
+    conn.commit()
+    cur.execute('''UPDATE bench_good SET order_id = %s, updated_at = now()
+                   WHERE sid = (SELECT sid FROM bench_good WHERE offer_id = %s AND order_id IS NULL ORDER BY sid LIMIT 1 FOR UPDATE SKIP LOCKED)
+                   RETURNING sid;''', (order_id, OFFER_ID))
+    row = cur.fetchone()
+    conn.commit()
+    if row is None:
+        return None
+    cur.execute("INSERT INTO bench_order VALUES (%s, %s, %s, %s, %s, timezone('utc', now()));", (order_id, OFFER_ID, user_id, kin_cost, address))
+    conn.commit()
+    return order_id
+
+
+def book_one_round_trip(conn, user_id, order_id):
+    cur = conn.cursor()
+    params = {'user_id': user_id, 'offer_id': OFFER_ID, 'order_id': order_id, 'expiration_secs': EXPIRATION_SECS,
+              'max_orders': MAX_ORDERS, 'locked': False}
+    cur.execute('''
+        SELECT 1 FROM bench_user_balance WHERE user_id = %(user_id)s FOR UPDATE;
+        WITH offer AS (
+            SELECT offer_id, kin_cost, address FROM bench_offer WHERE offer_id = %(offer_id)s AND is_active = true
+        ), balance AS (
+            SELECT earned - spent AS balance FROM bench_user_balance WHERE user_id = %(user_id)s
+        ), verdict AS (
+            SELECT CASE
+                WHEN NOT EXISTS (SELECT 1 FROM offer) THEN 'offer_inactive'
+                WHEN NOT EXISTS (SELECT 1 FROM balance) THEN 'no_balance'
+                WHEN NOT EXISTS (SELECT 1 FROM bench_good WHERE offer_id = %(offer_id)s AND order_id IS NULL) THEN 'goods_unavailable'
+                WHEN (SELECT balance FROM balance) < (SELECT kin_cost FROM offer) THEN 'not_enough_kin'
+                WHEN %(locked)s THEN 'max_offers'
+                WHEN (SELECT count(*) FROM bench_order WHERE user_id = %(user_id)s
+                      AND created_at > timezone('utc', now()) - %(expiration_secs)s * interval '1 second') >= %(max_orders)s THEN 'cooldown'
+            END AS reason
+        ), allocated AS (
+            UPDATE bench_good SET order_id = %(order_id)s, updated_at = now()
+            WHERE sid = (SELECT sid FROM bench_good WHERE offer_id = %(offer_id)s AND order_id IS NULL AND (SELECT reason FROM verdict) IS NULL
+                         ORDER BY sid LIMIT 1 FOR UPDATE SKIP LOCKED)
+            RETURNING sid
+        ), booked AS (
+            INSERT INTO bench_order (order_id, offer_id, user_id, kin_amount, address, created_at)
+            SELECT %(order_id)s, offer.offer_id, %(user_id)s, offer.kin_cost, offer.address, timezone('utc', now())
+            FROM offer, allocated
+            RETURNING order_id
+        )
+        SELECT coalesce((SELECT reason FROM verdict), CASE WHEN EXISTS (SELECT 1 FROM booked) THEN NULL ELSE 'no_goods' END);''', params)
+    reason = cur.fetchone()[0]
+    conn.commit()
+    return order_id if reason is None else None
+
+
+def run(mode, book, user_ids):
+    conns = [psycopg2.connect(get_conn_string()) for user_id in user_ids]
+    reset(conns[0])
+
+    latencies = []
+    booked = []
+    start_barrier = threading.Barrier(len(user_ids))
+
+    def booker(i):
+        start_barrier.wait()
+        start = time.time()
+        order_id = book(conns[i], user_ids[i], 'order-%s' % i)
+        latencies.append(time.time() - start)
+        booked.append(order_id)
+
+    threads = [threading.Thread(target=booker, args=(i,)) for i in range(len(user_ids))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_secs = time.time() - start
+
+    for conn in conns:
+        conn.close()
+
+    latencies.sort()
+    failed = len([order_id for order_id in booked if order_id is None])
+    print('%-16s total: %.3f secs, p50: %.1f ms, p99: %.1f ms, max: %.1f ms, bookings/sec: %.0f, failed: %s' % (
+        mode, total_secs, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        latencies[-1] * 1000, len(user_ids) / total_secs, failed))
+
+
+if __name__ == '__main__':
+    num_of_bookers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    txs_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    user_ids = [str(uuid.uuid4()) for i in range(num_of_bookers)]
+
+    conn = psycopg2.connect(get_conn_string())
+    setup(conn, user_ids, txs_per_user)
+    try:
+        print('bookers: %s, txs per user: %s' % (num_of_bookers, txs_per_user))
+        run('multi_statement', book_multi_statement, user_ids)
+        run('one_round_trip', book_one_round_trip, user_ids)
+    finally:
+        conn.cursor().execute(''.join('DROP TABLE IF EXISTS %s;' % table for table in TABLES))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,95 @@
+# !/usr/bin/python
+"""benchmark: 10k user lookups by phone number, before and after the phone blind index.
+
+encrypted:   encrypt each number (AES-CBC with the fixed iv) and look the user up by user.enc_phone_number.
+blind_index: hash each number (HMAC-SHA256) and look the user up by user.phone_blind_index.
+
+the hashing/encryption time is reported on its own, and with the db lookups. the benchmark runs against its own
+bench_user table, which is dropped when it's done.
+
+usage: python3 bench_phone_lookup.py [num_of_lookups] [num_of_users]
+"""
+import random
+import sys
+import time
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+from encrypt import AESCipher, BlindIndex
+
+ENCRYPTION_KEY = 'theforceisstrong'
+ENCRYPTION_IV = bytes.fromhex('0cc60592a486dabf7aeda283d5e3391f')
+BLIND_INDEX_KEY = 'phone-blind-index:theforceisstrong'
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+def generate_phone_numbers(num_of_numbers):
+    return ['+9725%08d' % i for i in range(num_of_numbers)]
+
+
+def setup(conn, phone_numbers, cipher, blind_index):
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_user;')
+    cur.execute('CREATE TABLE bench_user (sid serial PRIMARY KEY, public_address varchar(60), enc_phone_number varchar(200), phone_blind_index varchar(64), deactivated boolean);')
+    rows = [('GADDRESS%s' % i, cipher.encrypt(phone_number), blind_index.digest(phone_number)) for i, phone_number in enumerate(phone_numbers)]
+    cur.executemany('INSERT INTO bench_user (public_address, enc_phone_number, phone_blind_index, deactivated) VALUES (%s, %s, %s, false);', rows)
+    cur.execute('CREATE INDEX ix_bench_user_enc_phone_number ON bench_user (enc_phone_number);')
+    cur.execute('CREATE INDEX ix_bench_user_phone_blind_index ON bench_user (phone_blind_index);')
+    conn.commit()
+    cur.execute('ANALYZE bench_user;')
+    conn.commit()
+
+
+def hash_only(lookups, func):
+    start = time.time()
+    for phone_number in lookups:
+        func(phone_number)
+    return time.time() - start
+
+
+def lookup(conn, lookups, func, column):
+    cur = conn.cursor()
+    found = 0
+    start = time.time()
+    for phone_number in lookups:
+        cur.execute('SELECT public_address FROM bench_user WHERE %s = %%s AND deactivated = false LIMIT 1;' % column, (func(phone_number),))
+        if cur.fetchone():
+            found = found + 1
+    conn.commit()
+    return found, time.time() - start
+
+
+if __name__ == '__main__':
+    num_of_lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_of_users = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    cipher = AESCipher(ENCRYPTION_KEY, ENCRYPTION_IV)
+    blind_index = BlindIndex(BLIND_INDEX_KEY)
+
+    phone_numbers = generate_phone_numbers(num_of_users)
+    random.seed(1)
+    # contact lists are mostly numbers that aren't users
+    lookups = [random.choice(phone_numbers) if random.random() < 0.3 else '+9726%08d' % i for i in range(num_of_lookups)]
+
+    print('lookups: %s, users: %s' % (num_of_lookups, num_of_users))
+    encrypt_secs = hash_only(lookups, cipher.encrypt)
+    digest_secs = hash_only(lookups, blind_index.digest)
+    print('encrypt only:     %.3f secs, %.1f us/number' % (encrypt_secs, 1000000 * encrypt_secs / num_of_lookups))
+    print('blind index only: %.3f secs, %.1f us/number' % (digest_secs, 1000000 * digest_secs / num_of_lookups))
+
+    conn = psycopg2.connect(get_conn_string())
+    try:
+        setup(conn, phone_numbers, cipher, blind_index)
+        encrypted_found, encrypted_secs = lookup(conn, lookups, cipher.encrypt, 'enc_phone_number')
+        blind_index_found, blind_index_secs = lookup(conn, lookups, blind_index.digest, 'phone_blind_index')
+        assert encrypted_found == blind_index_found
+        print('encrypted:   %.3f secs, %.0f lookups/sec, found: %s' % (encrypted_secs, num_of_lookups / encrypted_secs, encrypted_found))
+        print('blind_index: %.3f secs, %.0f lookups/sec, found: %s' % (blind_index_secs, num_of_lookups / blind_index_secs, blind_index_found))
+    finally:
+        conn.cursor().execute('DROP TABLE IF EXISTS bench_user;')
+        conn.commit()
+        conn.close()
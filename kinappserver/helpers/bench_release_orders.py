@@ -0,0 +1,111 @@
+# !/usr/bin/python
+"""benchmark: releasing unclaimed goods with 1M historical orders in the db.
+
+per_good:  the original release - load all the allocated-but-unpaid goods, then look up the order of each
+           good and release the good, one statement at a time. expired orders are never deleted.
+set_based: release the goods of expired orders and delete these orders, a batch of orders per statement.
+
+the benchmark runs against its own bench_order and bench_good tables, which are dropped when it's done.
+
+usage: python3 bench_release_orders.py [num_of_orders] [num_of_unclaimed_goods]
+"""
+import sys
+import time
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+EXPIRATION_SECS = 15
+BATCH_SIZE = 1000
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+def setup(conn, num_of_orders, num_of_unclaimed):
+    """num_of_orders expired orders. the goods of the first num_of_unclaimed ones were never paid for"""
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_order; DROP TABLE IF EXISTS bench_good;')
+    cur.execute('CREATE TABLE bench_order (order_id varchar(40) PRIMARY KEY, offer_id varchar(40), created_at timestamp);')
+    cur.execute('CREATE INDEX ix_bench_order_created_at ON bench_order (created_at);')
+    cur.execute('CREATE TABLE bench_good (sid serial PRIMARY KEY, offer_id varchar(40), order_id varchar(40) UNIQUE, tx_hash varchar(100), updated_at timestamptz);')
+    cur.execute('''INSERT INTO bench_order (order_id, offer_id, created_at)
+                   SELECT 'order-' || i, 'offer-' || (i %% 20), timezone('utc', now()) - (i || ' seconds')::interval - interval '1 hour'
+                   FROM generate_series(1, %s) AS i;''', (num_of_orders,))
+    cur.execute('''INSERT INTO bench_good (offer_id, order_id, tx_hash)
+                   SELECT 'offer-' || (i %% 20), 'order-' || i, CASE WHEN i <= %s THEN NULL ELSE 'tx-' || i END
+                   FROM generate_series(1, %s) AS i;''', (num_of_unclaimed, num_of_orders))
+    conn.commit()
+    cur.execute('ANALYZE bench_order; ANALYZE bench_good;')
+    conn.commit()
+
+
+def release_per_good(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT order_id FROM bench_good WHERE tx_hash IS NULL AND order_id IS NOT NULL;')
+    released = 0
+    for (order_id,) in cur.fetchall():
+        cur.execute('SELECT created_at FROM bench_order WHERE order_id = %s;', (order_id,))
+        created_at = cur.fetchone()[0]
+        cur.execute("SELECT timezone('utc', now()) - %s > %s * interval '1 second';", (created_at, EXPIRATION_SECS))
+        if cur.fetchone()[0]:
+            cur.execute('UPDATE bench_good SET order_id = NULL, updated_at = now() WHERE order_id = %s;', (order_id,))
+            conn.commit()
+            released = released + 1
+    return released
+
+
+def release_set_based(conn):
+    cur = conn.cursor()
+    released = 0
+    while True:
+        cur.execute('''
+            WITH expired AS (
+                SELECT order_id FROM bench_order
+                WHERE created_at < timezone('utc', now()) - %s * interval '1 second'
+                ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED
+            ), released AS (
+                UPDATE bench_good SET order_id = NULL, updated_at = now() FROM expired
+                WHERE bench_good.order_id = expired.order_id AND bench_good.tx_hash IS NULL
+                RETURNING bench_good.sid, bench_good.offer_id
+            ), deleted AS (
+                DELETE FROM bench_order USING expired WHERE bench_order.order_id = expired.order_id
+            )
+            SELECT (SELECT count(*) FROM expired), (SELECT count(*) FROM released);''', (EXPIRATION_SECS, BATCH_SIZE))
+        expired_orders, released_goods = cur.fetchone()
+        conn.commit()
+        released = released + released_goods
+        if expired_orders < BATCH_SIZE:
+            return released
+
+
+def timed(func, conn):
+    start = time.time()
+    result = func(conn)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    num_of_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_of_unclaimed = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    conn = psycopg2.connect(get_conn_string())
+    try:
+        setup(conn, num_of_orders, num_of_unclaimed)
+        per_good_released, per_good_secs = timed(release_per_good, conn)
+
+        setup(conn, num_of_orders, num_of_unclaimed)
+        set_based_released, set_based_secs = timed(release_set_based, conn)
+        # the next run has no expired orders left to scan
+        _, steady_state_secs = timed(release_set_based, conn)
+        assert per_good_released == set_based_released == num_of_unclaimed
+
+        print('orders: %s, unclaimed goods: %s' % (num_of_orders, num_of_unclaimed))
+        print('per_good:  %.3f secs' % per_good_secs)
+        print('set_based: %.3f secs (batches of %s orders), next run: %.3f secs' % (set_based_secs, BATCH_SIZE, steady_state_secs))
+    finally:
+        conn.cursor().execute('DROP TABLE IF EXISTS bench_order; DROP TABLE IF EXISTS bench_good;')
+        conn.commit()
+        conn.close()
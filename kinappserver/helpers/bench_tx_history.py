@@ -0,0 +1,147 @@
+# !/usr/bin/python
+"""load test: app opens (a read of the first tx history page) mixed with new txs, before and after the tx history cache.
+
+db:    every app open reads its page from the db.
+cache: every app open reads its page from the user's redis list. a list that isn't cached is filled from the db,
+       and new txs are written through to the lists that are.
+
+the benchmark reports the db queries issued by the app opens, the cache hit rate and the app opens per second.
+it runs against its own bench_transaction table and bench-tx-history redis keys, which are dropped when it's done.
+
+usage: python3 bench_tx_history.py [num_of_users] [txs_per_user] [num_of_requests] [write_ratio]
+"""
+import json
+import random
+import sys
+import time
+import uuid
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+import redis
+
+PAGE_SIZE = 100
+CACHE_SIZE = 200
+REDIS_KEY = 'bench-tx-history:%s'
+
+PAGE_QUERY = '''SELECT tx_hash, amount, incoming_tx, tx_info, update_at FROM bench_transaction
+                WHERE user_id = %s ORDER BY update_at DESC, tx_hash DESC LIMIT %s;'''
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+def get_redis():
+    from config import REDIS_ENDPOINT, REDIS_PORT
+    return redis.StrictRedis(host=REDIS_ENDPOINT, port=REDIS_PORT, db=0)
+
+
+def setup(conn, user_ids, txs_per_user):
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS bench_transaction;')
+    cur.execute('CREATE TABLE bench_transaction (tx_hash varchar(100) PRIMARY KEY, user_id uuid, amount integer, incoming_tx boolean, tx_info json, update_at timestamptz);')
+    for user_id in user_ids:
+        cur.execute('''INSERT INTO bench_transaction (tx_hash, user_id, amount, incoming_tx, tx_info, update_at)
+                       SELECT %s || '-' || i, %s, 10, false, json_build_object('task_id', i::text, 'memo', 'memo-' || i), now() - i * interval '1 minute'
+                       FROM generate_series(1, %s) AS i;''', (user_id, user_id, txs_per_user))
+    cur.execute('CREATE INDEX ix_bench_transaction_user_id_update_at ON bench_transaction (user_id, update_at, tx_hash);')
+    conn.commit()
+    cur.execute('ANALYZE bench_transaction;')
+    conn.commit()
+
+
+def serialize(row):
+    tx_hash, amount, incoming_tx, tx_info, update_at = row
+    return json.dumps({'type': 'server', 'tx_hash': tx_hash, 'amount': amount, 'client_received': not incoming_tx, 'tx_info': tx_info,
+                       'date': int(update_at.timestamp()), 'title': 'task title', 'desc': 'task desc', 'provider': {'name': 'provider'}})
+
+
+def generate_workload(user_ids, num_of_requests, write_ratio):
+    """returns a list of (is_write, user_id). a few users are much more active than the rest"""
+    random.seed(1)
+    weights = [1.0 / (i + 1) for i in range(len(user_ids))]
+    return [(random.random() < write_ratio, user_id) for user_id in random.choices(user_ids, weights=weights, k=num_of_requests)]
+
+
+def insert_tx(cur, user_id, tx_num):
+    cur.execute('''INSERT INTO bench_transaction (tx_hash, user_id, amount, incoming_tx, tx_info, update_at)
+                   VALUES (%s, %s, 10, false, %s, now()) RETURNING tx_hash, amount, incoming_tx, tx_info, update_at;''',
+                (str(uuid.uuid4()), user_id, json.dumps({'task_id': str(tx_num), 'memo': 'memo'})))
+    return cur.fetchone()
+
+
+def run_db(conn, red, workload):
+    cur = conn.cursor()
+    db_reads = 0
+    start = time.time()
+    for i, (is_write, user_id) in enumerate(workload):
+        if is_write:
+            insert_tx(cur, user_id, i)
+            conn.commit()
+        else:
+            cur.execute(PAGE_QUERY, (user_id, PAGE_SIZE))
+            ','.join(serialize(row) for row in cur.fetchall())
+            conn.commit()
+            db_reads = db_reads + 1
+    return db_reads, 0, time.time() - start
+
+
+def run_cache(conn, red, workload):
+    cur = conn.cursor()
+    db_reads = 0
+    hits = 0
+    start = time.time()
+    for i, (is_write, user_id) in enumerate(workload):
+        key = REDIS_KEY % user_id
+        if is_write:
+            row = insert_tx(cur, user_id, i)
+            conn.commit()
+            pipe = red.pipeline()
+            pipe.lpushx(key, serialize(row))
+            pipe.ltrim(key, 0, CACHE_SIZE - 1)
+            pipe.execute()
+        else:
+            entries = red.lrange(key, 0, PAGE_SIZE - 1)
+            if entries:
+                hits = hits + 1
+            else:
+                cur.execute(PAGE_QUERY, (user_id, CACHE_SIZE))
+                entries = [serialize(row).encode('utf-8') for row in cur.fetchall()]
+                conn.commit()
+                db_reads = db_reads + 1
+                red.rpush(key, *entries)
+                entries = entries[:PAGE_SIZE]
+            b','.join(entries)
+    return db_reads, hits, time.time() - start
+
+
+def report(mode, workload, db_reads, hits, secs):
+    reads = len([1 for is_write, user_id in workload if not is_write])
+    print('%-6s app opens: %s, db reads: %s, hit rate: %.1f%%, total: %.3f secs, requests/sec: %.0f' % (
+        mode, reads, db_reads, 100.0 * hits / reads if reads else 0, secs, len(workload) / secs))
+
+
+if __name__ == '__main__':
+    num_of_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    txs_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    num_of_requests = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    write_ratio = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+    user_ids = [str(uuid.uuid4()) for i in range(num_of_users)]
+    workload = generate_workload(user_ids, num_of_requests, write_ratio)
+
+    conn = psycopg2.connect(get_conn_string())
+    red = get_redis()
+    try:
+        print('users: %s, txs per user: %s, requests: %s, write ratio: %s' % (num_of_users, txs_per_user, num_of_requests, write_ratio))
+        setup(conn, user_ids, txs_per_user)
+        report('db', workload, *run_db(conn, red, workload))
+        setup(conn, user_ids, txs_per_user)
+        report('cache', workload, *run_cache(conn, red, workload))
+    finally:
+        conn.cursor().execute('DROP TABLE IF EXISTS bench_transaction;')
+        conn.commit()
+        conn.close()
+        for user_id in user_ids:
+            red.delete(REDIS_KEY % user_id)
@@ -0,0 +1,149 @@
+# !/usr/bin/python
+"""micro-benchmark: the per-user work of /user/offers, before and after the pre-rendered offer catalog.
+
+per_user: the original flow - walk the active offers, mark each one by the inventory, the user's locked offers
+          and balance, filter by the client version and serialize the whole list for every user.
+catalog:  the offers are rendered once per client class (os_type, client version). per user, only pick the
+          fragment of each offer by the user's locked offers and balance, and splice them.
+
+the db and redis round trips (the balance, the locked offers, the user's app data) are the same in both flows,
+so they are left out: this measures the cpu time of the request handler itself.
+
+usage: python3 bench_user_offers.py [num_of_requests] [num_of_offers]
+"""
+import json
+import random
+import sys
+import time
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+from version_utils import version_lt, version_gt
+
+OS_ANDROID = 'android'
+OS_IOS = 'iOS'
+MIN_ANDROID_VERSION = '1.4.1'
+MIN_IOS_VERSION = '1.2.1'
+ANDROID_VERSIONS = ['1.%s.%s' % (i, j) for i in range(1, 10) for j in range(5)]
+IOS_VERSIONS = ['1.%s.%s' % (i, j) for i in range(5) for j in range(4)]
+
+SOLD_OUT_REASON = 'Sold out\nCheck back again soon'
+LOCKED_REASON = 'You’ve reached the maximum number of this gift card for this month'
+CANNOT_BUY_REASON = 'Sorry, You can only buy goods with Kin earned from Kinit.'
+
+
+def generate_offers(num_of_offers):
+    offers = []
+    for i in range(num_of_offers):
+        offers.append({'id': str(i), 'type': 'gift-card', 'type_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                       'domain': 'shopping', 'title': 'offer %s' % i, 'desc': 'a gift card of some store, worth $%s' % i,
+                       'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card_%s.png' % i,
+                       'price': 1000 * (i + 1), 'address': 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ',
+                       'provider': {'name': 'provider %s' % i, 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/provider.png'},
+                       'min_client_version_android': '1.5.0' if i % 5 == 0 else None,
+                       'min_client_version_ios': '1.3.0' if i % 7 == 0 else None,
+                       'sold_out': i % 4 == 0})
+    return offers
+
+
+def generate_requests(num_of_requests, num_of_offers):
+    """returns a list of (os_type, app_ver, locked_offer_ids, balance) tuples"""
+    random.seed(1)
+    requests = []
+    for i in range(num_of_requests):
+        if random.random() < 0.7:
+            os_type, app_ver = OS_ANDROID, random.choice(ANDROID_VERSIONS)
+        else:
+            os_type, app_ver = OS_IOS, random.choice(IOS_VERSIONS)
+        locked = set(str(random.randrange(num_of_offers)) for j in range(random.randrange(3)))
+        requests.append((os_type, app_ver, locked, random.randrange(num_of_offers * 1000)))
+    return requests
+
+
+def offer_to_json(offer, unavailable_reason, cannot_buy_reason):
+    offer_json = {key: offer[key] for key in ('id', 'type', 'type_image_url', 'domain', 'title', 'desc', 'image_url', 'price', 'address', 'provider')}
+    offer_json['unavailable_reason'] = unavailable_reason
+    offer_json['cannot_buy_reason'] = cannot_buy_reason
+    return offer_json
+
+
+def supports_unavailable(os_type, app_ver):
+    if os_type == OS_ANDROID:
+        return not version_lt(app_ver, MIN_ANDROID_VERSION)
+    return not version_lt(app_ver, MIN_IOS_VERSION)
+
+
+def is_hidden(offer, os_type, app_ver):
+    if os_type == OS_ANDROID and offer['min_client_version_android']:
+        return version_gt(offer['min_client_version_android'], app_ver)
+    if os_type == OS_IOS and offer['min_client_version_ios']:
+        return version_gt(offer['min_client_version_ios'], app_ver)
+    return False
+
+
+def per_user(offers, requests):
+    size = 0
+    for os_type, app_ver, locked, balance in requests:
+        available, unavailable = [], []
+        for offer in offers:
+            if offer['sold_out']:
+                unavailable.append((offer, SOLD_OUT_REASON, None))
+            elif offer['id'] in locked:
+                unavailable.append((offer, LOCKED_REASON, None))
+            elif balance < offer['price']:
+                available.append((offer, None, CANNOT_BUY_REASON))
+            else:
+                available.append((offer, None, None))
+        redeemable = available + unavailable if supports_unavailable(os_type, app_ver) else available
+        redeemable = [item for item in redeemable if not is_hidden(item[0], os_type, app_ver)]
+        size = size + len(json.dumps({'offers': [offer_to_json(*item) for item in redeemable]}))
+    return size
+
+
+def catalog(offers, requests):
+    fragments = {}
+    for offer in offers:
+        fragments[offer['id']] = {state: json.dumps(offer_to_json(offer, unavailable_reason, cannot_buy_reason)).encode('utf-8')
+                                  for state, unavailable_reason, cannot_buy_reason in (('available', None, None), ('cannot_buy', None, CANNOT_BUY_REASON),
+                                                                                       ('sold_out', SOLD_OUT_REASON, None), ('locked', LOCKED_REASON, None))}
+    clients = {}
+
+    size = 0
+    for os_type, app_ver, locked, balance in requests:
+        client = clients.get((os_type, app_ver))
+        if client is None:
+            client = clients[(os_type, app_ver)] = ([offer for offer in offers if not is_hidden(offer, os_type, app_ver)], supports_unavailable(os_type, app_ver))
+        available, unavailable = [], []
+        for offer in client[0]:
+            if offer['sold_out']:
+                unavailable.append(fragments[offer['id']]['sold_out'])
+            elif offer['id'] in locked:
+                unavailable.append(fragments[offer['id']]['locked'])
+            elif balance < offer['price']:
+                available.append(fragments[offer['id']]['cannot_buy'])
+            else:
+                available.append(fragments[offer['id']]['available'])
+        if client[1]:
+            available.extend(unavailable)
+        size = size + len(b'{"offers":[' + b','.join(available) + b']}')
+    return size
+
+
+def timed(func, offers, requests):
+    start = time.time()
+    result = func(offers, requests)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    num_of_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_of_offers = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    offers = generate_offers(num_of_offers)
+    requests = generate_requests(num_of_requests, num_of_offers)
+
+    per_user_bytes, per_user_secs = timed(per_user, offers, requests)
+    catalog_bytes, catalog_secs = timed(catalog, offers, requests)
+
+    print('requests: %s, offers: %s' % (num_of_requests, num_of_offers))
+    print('per_user: %.3f secs, %.0f requests/sec, %s bytes' % (per_user_secs, num_of_requests / per_user_secs, per_user_bytes))
+    print('catalog:  %.3f secs, %.0f requests/sec, %s bytes' % (catalog_secs, num_of_requests / catalog_secs, catalog_bytes))
+    print('speedup: x%.1f' % (per_user_secs / catalog_secs))
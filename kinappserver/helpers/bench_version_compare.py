@@ -0,0 +1,74 @@
+# !/usr/bin/python
+"""micro-benchmark: the engagement-push client version filter, LooseVersion vs. interned version keys.
+
+usage: python3 bench_version_compare.py [num_of_users]
+"""
+import random
+import sys
+import time
+from distutils.version import LooseVersion
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+from version_utils import version_key
+
+OS_ANDROID = 'android'
+OS_IOS = 'iOS'
+
+ANDROID_VERSIONS = ['1.0.%s' % i for i in range(10)] + ['1.%s.%s' % (i, j) for i in range(1, 10) for j in range(5)]
+IOS_VERSIONS = ['1.%s.%s' % (i, j) for i in range(5) for j in range(4)]
+
+
+def generate_users(num_of_users):
+    """returns a list of (os_type, app_ver) tuples"""
+    random.seed(1)
+    users = []
+    for i in range(num_of_users):
+        if random.random() < 0.7:
+            users.append((OS_ANDROID, random.choice(ANDROID_VERSIONS)))
+        else:
+            users.append((OS_IOS, random.choice(IOS_VERSIONS)))
+    return users
+
+
+def loose_version_scan(users):
+    """the original filter: both sides are parsed for every user"""
+    skipped = 0
+    for os_type, app_ver in users:
+        if os_type == OS_ANDROID and LooseVersion(app_ver) <= LooseVersion("1.4.0"):
+            skipped = skipped + 1
+        elif os_type == OS_IOS and LooseVersion(app_ver) <= LooseVersion("1.2.1"):
+            skipped = skipped + 1
+    return skipped
+
+
+def version_key_scan(users):
+    """the new filter: the minimums are parsed once, the client versions are interned"""
+    skipped = 0
+    min_android_version_key = version_key("1.4.0")
+    min_ios_version_key = version_key("1.2.1")
+    for os_type, app_ver in users:
+        if os_type == OS_ANDROID and version_key(app_ver) <= min_android_version_key:
+            skipped = skipped + 1
+        elif os_type == OS_IOS and version_key(app_ver) <= min_ios_version_key:
+            skipped = skipped + 1
+    return skipped
+
+
+def timed(func, users):
+    start = time.time()
+    result = func(users)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    num_of_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    users = generate_users(num_of_users)
+
+    loose_skipped, loose_secs = timed(loose_version_scan, users)
+    key_skipped, key_secs = timed(version_key_scan, users)
+    assert loose_skipped == key_skipped
+
+    print('users: %s, skipped for old version: %s' % (num_of_users, key_skipped))
+    print('LooseVersion: %.3f secs' % loose_secs)
+    print('version_key:  %.3f secs' % key_secs)
+    print('speedup: x%.1f' % (loose_secs / key_secs))
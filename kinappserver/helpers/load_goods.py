@@ -4,16 +4,21 @@ import json
 import sys
 import requests
 
+
 def load_goods(filename, offer_id):
     print('reading file: %s' % filename)
-    url = 'http://localhost:80/internal/good/add'
-    headers = {"Content-Type": "application/json"}
-    lines = tuple(open(filename, 'r'))
-    payload = """{"offer_id": "%s", "good_type": "code", "value": "%s"}"""
-    for code in lines:
-        inner_payload = payload % (offer_id, code.rstrip())
-        print('posting payload: %s' % inner_payload)
-        requests.post(url, headers=headers, json=json.loads(inner_payload))
+    url = 'http://localhost:80/internal/good/add/bulk'
+    params = {'offer_id': offer_id, 'good_type': 'code', 'format': 'ndjson'}
+    headers = {"Content-Type": "application/x-ndjson"}
+
+    def codes():
+        # stream the codes as json strings, so codes with commas or quotes go through as they are
+        with open(filename, 'r') as f:
+            for line in f:
+                yield (json.dumps(line.rstrip()) + '\n').encode('utf-8')
+
+    resp = requests.post(url, params=params, headers=headers, data=codes())
+    print(resp.json())
 
 if __name__=="__main__":
-    load_goods(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    load_goods(sys.argv[1], sys.argv[2])
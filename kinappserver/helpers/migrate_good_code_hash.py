@@ -0,0 +1,40 @@
+# !/usr/bin/python
+"""migration: add the good.code_hash column and its unique index. run it before deploying the code that uses them.
+
+the server maps good.code_hash as soon as it's deployed, so every query of the good table fails on a db that
+doesn't have the column yet. the index is built concurrently, so the goods can still be allocated meanwhile.
+should the index build fail, postgres leaves it behind as invalid: drop it and run this script again.
+
+the migration is idempotent. once the code is deployed, set the code_hash of the existing goods with
+/internal/good/code-hash/backfill.
+
+usage: python3 migrate_good_code_hash.py
+"""
+import sys
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+MIGRATION_STATEMENTS = [
+    'ALTER TABLE good ADD COLUMN IF NOT EXISTS code_hash varchar(32);',
+    # existing goods have no code_hash yet, and null values don't collide
+    'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS good_code_hash_key ON good (code_hash);',
+]
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(get_conn_string())
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY can't run in a transaction
+    try:
+        cur = conn.cursor()
+        for statement in MIGRATION_STATEMENTS:
+            print(statement)
+            cur.execute(statement)
+    finally:
+        conn.close()
+    print('done')
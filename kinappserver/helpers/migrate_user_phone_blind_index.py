@@ -0,0 +1,41 @@
+# !/usr/bin/python
+"""migration: add the user.phone_blind_index column and its indexes. run it before deploying the code that uses them.
+
+the server maps user.phone_blind_index as soon as it's deployed, so every query of the user table fails on a db
+that doesn't have the column yet. the indexes are built concurrently, so the users can still register meanwhile.
+should an index build fail, postgres leaves it behind as invalid: drop it and run this script again.
+
+the migration is idempotent. once the code is deployed, set the phone_blind_index of the existing users with
+/users/phone-blind-index/backfill. until then, they're looked up by their encrypted phone number.
+
+usage: python3 migrate_user_phone_blind_index.py
+"""
+import sys
+sys.path.append("..")  # Adds higher directory to python modules path.
+
+import psycopg2
+
+MIGRATION_STATEMENTS = [
+    'ALTER TABLE public.user ADD COLUMN IF NOT EXISTS phone_blind_index varchar(64);',
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_phone_blind_index ON public.user (phone_blind_index);',
+    # the lookups of the users that weren't backfilled yet. the index empties as the backfill runs
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_enc_phone_number_no_blind_index ON public.user (enc_phone_number) WHERE phone_blind_index IS NULL;',
+]
+
+
+def get_conn_string():
+    from config import DB_CONNSTR
+    return DB_CONNSTR
+
+
+if __name__ == '__main__':
+    conn = psycopg2.connect(get_conn_string())
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY can't run in a transaction
+    try:
+        cur = conn.cursor()
+        for statement in MIGRATION_STATEMENTS:
+            print(statement)
+            cur.execute(statement)
+    finally:
+        conn.close()
+    print('done')
@@ -7,9 +7,9 @@ URL_PREFIX = 'http://localhost:80/internal'
 
 
 def report_inventory():
-    """reports the total and available number of goods for every offer id in the server"""
+    """reports the available number of goods and the allocation velocity for every offer id in the server"""
     inventory = {}
-    response = requests.get(URL_PREFIX + '/good/inventory')
+    response = requests.get(URL_PREFIX + '/good/inventory/report')
     try:
         inventory = json.loads(response.text)['inventory']
     except Exception as e:
@@ -18,6 +18,8 @@ def report_inventory():
     for offer_id in inventory.keys():
         metric_name_unallocated = 'inventory-offerid-%s-unallocated' % offer_id
         statsd.gauge(metric_name_unallocated, inventory[offer_id]['unallocated'], tags=['app:kinit,env:%s' % os.environ['ENV']])
+        metric_name_velocity = 'inventory-offerid-%s-allocations-per-hour' % offer_id
+        statsd.gauge(metric_name_velocity, inventory[offer_id]['allocations_per_hour'], tags=['app:kinit,env:%s' % os.environ['ENV']])
 
 
 def report_bh_balance():
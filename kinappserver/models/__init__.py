@@ -1,10 +1,15 @@
 from .transaction import *
+from .user_balance import *
+from .payment_outbox import *
+from .user_context import *
 from .user import *
 from .task2 import *
 from .offer import *
+from .offer_catalog import *
 from .order import *
 from .good import *
 from .p2p_transaction import *
+from .tx_history import *
 from .push_auth_token import *
 from .blackhawk_card import *
 from .blackhawk_creds import *
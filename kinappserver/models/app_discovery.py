@@ -1,7 +1,12 @@
-from kinappserver import db
+from kinappserver import app, db
 from kinappserver.utils import test_image, InvalidUsage
 import logging as log
 
+APP_DISCOVERY_GENERATION_REDIS_KEY = 'app-discovery-generation'
+
+# the discovery apps by sid, kept in each process until the generation in redis changes
+_apps_by_sid = {'generation': None, 'apps': {}}
+
 
 class AppDiscovery(db.Model):
     """ the app discovery class represents a single Discoverable App """
@@ -108,6 +113,7 @@ def add_discovery_app(discovery_app_json, set_active=False):
         log.error('cant add discovery app to db with id %s' % discovery_app_json['identifier'])
         return False
     else:
+        invalidate_discovery_apps_cache()
         if set_active:
             set_discovery_app_active(discovery_app_json['identifier'], True)
         return True
@@ -139,9 +145,27 @@ def set_discovery_app_active(identifier, is_active):
     app.is_active = is_active
     db.session.add(app)
     db.session.commit()
+    invalidate_discovery_apps_cache()
     return True
 
 
+def invalidate_discovery_apps_cache():
+    """make all the processes reload the discovery apps on their next read"""
+    try:
+        app.redis.incr(APP_DISCOVERY_GENERATION_REDIS_KEY)
+    except Exception as e:
+        log.error('failed to invalidate the discovery apps cache. e: %s' % e)
+
+
+def get_discovery_apps_by_sid():
+    """returns a dict of sid -> the json of the discovery app, of all the discovery apps. the dicts are shared, don't modify them"""
+    generation = app.redis.get(APP_DISCOVERY_GENERATION_REDIS_KEY) or b'0'
+    if _apps_by_sid['generation'] != generation:
+        _apps_by_sid['apps'] = {discovery_app.sid: app_discovery_to_json(discovery_app) for discovery_app in AppDiscovery.query.all()}
+        _apps_by_sid['generation'] = generation
+    return _apps_by_sid['apps']
+
+
 def get_discovery_apps(os_type):
     """ get discovery apps from the db, filter by platform """
     apps = AppDiscovery.query.filter_by(os_type=os_type).all() # android, iOS or both
@@ -151,9 +175,9 @@ def get_discovery_apps(os_type):
     # convert to json
     for cat in categories:
         apps_array = []
-        for app in apps:
-            if app.category_id == cat.category_id and app.is_active:
-                json_app = app_discovery_to_json(app)
+        for discovery_app in apps:
+            if discovery_app.category_id == cat.category_id and discovery_app.is_active:
+                json_app = app_discovery_to_json(discovery_app)
                 json_app['meta_data']['category_name'] = cat.category_name
                 apps_array.append(json_app)
         if apps_array:
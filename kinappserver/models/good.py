@@ -1,12 +1,63 @@
 import arrow
+import csv
+import hashlib
+import io
+import json
+import time
 import logging as log
-from kinappserver import db
-from kinappserver.utils import InternalError
+from uuid import UUID
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from kinappserver import db, app
+from kinappserver.utils import InternalError, increment_metric
 from kinappserver import config
 from sqlalchemy_utils import UUIDType, ArrowType
 
 from .offer import Offer
 
+# per-offer inventory counters: a redis hash with the 'total' and 'available' goods of the offer
+INVENTORY_REDIS_KEY = 'inventory:%s'
+INVENTORY_VERSION_REDIS_KEY = 'inventory-version:%s'  # bumped on every adjustment, so loads can tell they raced with one
+INVENTORY_DRIFT_REDIS_KEY = 'inventory-drift:%s'  # the drift the reconciler saw on its last run
+
+# counters are only adjusted if they were already loaded - otherwise they're loaded from the db on the next read
+ADJUST_INVENTORY_SCRIPT = """
+redis.call('incr', KEYS[2])
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hincrby', KEYS[1], 'total', ARGV[1])
+    return redis.call('hincrby', KEYS[1], 'available', ARGV[2])
+end
+return nil
+"""
+_adjust_inventory_script = None
+
+# load the counters that were counted in the db, unless they were adjusted (or loaded) since the count started
+LOAD_INVENTORY_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] or redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('hmset', KEYS[1], 'total', ARGV[2], 'available', ARGV[3])
+return 1
+"""
+_load_inventory_script = None
+
+# correct drifted counters, unless they were adjusted since they were read. a drift is only corrected when
+# the previous run saw the very same drift: a tx that was committed before the count but whose adjustment
+# was still on its way would look like a drift, but only for a single run.
+RECONCILE_INVENTORY_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+if redis.call('get', KEYS[3]) ~= ARGV[2] then
+    redis.call('set', KEYS[3], ARGV[2], 'EX', ARGV[5])
+    return 0
+end
+redis.call('hmset', KEYS[1], 'total', ARGV[3], 'available', ARGV[4])
+redis.call('del', KEYS[3])
+return 1
+"""
+_reconcile_inventory_script = None
+
 class Good(db.Model):
     """the Good class represent a single goods (as in, the singular of Goods).
 
@@ -25,6 +76,12 @@ class Good(db.Model):
     created_at = db.Column(ArrowType)
     updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
     extra_info = db.Column(db.JSON) # for additional, schemaless date
+    code_hash = db.Column(db.String(32), nullable=True, unique=True)  # the md5 of string values, see get_code_hash
+
+    # the unallocated goods of each offer, in allocation order: used to allocate goods and to count them
+    # the goods of each redeeming tx: used to join the goods with the user's txs (see get_redeemed_goods_page)
+    __table_args__ = (db.Index('ix_good_unallocated', 'offer_id', 'sid', postgresql_where=text('order_id IS NULL')),
+                      db.Index('ix_good_tx_hash', 'tx_hash', postgresql_where=text('tx_hash IS NOT NULL')))
 
     def __repr__(self):
         return '<sid: %s, offer_id: %s, order_id: %s, type: %s, tx_hash: %s, created_at: %s,' \
@@ -47,19 +104,161 @@ def create_good(offer_id, good_type, value, extra_info=None):
         good.offer_id = offer_id
         good.good_type = good_type
         good.value = value
+        good.code_hash = get_code_hash(value)
         good.created_at = now
         if extra_info:
             good.extra_info = extra_info
 
         db.session.add(good)
         db.session.commit()
+    except IntegrityError:
+        # the same code was added concurrently
+        db.session.rollback()
+        log.error('refusing to create good with code: %s as it already exists in the db' % value)
+        return False
     except Exception as e:
         log.error('failed to create a new good. e:%s' % e)
         raise InternalError('failed to create a new good')
     else:
+        adjust_inventory(offer_id, total_delta=1, available_delta=1)
+        return_good_to_pool(offer_id, good.sid)
         return True
 
 
+# codes that are already in the db are skipped
+CREATE_GOODS_STATEMENT = """
+INSERT INTO good (sid, offer_id, good_type, value, code_hash, created_at, updated_at)
+SELECT nextval('sid'), :offer_id, :good_type, to_json(code), md5(code), timezone('utc', now()), now()
+FROM unnest(CAST(:codes AS text[])) WITH ORDINALITY AS codes (code, position)
+ORDER BY position
+ON CONFLICT (code_hash) DO NOTHING
+RETURNING sid;
+"""
+
+
+def create_goods(offer_id, good_type, codes):
+    """creates a good for each of the given (string) codes with a single statement. codes that already exist are skipped.
+
+    returns the number of goods created.
+    """
+    if not offer_id:
+        log.error('refusing to create goods with offer_id: %s' % offer_id)
+        return 0
+
+    try:
+        stmt = text(CREATE_GOODS_STATEMENT).execution_options(autocommit=True)
+        sids = [row[0] for row in db.engine.execute(stmt, offer_id=str(offer_id), good_type=good_type, codes=list(codes)).fetchall()]
+    except Exception as e:
+        log.error('failed to create new goods. e:%s' % e)
+        raise InternalError('failed to create new goods')
+
+    if len(sids) < len(codes):
+        log.info('skipped %s codes that already exist in the db' % (len(codes) - len(sids)))
+    if sids:
+        adjust_inventory(offer_id, total_delta=len(sids), available_delta=len(sids))
+        return_goods_to_pool(offer_id, sids)
+    return len(sids)
+
+
+# the staging table of ingest_goods. it only lives until the end of the ingesting transaction
+CREATE_GOODS_STAGING_TABLE_STATEMENT = 'CREATE TEMP TABLE good_staging (position serial, code text) ON COMMIT DROP;'
+
+INGEST_STAGED_GOODS_STATEMENT = """
+INSERT INTO good (sid, offer_id, good_type, value, code_hash, created_at, updated_at)
+SELECT nextval('sid'), %(offer_id)s, %(good_type)s, to_json(code), md5(code), timezone('utc', now()), now()
+FROM (SELECT position, btrim(code) AS code FROM good_staging) staged
+WHERE code IS NOT NULL AND code != ''
+ORDER BY position
+ON CONFLICT (code_hash) DO NOTHING
+RETURNING sid;
+"""
+
+
+def ingest_goods(offer_id, good_type, stream, input_format='csv'):
+    """creates a good for each of the codes in the given stream. codes that already exist are skipped.
+
+    the codes are COPYed into a staging table and then inserted into the good table with a single statement.
+    the stream is either a csv file with a code per line, or ndjson with a json string per line.
+    returns the number of codes that were inserted, and the number of duplicates.
+    """
+    if input_format == 'ndjson':
+        stream = _ndjson_to_csv(stream)
+
+    conn = db.engine.raw_connection()
+    # in prod, the pooled connections are in autocommit mode - which would drop the staging table right after
+    # it's created. the whole ingestion runs in a single transaction instead
+    autocommit = conn.connection.autocommit
+    conn.connection.autocommit = False
+    try:
+        cur = conn.cursor()
+        cur.execute(CREATE_GOODS_STAGING_TABLE_STATEMENT)
+        cur.copy_expert('COPY good_staging (code) FROM STDIN WITH (FORMAT csv)', stream)
+        cur.execute("SELECT count(*) FROM good_staging WHERE btrim(code) != '';")
+        staged = cur.fetchone()[0]
+        cur.execute(INGEST_STAGED_GOODS_STATEMENT, {'offer_id': str(offer_id), 'good_type': good_type})
+        sids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.error('failed to ingest goods for offer_id %s. e:%s' % (offer_id, e))
+        raise InternalError('failed to ingest goods')
+    finally:
+        conn.connection.autocommit = autocommit
+        conn.close()
+
+    log.info('ingested %s goods for offer_id %s. skipped %s duplicates' % (len(sids), offer_id, staged - len(sids)))
+    if sids:
+        adjust_inventory(offer_id, total_delta=len(sids), available_delta=len(sids))
+        return_goods_to_pool(offer_id, sids)
+    return len(sids), staged - len(sids)
+
+
+class _NdjsonToCsv(object):
+    """a file-like csv view of an ndjson stream of codes, for COPY to read. lines are converted as they're read"""
+
+    def __init__(self, stream):
+        self._lines = iter(stream)
+        self._buffer = ''
+        self._csv_line = io.StringIO()
+        self._writer = csv.writer(self._csv_line, lineterminator='\n')
+
+    def _next_csv_line(self):
+        """returns the next code as a csv line, or None at the end of the stream"""
+        for line in self._lines:
+            line = line.decode('utf-8').strip() if isinstance(line, bytes) else line.strip()
+            if line:
+                self._csv_line.seek(0)
+                self._csv_line.truncate()
+                self._writer.writerow([json.loads(line)])
+                return self._csv_line.getvalue()
+        return None
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            csv_line = self._next_csv_line()
+            if csv_line is None:
+                break
+            self._buffer = self._buffer + csv_line
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if not self._buffer:
+            self._buffer = self._next_csv_line() or ''
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+
+def _ndjson_to_csv(stream):
+    """convert an ndjson stream of codes into a csv stream that COPY can read - lazily, without buffering the stream"""
+    return _NdjsonToCsv(stream)
+
+
 def list_all_goods():
     """returns a dict of all the goods"""
     response = {}
@@ -72,12 +271,143 @@ def list_all_goods():
 def list_inventory():
     """for each offer_id, generate a dict with the number of total goods and unallocated ones"""
     res = {}
-    offers = Offer.query.order_by(Offer.offer_id).all()
-    for offer in offers:
-        res[offer.offer_id] = {'total': count_total_goods(offer.offer_id), 'unallocated': count_available_goods(offer.offer_id)}
+    offer_ids = [offer.offer_id for offer in Offer.query.order_by(Offer.offer_id).all()]
+    for offer_id, (total, available) in get_inventory_counters(offer_ids).items():
+        res[offer_id] = {'total': total, 'unallocated': available}
+    return res
+
+
+INVENTORY_REPORT_QUERY = """
+SELECT offer.offer_id, count(good.sid) AS total,
+    count(good.sid) FILTER (WHERE good.order_id IS NULL) AS unallocated,
+    count(good.sid) FILTER (WHERE good.order_id IS NOT NULL AND good.updated_at > now() - CAST(:window_mins AS integer) * interval '1 minute') AS allocated_in_window
+FROM offer LEFT JOIN good ON good.offer_id = offer.offer_id
+GROUP BY offer.offer_id
+ORDER BY offer.offer_id;
+"""
+
+
+def get_inventory_report(window_mins=60):
+    """for each offer_id, the total and unallocated goods - and the allocation velocity, with a single query.
+
+    the velocity is the number of goods that were allocated (booked or redeemed) in the last window_mins, as
+    allocations per hour. hours_left is how long the unallocated goods would last at that rate.
+    """
+    res = {}
+    rows = db.engine.execute(text(INVENTORY_REPORT_QUERY), window_mins=int(window_mins)).fetchall()
+    for row in rows:
+        allocations_per_hour = row['allocated_in_window'] * 60.0 / window_mins
+        res[row['offer_id']] = {'total': row['total'], 'unallocated': row['unallocated'],
+                                'allocated_in_window': row['allocated_in_window'],
+                                'allocations_per_hour': allocations_per_hour,
+                                'hours_left': row['unallocated'] / allocations_per_hour if allocations_per_hour else None}
     return res
 
 
+def adjust_inventory(offer_id, total_delta=0, available_delta=0):
+    """adjust the offer's inventory counters, following a change to its goods in the db"""
+    global _adjust_inventory_script
+    try:
+        if _adjust_inventory_script is None:
+            _adjust_inventory_script = app.redis.register_script(ADJUST_INVENTORY_SCRIPT)
+        available = _adjust_inventory_script(keys=[INVENTORY_REDIS_KEY % offer_id, INVENTORY_VERSION_REDIS_KEY % offer_id], args=[total_delta, available_delta])
+    except Exception as e:
+        # the reconciliation job fixes the counters later on
+        log.error('failed to adjust the inventory counters of offer_id %s. e: %s' % (offer_id, e))
+        return
+
+    if available is not None and available_delta and (available == 0 or available == available_delta):
+        # the offer just sold out, or just got goods again
+        from .offer_catalog import invalidate_offer_catalog
+        invalidate_offer_catalog()
+
+
+def get_inventory_counters(offer_ids):
+    """returns a dict of offer_id: (total, available) goods, for the given offer_ids.
+
+    the counters are read from redis in a single round trip. missing counters are loaded from the db.
+    """
+    global _load_inventory_script
+    pipe = app.redis.pipeline(transaction=False)
+    for offer_id in offer_ids:
+        pipe.hmget(INVENTORY_REDIS_KEY % offer_id, 'total', 'available')
+        pipe.get(INVENTORY_VERSION_REDIS_KEY % offer_id)
+    results = pipe.execute()
+
+    counters = {}
+    for offer_id, (total, available), version in zip(offer_ids, results[0::2], results[1::2]):
+        if total is None or available is None:
+            increment_metric('inventory-counters-miss')
+            total, available = count_total_goods(offer_id), count_available_goods(offer_id)
+            if _load_inventory_script is None:
+                _load_inventory_script = app.redis.register_script(LOAD_INVENTORY_SCRIPT)
+            # an adjustment that raced with the count would be lost: the next read loads the counters again
+            _load_inventory_script(keys=[INVENTORY_REDIS_KEY % offer_id, INVENTORY_VERSION_REDIS_KEY % offer_id],
+                                   args=[(version or b'0').decode('utf-8'), total, available])
+        counters[offer_id] = (int(total), int(available))
+    return counters
+
+
+def reset_inventory_counters(offer_id):
+    """drop the offer's inventory counters and goods pool. they're loaded from the db when needed"""
+    pipe = app.redis.pipeline()
+    pipe.incr(INVENTORY_VERSION_REDIS_KEY % offer_id)
+    pipe.delete(INVENTORY_REDIS_KEY % offer_id, GOODS_POOL_REDIS_KEY % offer_id)
+    pipe.execute()
+    from .offer_catalog import invalidate_offer_catalog
+    invalidate_offer_catalog()
+
+
+def reconcile_inventory():
+    """correct the inventory counters of the offers whose counters drifted from the actual counts in the db.
+
+    a drift is corrected on the second run in a row that sees it, and only if the counters weren't adjusted
+    while the goods were counted (see RECONCILE_INVENTORY_SCRIPT). counters that aren't loaded are left alone.
+    returns the number of offers whose counters were corrected.
+    """
+    global _reconcile_inventory_script
+    if _reconcile_inventory_script is None:
+        _reconcile_inventory_script = app.redis.register_script(RECONCILE_INVENTORY_SCRIPT)
+
+    offer_ids = [offer.offer_id for offer in Offer.query.all()]
+
+    # read the counters and their versions before counting, so adjustments made during the count are detected
+    pipe = app.redis.pipeline(transaction=True)
+    for offer_id in offer_ids:
+        pipe.hmget(INVENTORY_REDIS_KEY % offer_id, 'total', 'available')
+        pipe.get(INVENTORY_VERSION_REDIS_KEY % offer_id)
+    results = pipe.execute()
+    cached = dict(zip(offer_ids, zip(results[0::2], results[1::2])))
+
+    counts = {}
+    results = db.engine.execute("select offer_id, count(sid), count(sid) filter (where order_id is NULL) from good group by offer_id;")
+    for offer_id, total, available in results.fetchall():
+        counts[offer_id] = (total, available)
+
+    drifted = 0
+    for offer_id in offer_ids:
+        (cached_total, cached_available), version = cached[offer_id]
+        if cached_total is None or cached_available is None:
+            continue
+        total, available = counts.get(offer_id, (0, 0))
+        drift = (int(cached_total) - total, int(cached_available) - available)
+        if drift == (0, 0):
+            app.redis.delete(INVENTORY_DRIFT_REDIS_KEY % offer_id)
+            continue
+
+        log.info('inventory counters of offer_id %s drifted by %s. actual: %s' % (offer_id, drift, (total, available)))
+        if _reconcile_inventory_script(keys=[INVENTORY_REDIS_KEY % offer_id, INVENTORY_VERSION_REDIS_KEY % offer_id, INVENTORY_DRIFT_REDIS_KEY % offer_id],
+                                       args=[(version or b'0').decode('utf-8'), '%s %s' % drift, total, available, config.INVENTORY_DRIFT_TTL_SECS]):
+            log.info('corrected the inventory counters of offer_id %s' % offer_id)
+            drifted = drifted + 1
+
+    increment_metric('inventory-counters-drift', drifted)
+    if drifted:
+        from .offer_catalog import invalidate_offer_catalog
+        invalidate_offer_catalog()
+    return drifted
+
+
 def count_total_goods(offer_id):
     offer_id = int(offer_id)  # sanitize input
     results = db.engine.execute("select count(sid) from good where good.offer_id=\'%s\';" % str(offer_id))  # safe
@@ -91,6 +421,25 @@ def count_available_goods(offer_id):
     return(results.fetchone()[0])
 
 
+# take the first unallocated good that isn't being allocated right now, instead of waiting on its lock
+ALLOCATE_GOOD_STATEMENT = """
+UPDATE good SET order_id = :order_id, updated_at = now()
+WHERE sid = (SELECT sid FROM good WHERE offer_id = :offer_id AND order_id IS NULL ORDER BY sid LIMIT 1 FOR UPDATE SKIP LOCKED)
+RETURNING sid;
+"""
+
+# the pool mode: confirm that the popped good wasn't allocated in the meantime
+CONFIRM_POOLED_GOOD_STATEMENT = """
+UPDATE good SET order_id = :order_id, updated_at = now()
+WHERE sid = :sid AND offer_id = :offer_id AND order_id IS NULL
+RETURNING sid;
+"""
+
+# the pool of unallocated good sids for each offer: a redis list
+GOODS_POOL_REDIS_KEY = 'goods-pool:%s'
+GOODS_POOL_REFILL_LOCK_REDIS_KEY = 'goods-pool-refill:%s'
+
+
 def allocate_good(offer_id, order_id):
     """find and allocate a good to an order.
        returns the good sid on success or None if no goods are available"""
@@ -98,24 +447,83 @@ def allocate_good(offer_id, order_id):
     #TODO ensure the order hasn't expired?
 
     try:
-        # lock the line until the commit is complete
-        good = db.session.query(Good).filter(Good.offer_id==offer_id).filter(Good.order_id == None).with_for_update().first()
-        if not good:
-            return None
-        good.order_id = order_id
-        db.session.add(good)
-        db.session.commit()
-        db.session.flush()
+        if config.GOODS_ALLOCATION_MODE == 'pool':
+            sid = allocate_pooled_good(offer_id, order_id)
+        else:
+            stmt = text(ALLOCATE_GOOD_STATEMENT).execution_options(autocommit=True)
+            sid = db.engine.execute(stmt, offer_id=str(offer_id), order_id=order_id).scalar()
     except Exception as e:
-        db.session.rollback()
         log.error('failed to allocate good with order_id: %s. exception: %s' % (order_id, e))
         raise InternalError('cant allocate good for order_id: %s' % order_id)
-    else:
-        return good.sid
 
+    if sid is None:
+        return None
+    adjust_inventory(offer_id, available_delta=-1)
+    return sid
 
-def finalize_good(order_id, tx_hash):
-    """mark this good as used-up. return True on success"""
+
+def allocate_pooled_good(offer_id, order_id):
+    """pop unallocated goods from the offer's pool until one is confirmed in the db. returns its sid or None"""
+    stmt = text(CONFIRM_POOLED_GOOD_STATEMENT).execution_options(autocommit=True)
+    refilled = False
+    while True:
+        sid = app.redis.lpop(GOODS_POOL_REDIS_KEY % offer_id)
+        if sid is None:
+            # refill the pool once, then give up
+            if refilled or not refill_goods_pool(offer_id):
+                return None
+            refilled = True
+            continue
+
+        sid = db.engine.execute(stmt, sid=int(sid), offer_id=str(offer_id), order_id=order_id).scalar()
+        if sid is not None:
+            return sid
+        # a stale sid (say, pushed twice by concurrent refills): skip it
+        increment_metric('goods-pool-stale')
+
+
+def refill_goods_pool(offer_id):
+    """push the next batch of unallocated goods into the offer's pool. returns False if there are none.
+
+    only one refill per offer runs at a time. the others wait for it to complete.
+    """
+    lock_key = GOODS_POOL_REFILL_LOCK_REDIS_KEY % offer_id
+    if not app.redis.set(lock_key, 1, nx=True, ex=10):
+        for i in range(50):
+            time.sleep(0.02)
+            if not app.redis.exists(lock_key):
+                break
+        return app.redis.llen(GOODS_POOL_REDIS_KEY % offer_id) > 0
+
+    try:
+        results = db.engine.execute(text("SELECT sid FROM good WHERE offer_id = :offer_id AND order_id IS NULL ORDER BY sid LIMIT :limit;"),
+                                    offer_id=str(offer_id), limit=int(config.GOODS_POOL_REFILL_SIZE))
+        sids = [row[0] for row in results.fetchall()]
+        if sids:
+            app.redis.rpush(GOODS_POOL_REDIS_KEY % offer_id, *sids)
+        increment_metric('goods-pool-refill')
+        return len(sids) > 0
+    finally:
+        app.redis.delete(lock_key)
+
+
+def return_good_to_pool(offer_id, sid):
+    """push a good that was just created or released back into the offer's pool, if the pool is in use"""
+    if config.GOODS_ALLOCATION_MODE == 'pool':
+        app.redis.rpushx(GOODS_POOL_REDIS_KEY % offer_id, sid)
+
+
+def return_goods_to_pool(offer_id, sids):
+    """push many goods that were just created into the offer's pool in a single round trip, if the pool is in use"""
+    if config.GOODS_ALLOCATION_MODE == 'pool' and sids:
+        pipe = app.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.rpushx(GOODS_POOL_REDIS_KEY % offer_id, sid)
+        pipe.execute()
+
+
+def finalize_good(order_id, tx_hash, user_id):
+    """mark this good as used-up by the given user. return True on success"""
     good_res = {}
     try:
         # lock the line until the commit is complete
@@ -135,6 +543,7 @@ def finalize_good(order_id, tx_hash):
         log.error('failed to finalize good with order_id: %s. exception: %s' % (order_id, e))
         raise InternalError('cant finalize good for order_id: %s' % order_id)
     else:
+        invalidate_redeemed_goods_cache(user_id)
         return True, good_res
 
 
@@ -144,6 +553,7 @@ def release_good(order_id):
         # lock the line until the commit is compelete
         good = db.session.query(Good).filter(Good.order_id == order_id).with_for_update().one()
         good.order_id = None
+        offer_id, sid = good.offer_id, good.sid
         db.session.add(good)
         db.session.commit()
     except Exception as e:
@@ -152,49 +562,223 @@ def release_good(order_id):
         db.session.rollback()
         return False
     else:
+        adjust_inventory(offer_id, available_delta=1)
+        return_good_to_pool(offer_id, sid)
         return True
 
 
+# release the goods of a batch of expired orders and delete these orders, in a single statement.
+# order.created_at is a naive utc timestamp (ArrowType)
+RELEASE_EXPIRED_ORDERS_STATEMENT = """
+WITH expired AS (
+    SELECT order_id FROM "order"
+    WHERE created_at < timezone('utc', now()) - CAST(:expiration_secs AS integer) * interval '1 second'
+    ORDER BY created_at
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+), released AS (
+    UPDATE good SET order_id = NULL, updated_at = now()
+    FROM expired
+    WHERE good.order_id = expired.order_id AND good.tx_hash IS NULL
+    RETURNING good.sid, good.offer_id
+), deleted AS (
+    DELETE FROM "order" USING expired WHERE "order".order_id = expired.order_id
+), orphaned AS (
+    -- goods whose order row is gone (a failed order insert, or an order deleted by hand). the grace period
+    -- leaves alone the goods of orders that are being created right now
+    UPDATE good SET order_id = NULL, updated_at = now()
+    WHERE good.sid IN (
+        SELECT sid FROM good
+        WHERE order_id IS NOT NULL AND tx_hash IS NULL
+        AND updated_at < now() - CAST(:expiration_secs AS integer) * interval '1 second'
+        AND NOT EXISTS (SELECT 1 FROM "order" WHERE "order".order_id = good.order_id)
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED)
+    RETURNING good.sid, good.offer_id
+)
+SELECT (SELECT count(*) FROM expired) AS expired_orders, (SELECT count(*) FROM orphaned) AS orphaned_goods,
+       (SELECT json_agg(json_build_array(sid, offer_id)) FROM (SELECT sid, offer_id FROM released UNION ALL SELECT sid, offer_id FROM orphaned) goods) AS released_goods;
+"""
+
+
 def release_unclaimed_goods():
-    """traverse the list of goods and release those associated with expired goods
-        
-       this should be called by cron every minute or so
+    """release the goods of expired orders and delete these orders, in batches of ORDER_RELEASE_BATCH_SIZE orders.
+       goods whose order no longer exists are released too.
+
+       this should be called by cron every minute or so. returns the number of released goods.
     """
     print('releasing unclaimed goods...')
+    stmt = text(RELEASE_EXPIRED_ORDERS_STATEMENT).execution_options(autocommit=True)
+    batch_size = int(config.ORDER_RELEASE_BATCH_SIZE)
     released = 0
-    goods = db.session.query(Good).filter(Good.tx_hash == None).filter(Good.order_id != None).all()
-    for good in goods:
-        from .order import has_expired # don't move me to prevent cyclical deps
-        if has_expired(good.order_id):
-            release_good(good.order_id)
+    deleted_orders = 0
+    while True:
+        row = db.engine.execute(stmt, expiration_secs=int(config.ORDER_EXPIRATION_SECS), batch_size=batch_size).fetchone()
+        deleted_orders = deleted_orders + row['expired_orders']
+        for sid, offer_id in row['released_goods'] or []:
+            adjust_inventory(offer_id, available_delta=1)
+            return_good_to_pool(offer_id, sid)
             released = released + 1
+        if row['expired_orders'] < batch_size and row['orphaned_goods'] < batch_size:
+            break
 
-    log.info('released %s goods' % released)
+    log.info('released %s goods, deleted %s expired orders' % (released, deleted_orders))
     return released
 
 
 def goods_avilable(offer_id):
     """returns true if the given offer_id has avilable goods"""
-    return db.session.query(Good).filter(Good.offer_id == offer_id).filter(Good.order_id == None).count()>0
-
+    return get_inventory_counters([offer_id])[offer_id][1] > 0
+
+
+# a page of the goods the user redeemed, newest first, with the details of their offers.
+# the keyset condition (if any) is added by get_redeemed_goods_page
+REDEEMED_GOODS_PAGE_QUERY = """
+SELECT g.sid, g.value, g.good_type, g.offer_id, g.updated_at, o.title, o."desc", o.provider_data
+FROM transaction t
+JOIN good g ON g.tx_hash = t.tx_hash
+LEFT JOIN offer o ON o.offer_id = g.offer_id
+WHERE t.user_id = CAST(:user_id AS uuid) AND t.incoming_tx = true %s
+ORDER BY g.updated_at DESC, g.sid DESC
+LIMIT :limit;
+"""
+
+# the full list of each user's redeemed goods, serialized - as served to the clients that don't page it
+REDEEMED_GOODS_CACHE_REDIS_KEY = 'redeemed-goods:%s'
+# bumped on every redeem, so a fill that read the db before the redeem doesn't cache a stale list
+REDEEMED_GOODS_GENERATION_REDIS_KEY = 'redeemed-goods-generation:%s'
+
+# cache the list only if no good was redeemed since it was read from the db
+CACHE_REDEEMED_GOODS_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+_cache_redeemed_goods_script = None
+
+
+def _redeemed_goods_keys(user_id):
+    """the cache keys of the given user. the user_id is normalized, as it comes both from the headers and the db"""
+    user_id = UUID(str(user_id))
+    return [REDEEMED_GOODS_CACHE_REDIS_KEY % user_id, REDEEMED_GOODS_GENERATION_REDIS_KEY % user_id]
+
+
+def get_redeemed_goods_page(user_id, limit, cursor=None):
+    """returns the goods the user redeemed that come after the cursor, newest first, and at most limit of them
+    (or all of them, if limit is None).
+
+    returns a (redeemed, next_cursor) tuple. next_cursor is None on the last page.
+    """
+    from .transaction import encode_tx_cursor, decode_tx_cursor
+    params = {'user_id': str(user_id), 'limit': int(limit) if limit is not None else None}  # LIMIT NULL is no limit
+    keyset = ''
+    if cursor:
+        params['before_updated_at'], params['before_sid'] = decode_tx_cursor(cursor)
+        keyset = 'AND (g.updated_at, g.sid) < (CAST(:before_updated_at AS timestamptz), CAST(:before_sid AS integer))'
+    rows = db.engine.execute(text(REDEEMED_GOODS_PAGE_QUERY % keyset), **params).fetchall()
 
-def get_redeemed_items(tx_hases):
-    """returns an array of redeemed goods by the given tx_hashes array"""
     redeemed = []
+    for row in rows:
+        if row['title'] is None:
+            log.error('cant find offer with id %s. using default text' % row['offer_id'])
+            details = {'title': 'unknown offer', 'desc': '', 'provider': {}}
+        else:
+            details = {'title': row['title'], 'desc': row['desc'], 'provider': row['provider_data']}
+        redeemed.append({'date': arrow.get(row['updated_at']).timestamp, 'value': row['value'], 'type': row['good_type'], 'offer_id': row['offer_id'], **details})
 
-    if not tx_hases:
-        return redeemed
+    next_cursor = encode_tx_cursor(rows[-1]['updated_at'], rows[-1]['sid']) if len(rows) == limit else None
+    return redeemed, next_cursor
 
-    for good in db.session.query(Good).filter(Good.tx_hash.in_(tx_hases)).order_by(Good.updated_at.desc()).all():
-            redeemed.append({'date': arrow.get(good.updated_at).timestamp, 'value': good.value, 'type': good.good_type, 'offer_id': good.offer_id})
-    return redeemed
+
+def get_cached_redeemed_goods(user_id):
+    """returns (the serialized list of the user's redeemed goods or None if it isn't cached, the cache generation).
+
+    the generation is to be passed on to cache_redeemed_goods.
+    """
+    try:
+        cached, generation = app.redis.mget(_redeemed_goods_keys(user_id))
+        return cached, (generation or b'0').decode('utf-8')
+    except Exception as e:
+        log.error('failed to read the redeemed goods cache of user_id %s. e: %s' % (user_id, e))
+        return None, None
+
+
+def cache_redeemed_goods(user_id, serialized, generation):
+    """cache the user's redeemed goods, unless a good was redeemed since the given generation was read"""
+    global _cache_redeemed_goods_script
+    if generation is None:
+        return
+    try:
+        if _cache_redeemed_goods_script is None:
+            _cache_redeemed_goods_script = app.redis.register_script(CACHE_REDEEMED_GOODS_SCRIPT)
+        _cache_redeemed_goods_script(keys=_redeemed_goods_keys(user_id), args=[generation, serialized, config.REDEEMED_GOODS_CACHE_TTL_SECS])
+    except Exception as e:
+        log.error('failed to cache the redeemed goods of user_id %s. e: %s' % (user_id, e))
+
+
+def invalidate_redeemed_goods_cache(user_id):
+    try:
+        cache_key, generation_key = _redeemed_goods_keys(user_id)
+        pipe = app.redis.pipeline()
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, config.REDEEMED_GOODS_CACHE_TTL_SECS)
+        pipe.delete(cache_key)
+        pipe.execute()
+    except Exception as e:
+        log.error('failed to invalidate the redeemed goods cache of user_id %s. e: %s' % (user_id, e))
+
+
+def get_code_hash(value):
+    """returns the hash by which duplicate codes are detected: the md5 of the code. only string values are codes"""
+    if not isinstance(value, str):
+        return None
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
 
 
 def does_code_exist(code):
     """return true if the given code is already present in the db"""
-    results = db.engine.execute("select * from good where cast(value as varchar)='\"%s\"' limit 1;" % code)
-    results = results.fetchall()
-    return (results != [])
+    code_hash = get_code_hash(code)
+    if code_hash is None:
+        return False
+    return db.session.query(Good.sid).filter(Good.code_hash == code_hash).first() is not None
+
+
+# set the code_hash of the goods that predate it, a batch of goods at a time. if an existing code appears more
+# than once, only its first good gets the hash.
+BACKFILL_CODE_HASHES_STATEMENT = """
+WITH batch AS (
+    SELECT sid, md5(value #>> '{}') AS code_hash FROM good
+    WHERE sid > :after_sid AND code_hash IS NULL AND json_typeof(value) = 'string'
+    ORDER BY sid LIMIT :batch_size
+), firsts AS (
+    SELECT DISTINCT ON (code_hash) sid, code_hash FROM batch ORDER BY code_hash, sid
+), updated AS (
+    UPDATE good SET code_hash = firsts.code_hash FROM firsts
+    WHERE good.sid = firsts.sid AND NOT EXISTS (SELECT 1 FROM good existing WHERE existing.code_hash = firsts.code_hash)
+    RETURNING good.sid
+)
+SELECT (SELECT max(sid) FROM batch) AS last_sid, (SELECT count(*) FROM batch) AS scanned, (SELECT count(*) FROM updated) AS updated;
+"""
+
+
+def backfill_code_hashes(batch_size=10000):
+    """set the code_hash of the existing goods. returns the number of goods that were left without one as duplicates.
+
+    the column itself is added before the deploy, by helpers/migrate_good_code_hash.py.
+    """
+    stmt = text(BACKFILL_CODE_HASHES_STATEMENT).execution_options(autocommit=True)
+    after_sid, duplicates = 0, 0
+    while True:
+        row = db.engine.execute(stmt, after_sid=after_sid, batch_size=batch_size).first()
+        if not row['scanned']:
+            break
+        after_sid = row['last_sid']
+        duplicates = duplicates + row['scanned'] - row['updated']
+    if duplicates:
+        log.error('backfill_code_hashes: %s goods have duplicate codes' % duplicates)
+    return duplicates
 
 
 def get_user_goods_report(user_id):
@@ -1,7 +1,21 @@
-from kinappserver import db, config, utils
-from kinappserver.utils import InvalidUsage, test_image, OS_ANDROID, OS_IOS
+import time
+from sqlalchemy import text
+from kinappserver import db, config, app
+from kinappserver.utils import InvalidUsage, test_image
 import logging as log
-from datetime import datetime, timedelta
+
+# each user's locked offers are kept in a sorted set of offer_id: unlock timestamp. the sentinel member, which
+# never unlocks, tells an empty set from one that wasn't built yet
+LOCKED_OFFERS_SENTINEL = '-'
+LOCK_OFFER_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[3])
+    redis.call('zadd', KEYS[1], ARGV[1], ARGV[2])
+    return redis.call('expire', KEYS[1], ARGV[4])
+end
+return nil
+"""
+_lock_offer_script = None
 
 class Offer(db.Model):
     """the Offer class represent a single offer"""
@@ -66,6 +80,8 @@ def set_offer_active(offer_id, is_active):
     offer.is_active = is_active
     db.session.add(offer)
     db.session.commit()
+    from .offer_catalog import invalidate_offer_catalog
+    invalidate_offer_catalog()
     return True
 
 
@@ -122,6 +138,9 @@ def add_offer(offer_json, set_active=False):
         log.error('cant add offer to db with id %s' % offer_json['id'])
         return False
     else:
+        # a new offer has no goods: drop any stale inventory counters of an offer that had this id
+        from .good import reset_inventory_counters
+        reset_inventory_counters(offer.offer_id)
         if set_active:
             set_offer_active(str(offer_json['id']), True)
         return True
@@ -137,80 +156,34 @@ def get_cost_and_address(offer_id):
 
 def get_offers_for_user(user_id):
     """return the list of offers with there status for this user"""
-    import time
-    from distutils.version import LooseVersion
-    from .user import get_user_app_data, get_user_os_type, get_user_inapp_balance
-    from .good import goods_avilable
+    import json
+    return json.loads(get_offers_json_for_user(user_id).decode('utf-8'))
 
-    all_offers = Offer.query.filter_by(is_active=True).order_by(Offer.kin_cost.asc()).all()
 
-    start = time.time()
-    locked_offers_ids = get_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE)
-    end = time.time()
-    log.info("## locked_offers_ids MID PTIME: %s", end - start)
+def get_offers_json_for_user(user_id):
+    """return the list of offers with there status for this user, as a json array (bytes).
+
+    the offers are rendered in advance for each client class (see offer_catalog), so all that's left to do per user
+    is to mark the locked offers and the ones the user can't afford.
+    """
+    import time
+    from .user import get_user_app_data, get_user_os_type, get_user_inapp_balance
+    from .offer_catalog import get_client_catalog, render_offers
 
     start = time.time()
+    locked_offers_ids = set(get_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE))
     user_balance = get_user_inapp_balance(user_id)
-    end = time.time()
-    log.info("## GETTING user_balance MID PTIME: %s", end - start)
-
-    # filter out offers with no goods
-    available_offers = []
-    unavailable_offers = []
-    for offer in all_offers:
-        if offer.offer_type == 'p2p':
-            # we no longer support p2p as an offer type
-            # we may want to add it again in the future, in which case we will have
-            # to handle it being on top of the list + appear only for versions that support it.
-            continue
-        elif not goods_avilable(offer.offer_id):
-            offer.unavailable_reason = 'Sold out\nCheck back again soon'
-            unavailable_offers.append(offer)
-        elif str(offer.offer_id) in locked_offers_ids:
-            offer.unavailable_reason = 'You’ve reached the maximum number of this gift card for this month'
-            unavailable_offers.append(offer)
-        elif user_balance < offer.kin_cost:
-            offer.cannot_buy_reason = 'Sorry, You can only buy goods with Kin earned from Kinit.'
-            available_offers.append(offer)
-        else:
-            available_offers.append(offer)
-
-
-    # customize list according to client_version and os_type
+
     try:
         client_version = get_user_app_data(user_id).app_ver
         os_type = get_user_os_type(user_id)
     except Exception as e:
-        redeemable_offers = available_offers
+        client_version, os_type = None, None
         log.error('cant get app_ver or os_type - not filtering offers')
-    else:
-        if os_type == OS_ANDROID and LooseVersion(client_version) < LooseVersion(
-                config.OFFER_RATE_LIMIT_MIN_ANDROID_VERSION):
-            # client does not support "unavailable" text on offers
-            redeemable_offers = available_offers
-        elif os_type == OS_IOS and LooseVersion(client_version) < LooseVersion(config.OFFER_RATE_LIMIT_MIN_IOS_VERSION):
-            # client does not support "unavailable" text on offers
-            redeemable_offers = available_offers
-        else:
-            # client supports "unavailable" text on offers
-            redeemable_offers = available_offers + unavailable_offers
-
-        for offer in redeemable_offers:
-            if os_type == OS_ANDROID and offer.min_client_version_android:
-                if LooseVersion(offer.min_client_version_android) > LooseVersion(client_version):
-                    redeemable_offers.remove(offer)
-            elif os_type == OS_IOS and offer.min_client_version_ios:
-                if LooseVersion(offer.min_client_version_ios) > LooseVersion(client_version):
-                    redeemable_offers.remove(offer)
-
-    # convert to json
-    offers_json_array = []
-    for offer in redeemable_offers:
-        offers_json_array.append(offer_to_json(offer))
-
-    end = time.time()
-    log.info('offers for user %s: %s. \n ## GETTING OFFERS PTIME: %s' % (user_id, [o['id'] for o in offers_json_array], end - start))
-    return offers_json_array
+
+    offers_json = render_offers(get_client_catalog(os_type, client_version), locked_offers_ids, user_balance)
+    log.info('offers for user %s. ## GETTING OFFERS PTIME: %s' % (user_id, time.time() - start))
+    return offers_json
 
 
 def get_offer_details(offer_id):
@@ -224,35 +197,60 @@ def get_offer_details(offer_id):
 
 
 def set_locked_offers(user_id, days):
-    """ scan the db for offers bought in the last {days} and update USER_LOCKED_OFFERS_REDIS_KEY"""
+    """scan the db for offers bought in the last {days} and rebuild the user's locked offers set. returns the locked offer_ids"""
     log.info("user_id: %s - not cache - set_locked_offers! " % user_id)
-    date_days_from_now = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-    offers_bought_in_time_range = db.engine.execute("select tx_info, update_at from public.transaction "
-                                                    "where user_id='%s' and incoming_tx=true "
-                                                    "and update_at > ('%s'::date);" % (user_id, date_days_from_now)).fetchall()
-    # extract data from result
-    offers_bought_in_time_range_ids = [item[0]['offer_id'] for item in offers_bought_in_time_range]
-    offers_bought_in_time_range_timestamp = [item[1].strftime('%m/%d/%Y') for item in offers_bought_in_time_range]
-    # build locked_offers_ids array
-    locked_offers_ids = dict(zip(offers_bought_in_time_range_ids, offers_bought_in_time_range_timestamp))
-    # write to cache
-    utils.write_json_to_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id, locked_offers_ids)
+    rows = db.engine.execute(text('''SELECT tx_info->>'offer_id' AS offer_id, extract(epoch FROM max(update_at)) AS bought_ts FROM public.transaction
+                                     WHERE user_id = CAST(:user_id AS uuid) AND incoming_tx = true AND update_at > now() - CAST(:days AS integer) * interval '1 day'
+                                     GROUP BY tx_info->>'offer_id';'''), user_id=str(user_id), days=int(days)).fetchall()
+
+    key = config.USER_LOCKED_OFFERS_REDIS_KEY % user_id
+    scores = ['+inf', LOCKED_OFFERS_SENTINEL]
+    for row in rows:
+        scores.extend([float(row['bought_ts']) + days * 24 * 60 * 60, row['offer_id']])
+    pipe = app.redis.pipeline()
+    pipe.delete(key)
+    pipe.zadd(key, *scores)
+    pipe.expire(key, days * 24 * 60 * 60)
+    pipe.execute()
+
+    locked_offers_ids = [row['offer_id'] for row in rows]
     log.info("user_id: %s - locked_offers_ids: %s" % (user_id, locked_offers_ids))
-    return locked_offers_ids.keys()
+    return locked_offers_ids
+
+
+def lock_offer(user_id, offer_id, days):
+    """lock the offer for the user for the next {days}, following a redeem.
+
+    if the user has no locked offers set, it is left for the next read to rebuild from the db.
+    """
+    global _lock_offer_script
+    try:
+        if _lock_offer_script is None:
+            _lock_offer_script = app.redis.register_script(LOCK_OFFER_SCRIPT)
+        now = time.time()
+        _lock_offer_script(keys=[config.USER_LOCKED_OFFERS_REDIS_KEY % user_id], args=[now + days * 24 * 60 * 60, str(offer_id), now, days * 24 * 60 * 60])
+    except Exception as e:
+        # bookings read the set too, so drop it and let the next read rebuild it from the db
+        log.error('failed to lock offer_id %s for user_id %s. e: %s' % (offer_id, user_id, e))
+        try:
+            app.redis.delete(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id)
+        except Exception as e:
+            log.error('failed to drop the locked offers of user_id %s. e: %s' % (user_id, e))
 
 
 def get_locked_offers(user_id, days):
-    """return list of locked offers"""
-    # first check if we have a cached result.
-    locked_offers_ids = utils.read_json_from_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id)
-    if locked_offers_ids is not None:
-        log.info("user_id: %s - get_locked_offers - cache found!" % user_id)
-        # we need to check if offer's timestamp is old enough to be unlocked
-        locked_offers_ids = {k: v for k, v in locked_offers_ids.items() if datetime.strptime(v, '%m/%d/%Y') + timedelta(days=days) > datetime.now()}
-        # update cache
-        utils.write_json_to_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id, locked_offers_ids)
-        log.info("user_id: %s - locked_offers_ids: %s" % (user_id, locked_offers_ids))
-        return locked_offers_ids.keys()
-    else:
-        # cache not available, query the db store and return the result
+    """return the list of offers the user can't buy right now, as they were bought in the last {days}.
+
+    expired locks are trimmed and the current ones are read in a single round trip. the offers list and the
+    booking both read this set, so they always agree on which offers are locked.
+    """
+    key = config.USER_LOCKED_OFFERS_REDIS_KEY % user_id
+    now = time.time()
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.zremrangebyscore(key, '-inf', now)
+    pipe.zrangebyscore(key, now, '+inf')
+    _, members = pipe.execute()
+    if not members:
+        # the set always holds the sentinel, so it doesn't exist yet (or expired): rebuild it from the db
         return set_locked_offers(user_id, days)
+    return [member.decode() for member in members if member.decode() != LOCKED_OFFERS_SENTINEL]
@@ -0,0 +1,159 @@
+"""the offer catalog: the offers list, pre-rendered for each client class.
+
+get_offers_for_user used to load the active offers and their inventory, compare their minimum client versions
+and serialize every offer dict for every user. the catalog does all of that once per (os_type, client version)
+and keeps, for each offer, the json fragment of each state it can be in for a user (available, can't buy,
+sold out or locked). a user's list is then just a pick of fragments - by the user's locked offers and balance -
+spliced into a json array.
+
+the catalogs are kept in each process, and are rebuilt when the catalog generation in redis changes. the
+generation is a random token, replaced whenever an offer is added or (de)activated, and whenever an offer sells
+out or gets goods again (see adjust_inventory).
+
+client versions only matter by the version thresholds they reach - the minimum version that displays unavailable
+offers and the offers' minimum versions - so all the versions that reach the same thresholds share one catalog.
+"""
+import json
+import threading
+import logging as log
+from uuid import uuid4
+
+from kinappserver import app, config
+from kinappserver.utils import OS_ANDROID, OS_IOS, increment_metric
+from kinappserver.version_utils import version_lt, version_gt, version_ge
+
+OFFER_CATALOG_GENERATION_REDIS_KEY = 'offer-catalog-generation'
+
+OFFER_STATE_AVAILABLE = 'available'
+OFFER_STATE_CANNOT_BUY = 'cannot_buy'
+OFFER_STATE_SOLD_OUT = 'sold_out'
+OFFER_STATE_LOCKED = 'locked'
+
+SOLD_OUT_REASON = 'Sold out\nCheck back again soon'
+LOCKED_REASON = 'You’ve reached the maximum number of this gift card for this month'
+CANNOT_BUY_REASON = 'Sorry, You can only buy goods with Kin earned from Kinit.'
+
+_catalog_lock = threading.Lock()
+_catalog = {'generation': None, 'offers': [], 'thresholds': {}, 'clients': {}}
+
+
+class CatalogOffer(object):
+    """an active offer, with its json fragments"""
+
+    def __init__(self, offer, sold_out):
+        from .offer import offer_to_json
+        self.offer_id = str(offer.offer_id)
+        self.kin_cost = offer.kin_cost
+        self.sold_out = sold_out
+        self.min_client_version_android = offer.min_client_version_android
+        self.min_client_version_ios = offer.min_client_version_ios
+        self.fragments = {}
+        for state, unavailable_reason, cannot_buy_reason in ((OFFER_STATE_AVAILABLE, None, None),
+                                                             (OFFER_STATE_CANNOT_BUY, None, CANNOT_BUY_REASON),
+                                                             (OFFER_STATE_SOLD_OUT, SOLD_OUT_REASON, None),
+                                                             (OFFER_STATE_LOCKED, LOCKED_REASON, None)):
+            offer.unavailable_reason = unavailable_reason
+            offer.cannot_buy_reason = cannot_buy_reason
+            self.fragments[state] = json.dumps(offer_to_json(offer)).encode('utf-8')
+        offer.unavailable_reason = offer.cannot_buy_reason = None
+
+
+class ClientCatalog(object):
+    """the offers a client class may see, and whether it can display unavailable offers"""
+
+    def __init__(self, offers, supports_unavailable):
+        self.offers = offers
+        self.supports_unavailable = supports_unavailable
+
+
+def invalidate_offer_catalog():
+    """make all the processes rebuild their catalogs on their next read"""
+    try:
+        app.redis.set(OFFER_CATALOG_GENERATION_REDIS_KEY, uuid4().hex)
+    except Exception as e:
+        log.error('failed to invalidate the offer catalog. e: %s' % e)
+
+
+def _load_catalog_offers():
+    """the active offers, cheapest first, with their inventory"""
+    from .offer import Offer
+    from .good import get_inventory_counters
+    offers = [offer for offer in Offer.query.filter_by(is_active=True).order_by(Offer.kin_cost.asc()).all()
+              # we no longer support p2p as an offer type
+              if offer.offer_type != 'p2p']
+    inventory = get_inventory_counters([offer.offer_id for offer in offers])
+    return [CatalogOffer(offer, inventory[offer.offer_id][1] == 0) for offer in offers]
+
+
+def _version_thresholds(offers):
+    """the client versions, per os_type, at which the client catalogs change"""
+    thresholds = {OS_ANDROID: [config.OFFER_RATE_LIMIT_MIN_ANDROID_VERSION], OS_IOS: [config.OFFER_RATE_LIMIT_MIN_IOS_VERSION]}
+    for offer in offers:
+        for os_type, min_version in ((OS_ANDROID, offer.min_client_version_android), (OS_IOS, offer.min_client_version_ios)):
+            if min_version and min_version not in thresholds[os_type]:
+                thresholds[os_type].append(min_version)
+    return thresholds
+
+
+def _build_client_catalog(offers, os_type, client_version):
+    if os_type is None:
+        # unknown client: no unavailable offers and no version filtering
+        return ClientCatalog(offers, False)
+
+    if os_type == OS_ANDROID and version_lt(client_version, config.OFFER_RATE_LIMIT_MIN_ANDROID_VERSION):
+        supports_unavailable = False
+    elif os_type == OS_IOS and version_lt(client_version, config.OFFER_RATE_LIMIT_MIN_IOS_VERSION):
+        supports_unavailable = False
+    else:
+        supports_unavailable = True
+
+    client_offers = []
+    for offer in offers:
+        if os_type == OS_ANDROID and offer.min_client_version_android and version_gt(offer.min_client_version_android, client_version):
+            continue
+        if os_type == OS_IOS and offer.min_client_version_ios and version_gt(offer.min_client_version_ios, client_version):
+            continue
+        client_offers.append(offer)
+    return ClientCatalog(client_offers, supports_unavailable)
+
+
+def get_client_catalog(os_type, client_version):
+    """returns the catalog of the given client class, (re)building it if needed"""
+    generation = app.redis.get(OFFER_CATALOG_GENERATION_REDIS_KEY)
+    if generation is None:
+        # a lost token is replaced by a new one, so no process keeps a catalog built before it was lost
+        app.redis.set(OFFER_CATALOG_GENERATION_REDIS_KEY, uuid4().hex, nx=True)
+        generation = app.redis.get(OFFER_CATALOG_GENERATION_REDIS_KEY)
+    with _catalog_lock:
+        if generation is None or _catalog['generation'] != generation:
+            increment_metric('offer-catalog-rebuild')
+            _catalog['offers'] = _load_catalog_offers()
+            _catalog['thresholds'] = _version_thresholds(_catalog['offers'])
+            _catalog['clients'] = {}
+            _catalog['generation'] = generation
+
+        # the client class is the os_type and the thresholds the client version reaches
+        client_key = (os_type,)
+        if os_type is not None:
+            client_key += tuple(version_ge(client_version, threshold) for threshold in _catalog['thresholds'].get(os_type, []))
+        if client_key not in _catalog['clients']:
+            _catalog['clients'][client_key] = _build_client_catalog(_catalog['offers'], os_type, client_version)
+        return _catalog['clients'][client_key]
+
+
+def render_offers(catalog, locked_offers_ids, user_balance):
+    """splice the user's offers list - a json array - from the catalog's fragments"""
+    available, unavailable = [], []
+    for offer in catalog.offers:
+        if offer.sold_out:
+            unavailable.append(offer.fragments[OFFER_STATE_SOLD_OUT])
+        elif offer.offer_id in locked_offers_ids:
+            unavailable.append(offer.fragments[OFFER_STATE_LOCKED])
+        elif user_balance < offer.kin_cost:
+            available.append(offer.fragments[OFFER_STATE_CANNOT_BUY])
+        else:
+            available.append(offer.fragments[OFFER_STATE_AVAILABLE])
+
+    if catalog.supports_unavailable:
+        available.extend(unavailable)
+    return b'[' + b','.join(available) + b']'
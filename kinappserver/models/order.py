@@ -3,11 +3,12 @@ import logging as log
 
 from kinappserver import db, config, stellar, utils
 from kinappserver.utils import InternalError, increment_metric, generate_memo
+from sqlalchemy import text
 from sqlalchemy_utils import UUIDType, ArrowType
 
-from .offer import get_cost_and_address
+from .offer import get_cost_and_address, get_locked_offers
 from .transaction import create_tx
-from .good import allocate_good, finalize_good
+from .good import allocate_good, finalize_good, adjust_inventory
 
 class Order(db.Model):
     """the Order class represent a single order.
@@ -20,7 +21,7 @@ class Order(db.Model):
     user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=False, nullable=False)
     kin_amount = db.Column(db.Integer(), nullable=False, primary_key=False)
     address = db.Column(db.String(80), nullable=False, primary_key=False)
-    created_at = db.Column(ArrowType)
+    created_at = db.Column(ArrowType, index=True)
 
     def __repr__(self):
         return '<order_id: %s, offer_id: %s, user_id: %s, kin_amount: %s, created_at: %s>' % (self.order_id, self.offer_id, self.user_id, self.kin_amount, self.created_at)
@@ -75,6 +76,87 @@ def create_order(user_id, offer_id):
         return str(order_id), None
 
 
+# the reasons book_offer may refuse a booking
+BOOKING_ERROR_OFFER_INACTIVE = 'offer_inactive'
+BOOKING_ERROR_NO_BALANCE = 'no_balance'
+BOOKING_ERROR_COOLDOWN = 'cooldown'
+BOOKING_ERROR_MAX_OFFERS = 'max_offers'
+BOOKING_ERROR_NOT_ENOUGH_KIN = 'not_enough_kin'
+BOOKING_ERROR_GOODS_UNAVAILABLE = 'goods_unavailable'
+BOOKING_ERROR_NO_GOODS = 'no_goods'
+
+# the first statement locks the user's balance row, so the bookings of a user run one at a time. the second one
+# takes a fresh snapshot once the lock is held - so it sees the orders of the user's previous bookings - and then
+# checks the booking, allocates a good and creates the order. both are sent to the db in one round trip.
+# the checks run in the order the booking api always reported them in. whether the user already bought the offer
+# comes from the user's locked offers set, which the offers list reads as well.
+BOOK_OFFER_STATEMENT = '''
+SELECT 1 FROM user_balance WHERE user_id = CAST(:user_id AS uuid) FOR UPDATE;
+WITH offer AS (
+    SELECT offer_id, kin_cost, address FROM offer WHERE offer_id = :offer_id AND is_active = true
+), balance AS (
+    SELECT earned - spent AS balance FROM user_balance WHERE user_id = CAST(:user_id AS uuid)
+), verdict AS (
+    SELECT CASE
+        WHEN NOT EXISTS (SELECT 1 FROM offer) THEN 'offer_inactive'
+        WHEN NOT EXISTS (SELECT 1 FROM balance) THEN 'no_balance'
+        WHEN NOT EXISTS (SELECT 1 FROM good WHERE offer_id = :offer_id AND order_id IS NULL) THEN 'goods_unavailable'
+        WHEN (SELECT balance FROM balance) < (SELECT kin_cost FROM offer) THEN 'not_enough_kin'
+        WHEN CAST(:locked AS boolean) THEN 'max_offers'
+        WHEN (SELECT count(*) FROM "order" WHERE user_id = CAST(:user_id AS uuid)
+              AND created_at > timezone('utc', now()) - CAST(:expiration_secs AS integer) * interval '1 second') >= :max_orders THEN 'cooldown'
+    END AS reason
+), allocated AS (
+    UPDATE good SET order_id = :order_id, updated_at = now()
+    WHERE sid = (SELECT sid FROM good WHERE offer_id = :offer_id AND order_id IS NULL AND (SELECT reason FROM verdict) IS NULL
+                 ORDER BY sid LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING sid
+), booked AS (
+    INSERT INTO "order" (order_id, offer_id, user_id, kin_amount, address, created_at)
+    SELECT :order_id, offer.offer_id, CAST(:user_id AS uuid), offer.kin_cost, offer.address, timezone('utc', now())
+    FROM offer, allocated
+    RETURNING order_id
+)
+SELECT coalesce((SELECT reason FROM verdict), CASE WHEN EXISTS (SELECT 1 FROM booked) THEN NULL ELSE 'no_goods' END) AS reason;
+'''
+
+
+def book_offer(user_id, offer_id):
+    """atomically check that the user may book the offer, allocate a good and create the order.
+
+    the user may book the offer if it is active and has goods left, the user has enough kin, didn't buy the offer
+    in the last OFFER_LIMIT_TIME_RANGE days and has less than MAX_SIMULTANEOUS_ORDERS_PER_USER active orders.
+    returns the order_id and None, or None and one of the BOOKING_ERROR_* reasons. BOOKING_ERROR_NO_GOODS means
+    the last goods were taken by concurrent bookings.
+
+    the good is allocated with SKIP LOCKED in both allocation modes. in the pool mode, its sid is left in the pool
+    and skipped as stale when it is popped.
+    """
+    order_id = utils.generate_memo()
+    locked = str(offer_id) in get_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE)
+    stmt = text(BOOK_OFFER_STATEMENT).execution_options(autocommit=True)
+    params = {'user_id': str(user_id), 'offer_id': str(offer_id), 'order_id': order_id,
+              'expiration_secs': int(config.ORDER_EXPIRATION_SECS), 'max_orders': int(config.MAX_SIMULTANEOUS_ORDERS_PER_USER),
+              'locked': locked}
+    try:
+        reason = db.engine.execute(stmt, **params).scalar()
+        if reason == BOOKING_ERROR_NO_BALANCE:
+            # the user has no balance ledger row yet: seed it, then try again
+            from .user import get_user_inapp_balance
+            get_user_inapp_balance(user_id)
+            reason = db.engine.execute(stmt, **params).scalar()
+    except Exception as e:
+        log.error('failed to book offer %s for user_id %s. e: %s' % (offer_id, user_id, e))
+        raise InternalError('failed to create a new order')
+
+    if reason is not None:
+        log.info('rejected booking of offer %s by user_id %s: %s' % (offer_id, user_id, reason))
+        return None, reason
+
+    adjust_inventory(offer_id, available_delta=-1)
+    return order_id, None
+
+
 def list_all_order_data():
     """returns a dict of all the orders"""
     response = {}
@@ -157,7 +239,7 @@ def process_order(user_id, tx_hash):
     create_tx(tx_hash, user_id, order.address, True, order.kin_amount, {'offer_id': str(order.offer_id), 'order_id': order.order_id})
 
     # get the allocated goods
-    res, good = finalize_good(order.order_id, tx_hash)
+    res, good = finalize_good(order.order_id, tx_hash, order.user_id)
     if res:
         goods.append(good)
     else:
@@ -169,7 +251,61 @@ def process_order(user_id, tx_hash):
     except Exception as e:
         log.error('failed to delete order %s' % order.order_id)
 
-    # update locked_offers
-    from kinappserver.models.offer import set_locked_offers
-    set_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE)
+    # lock the offer for this user
+    from kinappserver.models.offer import lock_offer
+    lock_offer(user_id, order.offer_id, config.OFFER_LIMIT_TIME_RANGE)
     return True, goods
+
+
+REDEEM_STATUS_REDIS_KEY = 'redeem-status:%s'
+REDEEM_STATUS_PENDING = 'pending'
+REDEEM_STATUS_OK = 'ok'
+REDEEM_STATUS_ERROR = 'error'
+
+
+def start_async_redeem(user_id, tx_hash):
+    """mark the tx_hash as pending redemption and process the order in the background.
+
+    returns False if this tx_hash was already submitted for redemption.
+    """
+    import json
+    from kinappserver import app
+    status = json.dumps({'user_id': str(user_id), 'status': REDEEM_STATUS_PENDING, 'goods': None})
+    if not app.redis.set(REDEEM_STATUS_REDIS_KEY % tx_hash, status, nx=True, ex=config.REDEEM_STATUS_TTL_SECS):
+        return False
+    app.rq_fast.enqueue_call(func=process_order_in_background, args=(user_id, tx_hash))
+    return True
+
+
+def process_order_in_background(user_id, tx_hash):
+    """process the order and store the result for the redeem-status endpoint"""
+    import redis_lock
+    from kinappserver import app
+    success, goods = False, None
+    lock = redis_lock.Lock(app.redis, 'redeem:%s' % tx_hash)
+    if lock.acquire(blocking=False):
+        try:
+            success, goods = process_order(user_id, tx_hash)
+        except Exception as e:
+            log.error('failed to process the order for tx_hash %s. e: %s' % (tx_hash, e))
+        finally:
+            lock.release()
+    else:
+        log.error('tx_hash %s is already being redeemed' % tx_hash)
+
+    if success:
+        increment_metric('offers_redeemed')
+        print('redeemed order by user_id: %s' % user_id)
+    status = {'user_id': str(user_id), 'status': REDEEM_STATUS_OK if success else REDEEM_STATUS_ERROR, 'goods': goods}
+    utils.write_json_to_cache(REDEEM_STATUS_REDIS_KEY % tx_hash, status, config.REDEEM_STATUS_TTL_SECS)
+
+
+def get_redeem_status(user_id, tx_hash):
+    """returns the redemption status (pending/ok/error) and the goods of the given tx_hash.
+
+    returns (None, None) if the tx_hash wasn't submitted for redemption by this user.
+    """
+    data = utils.read_json_from_cache(REDEEM_STATUS_REDIS_KEY % tx_hash)
+    if not data or data['user_id'] != str(user_id):
+        return None, None
+    return data['status'], data['goods']
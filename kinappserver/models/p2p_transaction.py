@@ -2,7 +2,7 @@
 
 import logging as log
 from sqlalchemy_utils import UUIDType
-from sqlalchemy import desc
+from sqlalchemy import desc, or_, text
 import arrow
 
 from kinappserver import db
@@ -20,6 +20,9 @@ class P2PTransaction(db.Model):
     sender_address = db.Column(db.String(60), db.ForeignKey("user.public_address"), nullable=False, unique=False)
     receiver_address = db.Column('receiver_address', db.String(60), nullable=False, unique=False)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+    # the tx history pages are read off these indexes (see list_user_history_page)
+    __table_args__ = (db.Index('ix_p2_p_transaction_sender_user_id_update_at', 'sender_user_id', 'update_at', 'tx_hash'),
+                      db.Index('ix_p2_p_transaction_receiver_user_id_update_at', 'receiver_user_id', 'update_at', 'tx_hash'))
 
     def __repr__(self):
         return '<p2ptx_hash: %s, sender_user_id: %s, receiver_user_id: %s, ' \
@@ -29,42 +32,54 @@ class P2PTransaction(db.Model):
 
 def list_p2p_transactions_for_user_id(user_id, max_txs=None):
     """returns all p2p txs by this user - or the last x tx if max_txs was passed"""
-    sender_txs = P2PTransaction.query.filter(P2PTransaction.sender_user_id == user_id).order_by(desc(P2PTransaction.update_at)).all()
-    receiver_txs = P2PTransaction.query.filter(P2PTransaction.receiver_user_id == user_id).order_by(desc(P2PTransaction.update_at)).all()
-    # join and trim the amount of txs
-    txs = receiver_txs + sender_txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
-    return txs
+    query = P2PTransaction.query.filter(or_(P2PTransaction.sender_user_id == user_id, P2PTransaction.receiver_user_id == user_id)).order_by(desc(P2PTransaction.update_at))
+    if max_txs:
+        query = query.limit(max_txs)
+    return query.all()
+
+
+# insert the tx and update the balances of its users in a single statement (see user_balance_ctes)
+CREATE_P2P_TX_STATEMENT = '''
+WITH new_tx AS (
+    INSERT INTO p2_p_transaction (tx_hash, sender_user_id, receiver_user_id, receiver_app_sid, amount, sender_address, receiver_address, update_at)
+    VALUES (:tx_hash, CAST(:sender_user_id AS uuid), CAST(:receiver_user_id AS uuid), :receiver_app_sid, :amount, :sender_address, :receiver_address, now())
+    RETURNING update_at
+), %s
+SELECT update_at FROM new_tx;
+'''
 
 
 def create_p2p_tx(tx_hash, sender_user_id, receiver_user_id, sender_address, receiver_address, amount, receiver_app_sid):
     """create a p2p transaction object and store in the db."""
     try:
-        tx = P2PTransaction()
-        tx.tx_hash = tx_hash
-        tx.sender_user_id = sender_user_id
-        tx.receiver_user_id = receiver_user_id
-        tx.receiver_app_sid = receiver_app_sid
-        tx.amount = int(amount)
-        tx.sender_address = sender_address
-        tx.receiver_address = receiver_address
-        db.session.add(tx)
-        db.session.commit()
+        from .user_balance import user_balance_ctes
+        amount = int(amount)
+        amounts = {str(sender_user_id): {'p2p_sent': amount}}
+        if receiver_user_id is not None:
+            amounts.setdefault(str(receiver_user_id), {})['p2p_received'] = amount
+        balance_ctes, params = user_balance_ctes(amounts)
+        stmt = text(CREATE_P2P_TX_STATEMENT % balance_ctes).execution_options(autocommit=True)
+        update_at = db.engine.execute(stmt, tx_hash=tx_hash, sender_user_id=str(sender_user_id),
+                                      receiver_user_id=str(receiver_user_id) if receiver_user_id is not None else None,
+                                      receiver_app_sid=receiver_app_sid, amount=amount, sender_address=sender_address,
+                                      receiver_address=receiver_address, **params).scalar()
     except Exception as e:
         log.error('cant add p2ptx to db with id %s. e:%s' % (tx_hash, e))
+    else:
+        from .tx_history import add_p2p_tx_to_history
+        add_p2p_tx_to_history(tx_hash, sender_user_id, receiver_user_id, amount, receiver_app_sid, update_at)
 
 
 def format_app2app_tx_dict(tx_hash, amount, destination_app_sid):
     """create a dict with the tx data as it would be sent/returned to the client"""
     
-    from kinappserver.models import AppDiscovery
-    apps = AppDiscovery.query.all()
-    d_app = list(filter(lambda item: item.sid == destination_app_sid, apps))
-    title = 'Sent Kin to %s' % d_app[0].name
+    from kinappserver.models import get_discovery_apps_by_sid
+    d_app = get_discovery_apps_by_sid()[destination_app_sid]
+    title = 'Sent Kin to %s' % d_app['name']
     
     tx_dict = {'title': title,
-                    'description': 'You sent %sKIN to %s' % (amount, d_app[0].name),
-                    'provider': {'image_url': d_app[0].meta_data['icon_url'], 'name': d_app[0].name},
+                    'description': 'You sent %sKIN to %s' % (amount, d_app['name']),
+                    'provider': {'image_url': d_app['meta_data']['icon_url'], 'name': d_app['name']},
                     'type': 'p2p',
                     'tx_hash': tx_hash,
                     'amount': amount,
@@ -0,0 +1,141 @@
+"""the payment outbox: a durable record of every task reward, written with the task results.
+
+a row is inserted in the same statement that stores the task results (see commit_task_results), so a reward
+can't be lost between storing the results and paying for them. a payment moves between these states:
+
+pending -> submitted -> confirmed
+                     -> pending (retry, on failure) -> ... -> failed (too many attempts)
+                     -> failed (by fail_stale_payments, if it was never confirmed)
+
+once a payment's tx was sent, its tx_hash is recorded on the row (see record_payment_tx), and the payment is
+never retried again: a payment that was sent but couldn't be confirmed stays submitted, until
+fail_stale_payments flags it for a manual review.
+
+the request handler claims the payment right away. rows that were never claimed, or that failed, are
+claimed in batches by the outbox worker (process_payment_outbox), with SKIP LOCKED - so any number of
+workers can run side by side.
+"""
+import logging as log
+
+from sqlalchemy import text
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db, config
+from kinappserver.utils import increment_metric, gauge_metric
+
+PAYMENT_STATE_PENDING = 'pending'
+PAYMENT_STATE_SUBMITTED = 'submitted'
+PAYMENT_STATE_CONFIRMED = 'confirmed'
+PAYMENT_STATE_FAILED = 'failed'
+PAYMENT_STATES = (PAYMENT_STATE_PENDING, PAYMENT_STATE_SUBMITTED, PAYMENT_STATE_CONFIRMED, PAYMENT_STATE_FAILED)
+
+
+class PaymentOutbox(db.Model):
+    """a single task reward. each task is paid at most once per user"""
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=True, nullable=False)
+    task_id = db.Column(db.String(40), nullable=False, primary_key=True)
+    memo = db.Column(db.String(100), nullable=False, unique=True)
+    address = db.Column(db.String(80), nullable=False)
+    amount = db.Column(db.Integer(), nullable=False)
+    send_push = db.Column(db.Boolean, nullable=False, default=True)
+    state = db.Column(db.String(20), nullable=False, default=PAYMENT_STATE_PENDING, index=True)
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    tx_hash = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<user_id: %s, task_id: %s, memo: %s, amount: %s, state: %s, attempts: %s, tx_hash: %s>' % (self.user_id, self.task_id, self.memo, self.amount, self.state, self.attempts, self.tx_hash)
+
+
+# used by commit_task_results: queue the payment in the same statement that stores the results
+INSERT_PAYMENT_CTE = '''
+    INSERT INTO payment_outbox (user_id, task_id, memo, address, amount, send_push, state, attempts, created_at, update_at)
+    SELECT previous.user_id, :task_id, previous.memo, :address, :amount, :send_push, 'pending', 0, now(), now()
+    FROM previous WHERE CAST(:address AS text) IS NOT NULL AND previous.memo IS NOT NULL
+    ON CONFLICT DO NOTHING
+    RETURNING memo
+'''
+
+CLAIM_PENDING_PAYMENTS_STATEMENT = '''
+UPDATE payment_outbox SET state = 'submitted', attempts = attempts + 1, update_at = now()
+WHERE (user_id, task_id) IN (
+    SELECT user_id, task_id FROM payment_outbox
+    WHERE state = 'pending' AND update_at < now() - CAST(:min_age_secs AS integer) * interval '1 second'
+    ORDER BY update_at
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED)
+RETURNING user_id, task_id, memo, address, amount, send_push;
+'''
+
+
+def _execute(stmt, **params):
+    return db.engine.execute(text(stmt).execution_options(autocommit=True), **params)
+
+
+def claim_payment(memo):
+    """mark the given pending payment as submitted. returns False if someone else already claimed it"""
+    res = _execute('''UPDATE payment_outbox SET state = 'submitted', attempts = attempts + 1, update_at = now() WHERE memo = :memo AND state = 'pending';''', memo=memo)
+    return res.rowcount == 1
+
+
+def claim_pending_payments(batch_size, min_age_secs):
+    """claim a batch of pending payments that weren't touched for min_age_secs.
+
+    concurrent workers skip each other's rows, so each payment is claimed by a single worker.
+    returns a list of dicts with the payment details.
+    """
+    rows = _execute(CLAIM_PENDING_PAYMENTS_STATEMENT, batch_size=batch_size, min_age_secs=min_age_secs).fetchall()
+    return [dict(row) for row in rows]
+
+
+def record_payment_tx(memo, tx_hash):
+    """the payment's tx was sent: from now on, the payment can't go back to pending"""
+    _execute('''UPDATE payment_outbox SET tx_hash = :tx_hash, update_at = now() WHERE memo = :memo;''', memo=memo, tx_hash=tx_hash)
+
+
+def confirm_payment(memo, tx_hash):
+    """the payment's tx is on the blockchain"""
+    _execute('''UPDATE payment_outbox SET state = 'confirmed', tx_hash = :tx_hash, update_at = now() WHERE memo = :memo;''', memo=memo, tx_hash=tx_hash)
+
+
+def fail_payment(memo):
+    """the payment failed: retry it later - or give up, after too many attempts.
+
+    a payment whose tx was already sent (it has a tx_hash) is left as it is: retrying it would pay the user twice.
+    """
+    res = _execute('''UPDATE payment_outbox SET state = (CASE WHEN attempts < :max_attempts THEN 'pending' ELSE 'failed' END), update_at = now()
+                      WHERE memo = :memo AND state != 'confirmed' AND tx_hash IS NULL RETURNING state;''', memo=memo, max_attempts=int(config.PAYMENT_OUTBOX_MAX_ATTEMPTS))
+    row = res.fetchone()
+    if row and row['state'] == PAYMENT_STATE_FAILED:
+        log.error('payment with memo %s failed too many times - giving up' % memo)
+        increment_metric('payment-outbox-failed')
+
+
+def fail_stale_payments(timeout_secs):
+    """payments that were submitted but never confirmed or failed (say, the process died mid-payment).
+
+    these may or may not be on the blockchain, so they are not retried automatically: they're marked as failed
+    for a manual review. returns the number of such payments.
+    """
+    res = _execute('''UPDATE payment_outbox SET state = 'failed', update_at = now()
+                      WHERE state = 'submitted' AND update_at < now() - CAST(:timeout_secs AS integer) * interval '1 second';''', timeout_secs=timeout_secs)
+    if res.rowcount:
+        log.error('marked %s stale payments as failed' % res.rowcount)
+        increment_metric('payment-outbox-stale', res.rowcount)
+    return res.rowcount
+
+
+def get_outbox_payment(memo):
+    """returns the payment with the given memo, or None"""
+    return PaymentOutbox.query.filter_by(memo=memo).first()
+
+
+def report_payment_outbox():
+    """post the number of payments in each state as gauges. returns a dict of state:count"""
+    counts = dict.fromkeys(PAYMENT_STATES, 0)
+    for state, count in db.session.query(PaymentOutbox.state, db.func.count(PaymentOutbox.state)).group_by(PaymentOutbox.state).all():
+        counts[state] = count
+    for state in (PAYMENT_STATE_PENDING, PAYMENT_STATE_SUBMITTED, PAYMENT_STATE_FAILED):
+        gauge_metric('payment-outbox-%s' % state, counts[state])
+    return counts
@@ -6,6 +6,8 @@ from kinappserver.utils import InternalError
 from sqlalchemy_utils import UUIDType, ArrowType
 import uuid
 
+from .user_context import get_user_context
+
 
 class PushAuthToken(db.Model):
     """the PushAuth class hold data related to the push-authentication mechanism.
@@ -25,6 +27,10 @@ class PushAuthToken(db.Model):
 
 def get_token_obj_by_user_id(user_id):
     """returns the token object for this user, and creates one if one doesn't exist"""
+    ctx = get_user_context(user_id)
+    if ctx is not None and ctx.push_auth_token is not None:
+        return ctx.push_auth_token
+
     push_auth_token = PushAuthToken.query.filter_by(user_id=user_id).first()
     if not push_auth_token:
         # create one on the fly. throws exception if the user doesn't exist
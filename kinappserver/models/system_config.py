@@ -1,7 +1,7 @@
 from kinappserver import db
 import logging as log
 from kinappserver.utils import InvalidUsage, OS_ANDROID, OS_IOS
-from distutils.version import LooseVersion
+from kinappserver.version_utils import version_lt
 
 
 class SystemConfig(db.Model):
@@ -49,17 +49,17 @@ def update_available_below_version(os_type):
 
 
 def should_force_update(os, app_ver):
-    if os == OS_ANDROID and LooseVersion(app_ver) < LooseVersion(get_block_clients_below_version(OS_ANDROID)):
+    if os == OS_ANDROID and version_lt(app_ver, get_block_clients_below_version(OS_ANDROID)):
             return True
-    elif os == OS_IOS and LooseVersion(app_ver) < LooseVersion(get_block_clients_below_version(OS_IOS)):
+    elif os == OS_IOS and version_lt(app_ver, get_block_clients_below_version(OS_IOS)):
             return True
     return False
 
 
 def is_update_available(os, app_ver):
-    if os == OS_ANDROID and LooseVersion(app_ver) < LooseVersion(update_available_below_version(OS_ANDROID)):
+    if os == OS_ANDROID and version_lt(app_ver, update_available_below_version(OS_ANDROID)):
             return True
-    elif os == OS_IOS and LooseVersion(app_ver) < LooseVersion(update_available_below_version(OS_IOS)):
+    elif os == OS_IOS and version_lt(app_ver, update_available_below_version(OS_IOS)):
             return True
     return False
 
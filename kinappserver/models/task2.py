@@ -3,16 +3,24 @@ from sqlalchemy_utils import UUIDType, ArrowType
 import arrow
 import logging as log
 import json
+import copy
+from uuid import uuid4
 from ast import literal_eval
 
 from kinappserver import db, config, app
 from kinappserver.models.task import Task
+from kinappserver.version_utils import version_ge, version_gt
 from kinappserver.push import send_please_upgrade_push
 from kinappserver.utils import InvalidUsage, InternalError, seconds_to_local_nth_midnight, OS_ANDROID, OS_IOS, DEFAULT_MIN_CLIENT_VERSION, test_image, test_url, get_country_code_by_ip, increment_metric, commit_json_changed_to_orm
-from kinappserver.models import store_next_task_results_ts, get_next_task_results_ts, get_user_os_type, get_user_app_data, get_unenc_phone_number_by_user_id
+from kinappserver.models import get_next_task_results_ts, get_user_os_type, get_user_app_data, get_unenc_phone_number_by_user_id
 from .truex_blacklisted_user import is_user_id_blacklisted_for_truex
+from .payment_outbox import INSERT_PAYMENT_CTE
 
 TASK_TYPE_TRUEX = 'truex'
+TASK_CATALOG_VERSION_REDIS_KEY = 'task-catalog-version'
+
+# the compiled task catalog of this worker. replaced as a whole - never modified in place.
+_task_catalog = None
 
 
 class UserTaskResults(db.Model):
@@ -55,86 +63,128 @@ def get_cat_id_for_task_id(task_id):
     return get_task_by_id(task_id)['cat_id']
 
 
-def store_task_results(user_id, task_id, results):
-    """store the results provided by the user"""
-    # reject hackers trying to send task results too soon
-
+# when a payment is requested, nothing is written unless the payment was queued: with no memo to pay with, or
+# with a payment already queued for this task (a concurrent duplicate submission), the results aren't stored,
+# the user isn't advanced and the memo isn't replaced.
+COMMIT_TASK_RESULTS_STATEMENT = '''
+WITH previous AS (
+    SELECT user_id, coalesce(completed_tasks_dict::jsonb, '{}'::jsonb) AS completed_tasks, next_task_memo_dict::jsonb ->> CAST(:cat_id AS text) AS memo
+    FROM user_app_data WHERE user_id = :user_id FOR UPDATE
+), payment AS (''' + INSERT_PAYMENT_CTE + '''
+), proceed AS (
+    SELECT user_id FROM previous WHERE CAST(:address AS text) IS NULL OR EXISTS (SELECT 1 FROM payment)
+), stored_results AS (
+    INSERT INTO user_task_results (user_id, task_id, results, update_at)
+    SELECT proceed.user_id, :task_id, CAST(:results AS json), now() FROM proceed
+    ON CONFLICT (user_id, task_id) DO UPDATE SET results = EXCLUDED.results, update_at = now()
+    RETURNING (xmax = 0) AS inserted
+), advanced AS (
+    UPDATE user_app_data SET
+        completed_tasks_dict = (CASE
+            WHEN coalesce(previous.completed_tasks -> CAST(:cat_id AS text), '[]'::jsonb) @> jsonb_build_array(CAST(:task_id AS text)) THEN previous.completed_tasks
+            ELSE jsonb_set(previous.completed_tasks, ARRAY[CAST(:cat_id AS text)], coalesce(previous.completed_tasks -> CAST(:cat_id AS text), '[]'::jsonb) || jsonb_build_array(CAST(:task_id AS text)))
+            END)::json,
+        next_task_ts_dict = jsonb_set(coalesce(user_app_data.next_task_ts_dict::jsonb, '{}'::jsonb), ARRAY[CAST(:cat_id AS text)], to_jsonb(CAST(:next_task_ts AS bigint)))::json,
+        next_task_memo_dict = (CASE
+            WHEN CAST(:new_memo AS text) IS NULL THEN user_app_data.next_task_memo_dict
+            ELSE jsonb_set(coalesce(user_app_data.next_task_memo_dict::jsonb, '{}'::jsonb), ARRAY[CAST(:cat_id AS text)], to_jsonb(CAST(:new_memo AS text)))::json
+            END)
+    FROM previous
+    WHERE user_app_data.user_id = previous.user_id AND EXISTS (SELECT 1 FROM proceed)
+    RETURNING user_app_data.user_id
+)
+SELECT previous.memo, (SELECT inserted FROM stored_results) AS inserted, (SELECT count(*) FROM payment) AS payment_queued,
+       (SELECT count(*) FROM advanced) AS advanced
+FROM previous;
+'''
+
+
+def calculate_next_task_ts(user_id, user_app_data, task_id, cat_id):
+    """calculate the next valid submission time for the given category, as if task_id was already completed.
+
+    this takes into account the delay_days field on the next task.
+    """
+    # note: even if we end up skipping the next task (for example, truex for iOS),
+    # we should still use the original delay days value (as done here).
+    delay_days = None
     try:
-        # store the results
-
-        try:
-            user_task_results = UserTaskResults()
-            user_task_results.user_id = user_id
-            user_task_results.task_id = task_id
-            user_task_results.results = results
-            db.session.add(user_task_results)
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            # this code handles the unlikely event that a user already had task results for this task, so rather
-            # than INSERT, we UPDATE.
-            log.info('store_task_results - failed to insert results. attempting to update instead. error:%s' % e)
-            previous_task_results = UserTaskResults.query.filter_by(user_id=user_id).filter_by(task_id=task_id).first()
-            previous_task_results.results = results
-            db.session.add(previous_task_results)
-            db.session.commit()
-            log.info('store_task_results: overwritten user_id %s task %s results' % (user_id, task_id))
-            increment_metric('overwrite-task-results')
-
-        # write down the completed task-id
-        from kinappserver.models import UserAppData
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
-        if user_app_data is None:
-            log.error('cant retrieve user app data for user:%s' % user_id)
-            raise InternalError('cant retrieve user app data for user:%s' % user_id)
+        completed_tasks = copy.deepcopy(user_app_data.completed_tasks_dict or {})
+        if task_id not in completed_tasks.get(cat_id, []):
+            completed_tasks.setdefault(cat_id, []).append(task_id)
+        next_task_ids = next_task_id_for_category(get_user_os_type(user_id), user_app_data.app_ver, completed_tasks, cat_id, user_id, None, send_push=False)
+        delay_days = get_task_delay(next_task_ids[0]) if next_task_ids else None
+        log.info('next task delay:%s (user_id: %s, current task: %s)' % (delay_days, user_id, task_id))
+    except Exception as e:
+        log.error('cant find task_delay for next task_id of %s' % task_id)
 
-        cat_id = get_cat_id_for_task_id(task_id)
-        if not cat_id:
-            log.error('cant find cat_id for task_id %s' % task_id)
-            raise InternalError('cant find cat_id for task_id %s' % task_id)
+    if delay_days is None or int(delay_days) == 0:
+        shifted_ts = arrow.utcnow().timestamp
+        log.info('setting next task time to now (delay_days is: %s)' % delay_days)
+    else:
+        shift_seconds = calculate_timeshift(user_id, delay_days)
+        shifted_ts = arrow.utcnow().shift(seconds=shift_seconds).timestamp
+        log.info('setting next task time to %s seconds in the future' % shift_seconds)
 
-        if cat_id in user_app_data.completed_tasks_dict:
-            if task_id not in user_app_data.completed_tasks_dict[cat_id]:
-                user_app_data.completed_tasks_dict[cat_id].append(task_id)
-        else:
-            user_app_data.completed_tasks_dict[cat_id] = [task_id]
+    log.info('next valid submission time for user %s, (previous task id %s) in shifted_ts: %s' % (user_id, task_id, shifted_ts))
+    return shifted_ts
 
-        commit_json_changed_to_orm(user_app_data, ['completed_tasks_dict'])
 
-        log.info('wrote user_app_data.completed_tasks for userid: %s' % user_id)
+def commit_task_results(user_id, task_id, results, replace_memo=True, address=None, amount=None, send_push=True):
+    """store the results provided by the user and advance the user to the next task, in a single statement.
 
-        # calculate the next valid submission time, and store it:
-        delay_days = None
-        # calculate the next task's valid submission time, and store it:
-        # this takes into account the delay_days field on the next task.
+    the results are upserted, the task_id is appended to the user's completed tasks, the next task's valid
+    submission time is set and (optionally) the category's memo is replaced by a new one - all in one
+    transaction, so concurrent submissions can't overwrite each other's changes.
 
-        # note: even if we end up skipping the next task (for example, truex for iOS),
-        # we should still use the original delay days value (as done here).
+    if an address is given, a payment of the given amount is queued in the payment outbox in the same transaction,
+    and nothing else is written unless it was: that is, if the category has no memo, or if this task was already
+    queued for payment for this user.
 
-        try:
-            delay_days = get_next_task_delay_days(user_id, task_id)  # throws exception if no such task exists
-            print('next task delay:%s (user_id: %s, current task: %s)' % (delay_days, user_id, task_id))
-        except Exception as e:
-            log.error('cant find task_delay for next task_id of %s' % task_id)
+    returns the category's memo prior to this call (that is, the memo to pay with) or None, and whether a
+    payment was queued.
+    """
+    from sqlalchemy import text
+    from kinappserver.utils import generate_memo
+    from .user_context import expire_user_context, write_back_user_context
+    try:
+        cat_id = get_cat_id_for_task_id(task_id)
+        if not cat_id:
+            log.error('cant find cat_id for task_id %s' % task_id)
+            raise InternalError('cant find cat_id for task_id %s' % task_id)
 
-        if delay_days is None or int(delay_days) == 0:
-            shifted_ts = arrow.utcnow().timestamp
-            log.info('setting next task time to now (delay_days is: %s)' % delay_days)
-        else:
-            shift_seconds = calculate_timeshift(user_id, delay_days)
-            shifted_ts = arrow.utcnow().shift(seconds=shift_seconds).timestamp
-            log.info('setting next task time to %s seconds in the future' % shift_seconds)
+        user_app_data = get_user_app_data(user_id)  # raises if there's no such user
+        next_task_ts = calculate_next_task_ts(user_id, user_app_data, task_id, cat_id)
 
-        log.info('next valid submission time for user %s, (previous task id %s) in shifted_ts: %s' % (user_id, task_id, shifted_ts))
+        write_back_user_context(user_id)
+        stmt = text(COMMIT_TASK_RESULTS_STATEMENT).execution_options(autocommit=True)
+        res = db.engine.execute(stmt, user_id=str(user_id), task_id=task_id, cat_id=cat_id, results=json.dumps(results),
+                                next_task_ts=next_task_ts, new_memo=generate_memo() if replace_memo else None,
+                                address=address, amount=amount, send_push=bool(send_push)).fetchone()
+        expire_user_context(user_id)
+        if res is None:
+            log.error('cant retrieve user app data for user:%s' % user_id)
+            raise InternalError('cant retrieve user app data for user:%s' % user_id)
 
-        store_next_task_results_ts(user_id, task_id, shifted_ts)
+        if not res['advanced']:
+            log.info('store_task_results: nothing written for user_id %s task %s (memo: %s)' % (user_id, task_id, res['memo']))
+            return res['memo'], False
 
-        return True
+        if not res['inserted']:
+            log.info('store_task_results: overwritten user_id %s task %s results' % (user_id, task_id))
+            increment_metric('overwrite-task-results')
+        log.info('wrote user_app_data.completed_tasks for userid: %s' % user_id)
+        return res['memo'], res['payment_queued'] > 0
     except Exception as e:
         log.error('exception in store_task_results: %s', e)
         raise InvalidUsage('cant store_task_results')
 
 
+def store_task_results(user_id, task_id, results):
+    """store the results provided by the user"""
+    commit_task_results(user_id, task_id, results, replace_memo=False)
+    return True
+
+
 def get_user_task_results(user_id):
     """get the user's task results, ordered by update_at"""
     return UserTaskResults.query.filter_by(user_id=user_id).order_by(UserTaskResults.update_at).all()
@@ -204,28 +254,19 @@ def next_task_id_for_category(os_type, app_ver, completed_tasks, cat_id, user_id
      if the next task_id requires an upgrade, send push and return an empty set
      if no task can be matched return an empty set
      """
-    if not completed_tasks:
-        remove_previous_tasks_clause = ''
-    else:
-        completed_tasks_for_cat_id = completed_tasks.get(cat_id, None)
-        if not completed_tasks_for_cat_id:
-            remove_previous_tasks_clause = ''
-        else:
-            # oh man, this is ugly: convert ['0','1'] to ["\'0\'", ...] and then to "\'0\',\'1\',\'2\'"
-            completed_tasks_for_cat_id = ["\'%s\'" % id for id in completed_tasks_for_cat_id]
-            remove_previous_tasks_clause = '''and task2.task_id not in (%s)''' % (",".join(completed_tasks_for_cat_id))
-    # get ALL the unsolved task_ids for the category
-    stmt = '''SELECT task2.task_id FROM task2 WHERE task2.category_id='%s' %s order by task2.position, task2.task_start_date;''' % (cat_id, remove_previous_tasks_clause)
-    res = db.engine.execute(stmt)
-    unsolved_task_ids = [item[0] for item in res.fetchall()]
+    completed_tasks_for_cat_id = set((completed_tasks or {}).get(cat_id) or [])
+
+    # get ALL the unsolved task_ids for the category, already ordered by position, task_start_date
+    catalog = get_task_catalog()
+    unsolved_task_ids = [task_id for task_id in catalog['categories'].get(cat_id, ()) if task_id not in completed_tasks_for_cat_id]
     log.info('unsolved tasks for cat_id %s: %s' % (cat_id, unsolved_task_ids))
 
     # go over all the yet-unsolved tasks and get the first valid one
     for task_id in unsolved_task_ids:
-        task = get_task_by_id(task_id)
+        task = catalog['tasks'][task_id]
 
         # skip inactive ad-hoc tasks
-        if not is_task_active(task_id):
+        if not is_task_json_active(task):
             log.info('skipping task_id %s - inactive ad-hoc task' % task_id)
             continue
 
@@ -236,7 +277,7 @@ def next_task_id_for_category(os_type, app_ver, completed_tasks, cat_id, user_id
             continue
 
         # skip country-blocked tasks
-        if user_country_code in task['excluded_country_codes']:
+        if task['excluded_country_codes'] and user_country_code in task['excluded_country_codes']:
             # we're skipping this task
             log.info('skipping task_id %s for user %s with country-code %s' % (task_id, user_id, user_country_code))
             continue
@@ -278,20 +319,10 @@ def get_next_tasks_for_user(user_id, source_ip=None, cat_ids=[], send_push=True,
         log.info("user_id: %s - get_next_tasks_for_user - cache found!" % user_id)
         return cached_results
     else:
-        tasks_per_category = {}
         user_app_data = get_user_app_data(user_id)
         os_type = get_user_os_type(user_id)
-        app_ver = user_app_data.app_ver
         from .category import get_all_cat_ids
-        for cat_id in cat_ids or get_all_cat_ids():
-            task_ids = next_task_id_for_category(os_type, app_ver, user_app_data.completed_tasks_dict, cat_id, user_id, get_country_code_by_ip(source_ip), send_push)  # returns just one task in a list or empty list
-            tasks_per_category[cat_id] = [get_task_by_id(task_id) for task_id in task_ids]
-            # plant the memo and start date in the first task of the category:
-            from .user import get_next_task_memo
-            from .user import get_next_task_results_ts
-            if len(tasks_per_category[cat_id]) > 0:
-                tasks_per_category[cat_id][0]['memo'] = get_next_task_memo(user_id, cat_id)
-                tasks_per_category[cat_id][0]['start_date'] = get_next_task_results_ts(user_id, cat_id)
+        tasks_per_category = resolve_next_tasks(user_id, user_app_data, os_type, cat_ids or get_all_cat_ids(), get_country_code_by_ip(source_ip), send_push)
 
         # store result in cache
         if use_cache:
@@ -301,6 +332,36 @@ def get_next_tasks_for_user(user_id, source_ip=None, cat_ids=[], send_push=True,
         return tasks_per_category
 
 
+def resolve_next_tasks(user_id, user_app_data, os_type, cat_ids, user_country_code, send_push=True):
+    """returns the next task for the given user in each of the given categories, in a single pass.
+
+    the user's already-loaded app data is used for the completed tasks, the memos and the start dates,
+    so no additional queries are made per category. missing memos are generated and saved in one commit.
+    """
+    from kinappserver.utils import generate_memo
+    tasks_per_category = {}
+    generated_memos = False
+    for cat_id in cat_ids:
+        task_ids = next_task_id_for_category(os_type, user_app_data.app_ver, user_app_data.completed_tasks_dict, cat_id, user_id, user_country_code, send_push)  # returns just one task in a list or empty list
+        tasks_per_category[cat_id] = [get_task_by_id(task_id) for task_id in task_ids]
+        if len(tasks_per_category[cat_id]) == 0:
+            continue
+
+        # plant the memo and start date in the first task of the category:
+        memo = user_app_data.next_task_memo_dict.get(cat_id, None)
+        if memo is None:
+            memo = generate_memo()
+            user_app_data.next_task_memo_dict[cat_id] = memo
+            generated_memos = True
+        tasks_per_category[cat_id][0]['memo'] = memo
+        tasks_per_category[cat_id][0]['start_date'] = user_app_data.next_task_ts_dict.get(cat_id, 0)  # can be None
+
+    if generated_memos:
+        commit_json_changed_to_orm(user_app_data, ['next_task_memo_dict'])
+
+    return tasks_per_category
+
+
 def should_skip_truex_task(user_id, task_id, source_ip=None, country_code=None):
 
     if config.DEBUG:
@@ -357,11 +418,10 @@ def should_skip_task(user_id, task_id, source_ip, country_code=None):
 
 def can_client_support_task(os_type, app_ver, task):
     """ returns true if the client with the given os_type and app_ver can correctly handle the given task"""
-    from distutils.version import LooseVersion
     if os_type == OS_ANDROID:
-        if LooseVersion(app_ver) >= LooseVersion(task.get('min_client_version_android')):
+        if version_ge(app_ver, task.get('min_client_version_android')):
             return True
-    elif LooseVersion(app_ver) >= LooseVersion(task.get('min_client_version_ios')):
+    elif version_ge(app_ver, task.get('min_client_version_ios')):
             return True
     if os_type == OS_ANDROID:
         log.info('TASK NOT SUPPORTED android min version: %s, and the client app version: %s' % (task.get('min_client_version_android'), app_ver))
@@ -370,37 +430,105 @@ def can_client_support_task(os_type, app_ver, task):
     return False
 
 
-def get_task_by_id(task_id, shifted_ts=None):
-    """return the json representation of the task or None if no such task exists"""
-
-    task = Task2.query.filter_by(task_id=task_id).first()
-    if task is None:
-        return None
-
-    # build the json object:
+def task_to_json(task):
+    """return the json representation of the given Task2 row, without the user-specific start_date"""
     task_json = {}
-    task_json['id'] = task_id
+    task_json['id'] = task.task_id
     task_json['cat_id'] = task.category_id
     task_json['position'] = task.position
     task_json['title'] = task.title
     task_json['type'] = task.task_type
     task_json['desc'] = task.description
     task_json['price'] = task.price
-    task_json['excluded_country_codes'] = task.excluded_country_codes
+    task_json['excluded_country_codes'] = copy.deepcopy(task.excluded_country_codes)
     if task.video_url is not None:
         task_json['video_url'] = task.video_url
     task_json['min_to_complete'] = task.min_to_complete
-    task_json['provider'] = task.provider_data
-    task_json['tags'] = task.tags
-    task_json['items'] = task.items
+    task_json['provider'] = copy.deepcopy(task.provider_data)
+    task_json['tags'] = copy.deepcopy(task.tags)
+    task_json['items'] = copy.deepcopy(task.items)
     task_json['updated_at'] = arrow.get(task.update_at).timestamp
-    task_json['start_date'] = int(shifted_ts if shifted_ts is not None else arrow.get(0).timestamp)  # return 0 if no shift was requested
     task_json['task_start_date'] = str(task.task_start_date) if task.task_start_date else None
     task_json['task_expiration_date'] = str(task.task_expiration_date) if task.task_expiration_date else None
     task_json['min_client_version_android'] = task.min_client_version_android or DEFAULT_MIN_CLIENT_VERSION
     task_json['min_client_version_ios'] = task.min_client_version_ios or DEFAULT_MIN_CLIENT_VERSION
-    task_json['post_task_actions'] = [] if not task.post_task_actions else task.post_task_actions
+    task_json['post_task_actions'] = [] if not task.post_task_actions else copy.deepcopy(task.post_task_actions)
+    return task_json
+
+
+def compile_task_catalog(version):
+    """build an immutable snapshot of all the tasks in the db.
+
+    the snapshot holds the prebuilt json of every task, the delay_days of every task
+    and the task_ids of every category, ordered by (position, task_start_date).
+    """
+    tasks = {}
+    delay_days = {}
+    tasks_per_category = {}
+    for task in Task2.query.all():
+        tasks[task.task_id] = task_to_json(task)
+        delay_days[task.task_id] = task.delay_days
+        tasks_per_category.setdefault(task.category_id, []).append(task)
+
+    categories = {}
+    for cat_id, cat_tasks in tasks_per_category.items():
+        # same order as 'order by position, task_start_date' - null start dates go last
+        cat_tasks.sort(key=lambda t: (t.position, t.task_start_date is None, t.task_start_date.timestamp if t.task_start_date else 0, t.task_id))
+        categories[cat_id] = tuple([t.task_id for t in cat_tasks])
 
+    log.info('compiled task catalog version %s: %s tasks in %s categories' % (version, len(tasks), len(categories)))
+    return {'version': version, 'tasks': tasks, 'delay_days': delay_days, 'categories': categories}
+
+
+def get_task_catalog_version():
+    """returns the current version of the task catalog: a random token, replaced on every change to the tasks.
+
+    a counter could restart (e.g. after redis is flushed) and match the version of a stale catalog. a lost token
+    is replaced by a new one instead, so all the workers re-compile their catalogs.
+    """
+    version = app.redis.get(TASK_CATALOG_VERSION_REDIS_KEY)
+    if version is None:
+        app.redis.set(TASK_CATALOG_VERSION_REDIS_KEY, uuid4().hex, nx=True)
+        version = app.redis.get(TASK_CATALOG_VERSION_REDIS_KEY) or b''
+    return version.decode('utf-8')
+
+
+def get_task_catalog():
+    """return the compiled task catalog, re-compiling it if the tasks were changed since it was compiled"""
+    global _task_catalog
+    version = get_task_catalog_version()
+
+    catalog = _task_catalog
+    if catalog is None or catalog['version'] != version:
+        catalog = compile_task_catalog(version)
+        _task_catalog = catalog
+    return catalog
+
+
+def bump_task_catalog_version():
+    """signal all the workers to re-compile their task catalog. call this after every change to the task2 table.
+
+    raises InternalError if the version can't be replaced, as the workers would keep serving the old tasks.
+    """
+    try:
+        app.redis.set(TASK_CATALOG_VERSION_REDIS_KEY, uuid4().hex)
+    except Exception as e:
+        log.error('failed to bump the task catalog version. e: %s' % e)
+        raise InternalError('failed to bump the task catalog version')
+
+
+def get_task_by_id(task_id, shifted_ts=None):
+    """return the json representation of the task or None if no such task exists"""
+    if task_id is None:
+        return None
+
+    task_json = get_task_catalog()['tasks'].get(str(task_id))
+    if task_json is None:
+        return None
+
+    # the catalog is shared - callers get their own (shallow) copy
+    task_json = dict(task_json)
+    task_json['start_date'] = int(shifted_ts if shifted_ts is not None else arrow.get(0).timestamp)  # return 0 if no shift was requested
     return task_json
 
 
@@ -441,7 +569,7 @@ def add_task(task_json):
     skip_image_test = task_json.get('skip_image_test', False)
 
     # does the task_id already exist?
-    if get_task_by_id(task_id):
+    if Task2.query.filter_by(task_id=task_id).first():
         if not overwrite_task:
             log.error('cant add task with id %s - already exists. provide the overwrite flag to overwrite the task' % task_id)
             raise InvalidUsage('task_id %s already exists' % task_id)
@@ -563,22 +691,25 @@ def add_task(task_json):
 
         db.session.add(task)
         db.session.commit()
-        log.info('success: added task with id %s, cat_id %s and position %s' % (task_id, category_id, position))
-        return True
     except Exception as e:
         log.error('cant add task to db with id %s. exception: %s' % (task_id, e))
         db.session.rollback()
         return False
 
+    bump_task_catalog_version()
+    log.info('success: added task with id %s, cat_id %s and position %s' % (task_id, category_id, position))
+    return True
+
 
 def delete_task(task_id):
-    if not get_task_by_id(task_id):
+    task_to_delete = Task2.query.filter_by(task_id=task_id).first()
+    if not task_to_delete:
         log.error('no task with id %s in the db' % task_id)
         raise InvalidUsage('task_id %s doesnt exist - cant delete' % task_id)
 
-    task_to_delete = Task2.query.filter_by(task_id=task_id).first()
     db.session.delete(task_to_delete)
     db.session.commit()
+    bump_task_catalog_version()
 
 
 def set_delay_days(delay_days, task_id=None):
@@ -588,46 +719,60 @@ def set_delay_days(delay_days, task_id=None):
 
     where_clause = '' if not task_id else 'where task_id=\'%s\'' % task_id
     db.engine.execute("update task2 set delay_days=%d %s" % (int(delay_days), where_clause))  # safe
+    bump_task_catalog_version()
     return True
 
 
 def get_reward_for_task(task_id):
     """return the amount of kin reward associated with this task"""
-    task = Task2.query.filter_by(task_id=task_id).first()
+    task = get_task_by_id(task_id)
     if not task:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.price
+    return task['price']
 
 
 def get_task_delay(task_id):
     """return the amount of delay associated with this task"""
-    task = Task2.query.filter_by(task_id=task_id).first()
-    if not task:
+    delay_days = get_task_catalog()['delay_days'].get(str(task_id))
+    if delay_days is None:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.delay_days
+    return delay_days
 
 
 def get_task_type(task_id):
     """get the tasks type"""
-    task = Task2.query.filter_by(task_id=task_id).first()
+    task = get_task_catalog()['tasks'].get(str(task_id))
     if not task:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.task_type
+    return task['type']
 
 
 def get_task_details(task_id):
     """return a dict with some of the given task id's metadata"""
-    task = Task2.query.filter_by(task_id=task_id).first()
-    if task:
-        return {'title': task.title, 'desc': task.description, 'provider': task.provider_data}
+    return get_tasks_details([task_id])[str(task_id)]
+
+
+def get_tasks_details(task_ids):
+    """return a dict of task_id -> a dict with some of the task's metadata, for all the given task ids"""
+    catalog_tasks = get_task_catalog()['tasks']
+    details = {}
+    missing_task_ids = set()
+    for task_id in set(str(task_id) for task_id in task_ids):
+        task = catalog_tasks.get(task_id)
+        if task:
+            details[task_id] = {'title': task['title'], 'desc': task['desc'], 'provider': task['provider']}
+        else:
+            missing_task_ids.add(task_id)
 
-    # task wasn't found. Let's try the original task table that has not been migrated
-    task = Task.query.filter_by(task_id=task_id).first()
-    if not task:
-        log.error('cant find task with task_id %s. using default text' % task_id)
-        return {'title': 'Delayed Kin', 'desc': '', 'provider': {"image_url": "https://cdn.kinitapp.com/brand_img/poll_logo_kin.png", "name": "Kinit Team"}}
+    if missing_task_ids:
+        # tasks that weren't found. Let's try the original task table that has not been migrated - in one query
+        for task in Task.query.filter(Task.task_id.in_(missing_task_ids)).all():
+            details[task.task_id] = {'title': task.title, 'desc': task.desc, 'provider': task.provider_data}
 
-    return {'title': task.title, 'desc': task.desc, 'provider': task.provider_data}
+    for task_id in missing_task_ids - set(details):
+        log.error('cant find task with task_id %s. using default text' % task_id)
+        details[task_id] = {'title': 'Delayed Kin', 'desc': '', 'provider': {"image_url": "https://cdn.kinitapp.com/brand_img/poll_logo_kin.png", "name": "Kinit Team"}}
+    return details
 
 
 def handle_task_results_resubmission(user_id, task_id):
@@ -689,8 +834,8 @@ def get_truex_activity(user_id, cat_id, remote_ip, user_agent=None):
 
 def switch_task_ids(task_id1, task_id2):
     """replaces two task ids in the db"""
-    task1 = get_task_by_id(task_id1)
-    task2 = get_task_by_id(task_id2)
+    task1 = Task2.query.filter_by(task_id=task_id1).first()
+    task2 = Task2.query.filter_by(task_id=task_id2).first()
 
     if None in (task1, task2):
         log.error('cant find task_id(s) (%s,%s)' % (task_id1, task_id2))
@@ -700,11 +845,12 @@ def switch_task_ids(task_id1, task_id2):
     import random
     while True:
         temp_task_id = str(random.randint(900000, 999999))
-        if not get_task_by_id(temp_task_id):
+        if not Task2.query.filter_by(task_id=temp_task_id).first():
             break
 
     stmt = '''update task set task_id='%s' where task_id='%s';'''
     db.engine.execute('BEGIN;' + stmt % (temp_task_id, task_id1) + stmt % (task_id1, task_id2) + stmt % (task_id2, temp_task_id) + 'COMMIT;')
+    bump_task_catalog_version()
 
 
 def add_task_to_completed_tasks(user_id, task_id):
@@ -802,7 +948,6 @@ def count_immediate_tasks(user_id, only_cat_id=None, send_push=True):
 
 def get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_task_ids_for_category, os_type, client_version, user_country_code, user_id):
     """for the given category_id returns list of tasks, in order, with their delay days excluding previously completed tasks"""
-    from distutils.version import LooseVersion
 
     # calculate a sql clause to remove previously submitted tasks, if such exist
     remove_previous_tasks_clause = ''
@@ -836,7 +981,7 @@ def get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_task_ids_fo
             skip_task = True
 
         # filter out tasks that dont match the client's version
-        if LooseVersion(task[client_version_index]) > LooseVersion(client_version):
+        if version_gt(task[client_version_index], client_version):
             log.info('detected a task (%s) that doesnt match the users os_type and app_ver. user_id %s' % (task_id, user_id))
             skip_task = True
 
@@ -873,13 +1018,17 @@ def calculate_immediate_tasks(filtered_unsolved_tasks_for_user):
 
 
 def is_task_active(task_id):
-    """"determines whether the task with the given id is active.
+    """"determines whether the task with the given id is active."""
+    return is_task_json_active(get_task_catalog()['tasks'][str(task_id)])
+
+
+def is_task_json_active(task_json):
+    """"determines whether the given task is active.
 
     Static tasks are always active.
     Ad-hoc tasks are active only if their task__start_date has passed
     and theor task_expiration_date has yet to pass
     """
-    task_json = get_task_by_id(task_id)
     if task_json['position'] != -1:
         return True
 
@@ -898,15 +1047,6 @@ def should_reject_out_of_order_tasks(user_id, task_id, request_source_ip):
     return False
 
 
-def get_next_task_delay_days(user_id, task_id):
-    """returns the delay-days property of the task after the given task_id for the given user_id, if one exists"""
-    cat_id = get_cat_id_for_task_id(task_id)
-    next_tasks = get_next_tasks_for_user(user_id, None, [cat_id], False, False)
-    # now that we have the task_id, go back to the original task definition and get the delay days
-    next_task_id = next_tasks[cat_id][0]['id'] if len(next_tasks[cat_id]) > 0 else None
-    return get_task_delay(next_task_id) if next_task_id else None
-
-
 def task20_migrate_tasks():
     """migrate all the tasks from Sarit's list into task2 table"""
     from .user import tasks20_get_tasks_dict, tasks20_get_tasks_dict_stage
@@ -923,7 +1063,7 @@ def task20_migrate_task(task_id, cat_id, position, delay_days):
     """given a task_id, migrate it from the old Task table to the new Task2 table"""
     # no adhoc tasks allowed - we have none atm in prod.
 
-    if get_task_by_id(task_id) is not None:
+    if Task2.query.filter_by(task_id=task_id).first() is not None:
         log.info('refusing to migrate task_id %s - already migrated' % task_id)
         return False
 
@@ -959,4 +1099,5 @@ def task20_migrate_task(task_id, cat_id, position, delay_days):
 
     db.session.add(task)
     db.session.commit()
+    bump_task_catalog_version()
     return True
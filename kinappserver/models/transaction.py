@@ -1,11 +1,14 @@
 """The model for the Kin App Server."""
+import base64
 import datetime
+import json
 import logging as log
 
 from sqlalchemy_utils import UUIDType
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 
 from kinappserver import db, stellar
+from kinappserver.utils import InvalidUsage
 
 
 class Transaction(db.Model):
@@ -19,6 +22,10 @@ class Transaction(db.Model):
     remote_address = db.Column(db.String(100), nullable=False, primary_key=False)
     tx_info = db.Column(db.JSON)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+    # the tx history pages are read off the first index (see list_user_history_page). the second one covers
+    # the user's redeeming txs, which are joined with their goods (see get_redeemed_goods_page)
+    __table_args__ = (db.Index('ix_transaction_user_id_update_at', 'user_id', 'update_at', 'tx_hash'),
+                      db.Index('ix_transaction_user_id_incoming', 'user_id', 'tx_hash', postgresql_where=text('incoming_tx = true')))
 
     def __repr__(self):
         return '<tx_hash: %s, user_id: %s, amount: %s, remote_address: %s, incoming_tx: %s, tx_info: %s,  update_at: %s>' % (self.tx_hash, self.user_id, self.amount, self.remote_address, self.incoming_tx, self.tx_info, self.update_at)
@@ -26,27 +33,104 @@ class Transaction(db.Model):
 
 def list_user_transactions(user_id, max_txs=None):
     """returns all txs by this user - or the last x tx if max_txs was passed"""
-    txs = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at)).all()
-    # trim the amount of txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
-    return txs
+    query = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at))
+    if max_txs:
+        query = query.limit(max_txs)
+    return query.all()
+
+
+# a page of the user's history, newest first: the server txs (with the details of the offers the user paid for)
+# and the p2p txs the user sent and received. each branch reads at most a page off its own index, and the
+# merge, sort and limit all happen in the db. the keyset conditions (if any) are added by list_user_history_page
+USER_HISTORY_PAGE_QUERY = '''
+(SELECT 'server' AS type, t.tx_hash, t.amount, t.incoming_tx, t.tx_info, t.update_at,
+     o.offer_id, o.title AS offer_title, o."desc" AS offer_desc, o.provider_data AS offer_provider,
+     CAST(NULL AS uuid) AS sender_user_id, CAST(NULL AS uuid) AS receiver_user_id, CAST(NULL AS integer) AS receiver_app_sid
+ FROM transaction t
+ LEFT JOIN offer o ON t.incoming_tx = true AND o.offer_id = t.tx_info->>'offer_id'
+ WHERE t.user_id = CAST(:user_id AS uuid) %(transaction_keyset)s
+ ORDER BY t.update_at DESC, t.tx_hash DESC LIMIT :limit)
+UNION ALL
+(SELECT 'p2p', p.tx_hash, p.amount, NULL, NULL, p.update_at, NULL, NULL, NULL, NULL, p.sender_user_id, p.receiver_user_id, p.receiver_app_sid
+ FROM p2_p_transaction p
+ WHERE p.sender_user_id = CAST(:user_id AS uuid) %(p2p_keyset)s
+ ORDER BY p.update_at DESC, p.tx_hash DESC LIMIT :limit)
+UNION ALL
+(SELECT 'p2p', p.tx_hash, p.amount, NULL, NULL, p.update_at, NULL, NULL, NULL, NULL, p.sender_user_id, p.receiver_user_id, p.receiver_app_sid
+ FROM p2_p_transaction p
+ WHERE p.receiver_user_id = CAST(:user_id AS uuid) AND p.sender_user_id <> CAST(:user_id AS uuid) %(p2p_keyset)s
+ ORDER BY p.update_at DESC, p.tx_hash DESC LIMIT :limit)
+ORDER BY update_at DESC, tx_hash DESC
+LIMIT :limit;
+'''
+
+
+def get_history_key(update_at, tx_hash):
+    """returns the position of the given tx in the history: a string that sorts like (update_at, tx_hash)"""
+    return '%s %s' % (update_at.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00'), tx_hash)
+
+
+def encode_tx_cursor(update_at, tx_hash):
+    """returns an opaque cursor that points right after the given tx in the history"""
+    return encode_history_key(get_history_key(update_at, tx_hash))
+
+
+def encode_history_key(history_key):
+    return base64.urlsafe_b64encode(history_key.encode('utf-8')).decode('utf-8')
+
+
+def decode_tx_cursor(cursor):
+    """returns the (update_at, tx_hash) of the given cursor. update_at is an iso-formatted string"""
+    try:
+        update_at, tx_hash = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split(' ', 1)
+        datetime.datetime.strptime(update_at[:19], '%Y-%m-%dT%H:%M:%S')
+    except Exception:
+        raise InvalidUsage('bad cursor: %s' % cursor)
+    return update_at, tx_hash
+
+
+def list_user_history_page(user_id, limit, cursor=None):
+    """returns the user's server and p2p txs that come after the cursor in the history, newest first, and at most limit of them.
+
+    each branch of the query is an index range scan - on transaction (user_id, update_at, tx_hash) and on
+    p2_p_transaction (sender_user_id, ...) and (receiver_user_id, ...) - so a page costs the same no matter how
+    deep into the history it is or how many txs the user has.
+    """
+    params = {'user_id': str(user_id), 'limit': int(limit)}
+    keysets = {'transaction_keyset': '', 'p2p_keyset': ''}
+    if cursor:
+        params['before_update_at'], params['before_tx_hash'] = decode_tx_cursor(cursor)
+        for key, alias in (('transaction_keyset', 't'), ('p2p_keyset', 'p')):
+            keysets[key] = 'AND (%s.update_at, %s.tx_hash) < (CAST(:before_update_at AS timestamptz), :before_tx_hash)' % (alias, alias)
+    return db.engine.execute(text(USER_HISTORY_PAGE_QUERY % keysets), **params).fetchall()
+
+
+# insert the tx and update the user's balance in a single statement (see user_balance_ctes)
+CREATE_TX_STATEMENT = '''
+WITH new_tx AS (
+    INSERT INTO transaction (tx_hash, user_id, amount, incoming_tx, remote_address, tx_info, update_at)
+    VALUES (:tx_hash, CAST(:user_id AS uuid), :amount, :incoming_tx, :remote_address, CAST(:tx_info AS json), now())
+    RETURNING update_at
+), %s
+SELECT update_at FROM new_tx;
+'''
 
 
 def create_tx(tx_hash, user_id, remote_address, incoming_tx, amount, tx_info):
     try:
-        tx = Transaction()
-        tx.tx_hash = tx_hash
-        tx.user_id = user_id
-        tx.amount = int(amount)
-        tx.incoming_tx = bool(incoming_tx)
-        tx.remote_address = remote_address
-        tx.tx_info = tx_info
-        db.session.add(tx)
-        db.session.commit()
+        from .user_balance import user_balance_ctes
+        amount = int(amount)
+        incoming_tx = bool(incoming_tx)
+        balance_ctes, params = user_balance_ctes({str(user_id): {'spent': amount} if incoming_tx else {'earned': amount}})
+        stmt = text(CREATE_TX_STATEMENT % balance_ctes).execution_options(autocommit=True)
+        update_at = db.engine.execute(stmt, tx_hash=tx_hash, user_id=str(user_id), amount=amount, incoming_tx=incoming_tx,
+                                      remote_address=remote_address, tx_info=json.dumps(tx_info), **params).scalar()
     except Exception as e:
-        log.error('cant add tx to db with id %s' % tx_hash)
+        log.error('cant add tx to db with id %s. e: %s' % (tx_hash, e))
     else:
-        log.info('created tx with txinfo: %s' % tx.tx_info)
+        log.info('created tx with txinfo: %s' % tx_info)
+        from .tx_history import add_server_tx_to_history
+        add_server_tx_to_history(tx_hash, user_id, incoming_tx, amount, tx_info, update_at)
 
 def count_transactions_by_minutes_ago(minutes_ago=1):
     """return the number of failed txs since minutes_ago"""
@@ -0,0 +1,239 @@
+"""the tx history of each user, as served by /user/transactions.
+
+each user's most recent history entries are kept in a redis list, newest first, pre-serialized. every entry is
+prefixed by its history key - '<update_at> <tx_hash>', which sorts like the history - so a page is picked from
+the list by comparing the keys with the cursor, and the entries are spliced into the response as they are.
+
+the list is filled from the db on the first read, and kept up to date on write: create_tx and create_p2p_tx
+prepend the new tx to the lists of its users (if these are cached). the list is capped at TX_HISTORY_CACHE_SIZE
+entries; pages beyond it are read from the db. if the whole history fits in the list, the list ends with
+TX_HISTORY_END, and no page ever goes to the db.
+
+a fill that raced with a write would cache a list without the new tx, so every write bumps the user's history
+generation, and a fill only goes through if the generation didn't change since it read the db.
+"""
+import json
+import logging as log
+from uuid import UUID
+
+import arrow
+import emoji
+
+from kinappserver import app, config
+from kinappserver.utils import increment_metric
+from .transaction import list_user_history_page, decode_tx_cursor, get_history_key, encode_history_key
+
+TX_HISTORY_REDIS_KEY = 'tx-history:%s'
+TX_HISTORY_GENERATION_REDIS_KEY = 'tx-history-generation:%s'
+TX_HISTORY_END = 'end'
+
+KIN_FROM_A_FRIEND_TEXT = emoji.emojize(':party_popper: Kin from a friend')
+
+# prepend the entry only if the list is cached. an entry that is older than the list's newest one (say, two txs
+# of the same user that were committed out of order) drops the list instead: the next read re-fills it in order.
+PREPEND_TX_HISTORY_SCRIPT = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[4])
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+local head_key = string.match(redis.call('lindex', KEYS[1], 0), '^%S+ %S+')
+if head_key and head_key > ARGV[2] then
+    redis.call('del', KEYS[1])
+    return 0
+end
+redis.call('lpush', KEYS[1], ARGV[1])
+redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+return 1
+"""
+_prepend_tx_history_script = None
+
+# fill the list only if no tx was written since the entries were read from the db
+FILL_TX_HISTORY_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] or redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('rpush', KEYS[1], unpack(ARGV, 3))
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+_fill_tx_history_script = None
+
+
+def format_history_entries(user_id, rows, tasks_details=None, apps=None):
+    """returns a list of (history_key, serialized tx) of the given rows of list_user_history_page, from the user's side"""
+    from .task2 import get_tasks_details
+    from .app_discovery import get_discovery_apps_by_sid
+    if tasks_details is None:
+        tasks_details = get_tasks_details([row['tx_info']['task_id'] for row in rows if row['type'] == 'server' and not row['incoming_tx']])
+    if apps is None:
+        apps = get_discovery_apps_by_sid() if any(row['receiver_app_sid'] is not None for row in rows) else {}
+
+    entries = []
+    for row in rows:
+        if row['type'] == 'server':
+            if not row['incoming_tx']:
+                details = tasks_details[str(row['tx_info']['task_id'])]
+            elif row['offer_id'] is not None:
+                details = {'title': row['offer_title'], 'desc': row['offer_desc'], 'provider': row['offer_provider']}
+            else:
+                log.error('cant find offer with id %s. using default text' % row['tx_info'].get('offer_id'))
+                details = {'title': 'unknown offer', 'desc': '', 'provider': {}}
+            tx = {'type': 'server', 'tx_hash': row['tx_hash'], 'amount': row['amount'], 'client_received': not row['incoming_tx'],
+                  'tx_info': row['tx_info'], 'date': arrow.get(row['update_at']).timestamp, **details}
+        elif row['receiver_app_sid'] is not None:
+            d_app = apps[row['receiver_app_sid']]
+            tx = {'title': 'Sent Kin to %s' % d_app['name'],
+                  'description': 'You sent %sKIN to %s' % (row['amount'], d_app['name']),
+                  'provider': {'image_url': d_app['meta_data']['icon_url'], 'name': d_app['name']},
+                  'type': 'p2p',
+                  'tx_hash': row['tx_hash'],
+                  'amount': row['amount'],
+                  'client_received': str(row['receiver_user_id']).lower() == str(user_id).lower(),
+                  'tx_info': {'memo': 'na', 'task_id': '-1'},
+                  'date': arrow.get(row['update_at']).timestamp}
+        else:
+            client_received = str(row['receiver_user_id']).lower() == str(user_id).lower()
+            tx = {'title': KIN_FROM_A_FRIEND_TEXT if client_received else 'Kin to a friend',
+                  'description': 'a friend sent you %sKIN' % row['amount'],
+                  'provider': {'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/poll_logo_kin.png', 'name': 'friend'},
+                  'type': 'p2p',
+                  'tx_hash': row['tx_hash'],
+                  'amount': row['amount'],
+                  'client_received': client_received,
+                  'tx_info': {'memo': 'na', 'task_id': '-1'},
+                  'date': arrow.get(row['update_at']).timestamp}
+        entries.append((get_history_key(row['update_at'], row['tx_hash']), json.dumps(tx)))
+    return entries
+
+
+def _tx_history_keys(user_id):
+    """the cache keys of the given user. the user_id is normalized, as it comes both from the headers and the db"""
+    user_id = UUID(str(user_id))
+    return [TX_HISTORY_REDIS_KEY % user_id, TX_HISTORY_GENERATION_REDIS_KEY % user_id]
+
+
+def _read_cached_history(user_id):
+    """returns (entries, is_complete) of the user's cached history, or None if it isn't cached"""
+    cached = app.redis.lrange(_tx_history_keys(user_id)[0], 0, -1)
+    if not cached:
+        return None
+    entries = []
+    is_complete = False
+    for item in cached:
+        item = item.decode('utf-8')
+        if item == TX_HISTORY_END:
+            is_complete = True
+            break
+        update_at, tx_hash, tx = item.split(' ', 2)
+        entries.append(('%s %s' % (update_at, tx_hash), tx))
+    return entries, is_complete
+
+
+def _fill_history_cache(user_id):
+    """read the user's most recent history from the db and cache it. returns (entries, is_complete)"""
+    global _fill_tx_history_script
+    if _fill_tx_history_script is None:
+        _fill_tx_history_script = app.redis.register_script(FILL_TX_HISTORY_SCRIPT)
+
+    try:
+        generation = app.redis.get(_tx_history_keys(user_id)[1]) or b'0'
+    except Exception as e:
+        log.error('failed to read the tx history generation of user_id %s. e: %s' % (user_id, e))
+        generation = b'0'
+    entries = format_history_entries(user_id, list_user_history_page(user_id, config.TX_HISTORY_CACHE_SIZE))
+    is_complete = len(entries) < config.TX_HISTORY_CACHE_SIZE
+
+    items = ['%s %s' % entry for entry in entries] + ([TX_HISTORY_END] if is_complete else [])
+    try:
+        _fill_tx_history_script(keys=_tx_history_keys(user_id),
+                                args=[generation.decode('utf-8'), config.TX_HISTORY_CACHE_TTL_SECS] + items)
+    except Exception as e:
+        log.error('failed to fill the tx history cache of user_id %s. e: %s' % (user_id, e))
+    return entries, is_complete
+
+
+def get_tx_history_page(user_id, limit, cursor=None):
+    """returns (txs, next_cursor): the serialized txs of the user that come after the cursor, newest first, and
+    at most limit of them. next_cursor is None on the last page.
+    """
+    after_key = None
+    if cursor:
+        after_key = '%s %s' % decode_tx_cursor(cursor)
+
+    try:
+        cached = _read_cached_history(user_id)
+    except Exception as e:
+        log.error('failed to read the tx history cache of user_id %s. e: %s' % (user_id, e))
+        cached = None
+    if cached is None:
+        increment_metric('tx-history-cache-miss')
+        entries, is_complete = _fill_history_cache(user_id)
+    else:
+        increment_metric('tx-history-cache-hit')
+        entries, is_complete = cached
+
+    page = [entry for entry in entries if after_key is None or entry[0] < after_key][:limit]
+    if len(page) < limit and not is_complete:
+        # the page goes beyond the cached window: read it from the db
+        increment_metric('tx-history-cache-beyond-window')
+        page = format_history_entries(user_id, list_user_history_page(user_id, limit, cursor))
+
+    next_cursor = encode_history_key(page[-1][0]) if len(page) == limit else None
+    return [tx for key, tx in page], next_cursor
+
+
+def add_to_tx_history(user_id, entry):
+    """prepend the given (history_key, serialized tx) to the user's cached history, if it's cached"""
+    global _prepend_tx_history_script
+    if _prepend_tx_history_script is None:
+        _prepend_tx_history_script = app.redis.register_script(PREPEND_TX_HISTORY_SCRIPT)
+    try:
+        _prepend_tx_history_script(keys=_tx_history_keys(user_id),
+                                   args=['%s %s' % entry, entry[0], config.TX_HISTORY_CACHE_SIZE, config.TX_HISTORY_CACHE_TTL_SECS])
+    except Exception as e:
+        log.error('failed to add a tx to the history cache of user_id %s. e: %s' % (user_id, e))
+        invalidate_tx_history(user_id)
+
+
+def add_server_tx_to_history(tx_hash, user_id, incoming_tx, amount, tx_info, update_at):
+    """write-through a new server tx to the user's cached history"""
+    try:
+        row = {'type': 'server', 'tx_hash': tx_hash, 'amount': amount, 'incoming_tx': incoming_tx, 'tx_info': tx_info, 'update_at': update_at,
+               'offer_id': None, 'offer_title': None, 'offer_desc': None, 'offer_provider': None,
+               'sender_user_id': None, 'receiver_user_id': None, 'receiver_app_sid': None}
+        if incoming_tx:
+            from .offer import Offer
+            offer = Offer.query.filter_by(offer_id=tx_info.get('offer_id')).first()
+            if offer:
+                row.update({'offer_id': offer.offer_id, 'offer_title': offer.title, 'offer_desc': offer.desc, 'offer_provider': offer.provider_data})
+        add_to_tx_history(user_id, format_history_entries(user_id, [row])[0])
+    except Exception as e:
+        log.error('failed to add tx %s to the history cache of user_id %s. e: %s' % (tx_hash, user_id, e))
+        invalidate_tx_history(user_id)
+
+
+def add_p2p_tx_to_history(tx_hash, sender_user_id, receiver_user_id, amount, receiver_app_sid, update_at):
+    """write-through a new p2p tx to the cached histories of its sender and receiver"""
+    row = {'type': 'p2p', 'tx_hash': tx_hash, 'amount': amount, 'incoming_tx': None, 'tx_info': None, 'update_at': update_at,
+           'offer_id': None, 'offer_title': None, 'offer_desc': None, 'offer_provider': None,
+           'sender_user_id': sender_user_id, 'receiver_user_id': receiver_user_id, 'receiver_app_sid': receiver_app_sid}
+    for user_id in set(user_id for user_id in (sender_user_id, receiver_user_id) if user_id is not None):
+        try:
+            add_to_tx_history(user_id, format_history_entries(user_id, [row])[0])
+        except Exception as e:
+            log.error('failed to add p2p tx %s to the history cache of user_id %s. e: %s' % (tx_hash, user_id, e))
+            invalidate_tx_history(user_id)
+
+
+def invalidate_tx_history(user_id):
+    """drop the user's cached history. the next read re-fills it from the db"""
+    try:
+        history_key, generation_key = _tx_history_keys(user_id)
+        pipe = app.redis.pipeline()
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, config.TX_HISTORY_CACHE_TTL_SECS)
+        pipe.delete(history_key)
+        pipe.execute()
+    except Exception as e:
+        log.error('failed to invalidate the history cache of user_id %s. e: %s' % (user_id, e))
@@ -1,4 +1,5 @@
 """The User model"""
+from sqlalchemy import text, or_, and_
 from sqlalchemy_utils import UUIDType
 from sqlalchemy.dialects.postgresql import INET
 import logging as log
@@ -8,9 +9,10 @@ from kinappserver.utils import InvalidUsage, OS_IOS, OS_ANDROID, parse_phone_num
 from kinappserver.push import push_send_gcm, push_send_apns, engagement_payload_apns, engagement_payload_gcm, compensated_payload_apns, compensated_payload_gcm, send_country_IS_supported
 from uuid import uuid4, UUID
 from .push_auth_token import get_token_obj_by_user_id, should_send_auth_token, set_send_date
+from .user_context import get_user_context, expire_user_context, write_back_user_context
 import arrow
 import json
-from distutils.version import LooseVersion
+from kinappserver.version_utils import version_lt, version_le, version_key
 from .backup import get_user_backup_hints_by_enc_phone
 from time import sleep
 
@@ -34,6 +36,7 @@ class User(db.Model):
     onboarded = db.Column(db.Boolean, unique=False, default=False)
     public_address = db.Column(db.String(60), primary_key=False, unique=True, nullable=True)
     enc_phone_number = db.Column(db.String(200), primary_key=False, nullable=True)
+    phone_blind_index = db.Column(db.String(64), primary_key=False, nullable=True, index=True)  # lookups by phone number go through this, see _by_phone_number
     deactivated = db.Column(db.Boolean, unique=False, default=False)
     auth_token = db.Column(UUIDType(binary=False), primary_key=False, nullable=True)
     package_id = db.Column(db.String(60), primary_key=False, nullable=True)
@@ -51,8 +54,24 @@ class User(db.Model):
                                                                                 self.screen_w, self.screen_h, self.screen_d, self.user_agent, self.deactivated, self.truex_user_id)
 
 
+def _get_user_row(user_id):
+    """returns the User row from the request's user context, or from the db. None if there's no such user"""
+    ctx = get_user_context(user_id)
+    if ctx is not None and ctx.user is not None:
+        return ctx.user
+    return User.query.filter_by(user_id=user_id).first()
+
+
+def _get_user_app_data_row(user_id):
+    """returns the UserAppData row from the request's user context, or from the db. None if there's no such user"""
+    ctx = get_user_context(user_id)
+    if ctx is not None and ctx.user_app_data is not None:
+        return ctx.user_app_data
+    return UserAppData.query.filter_by(user_id=user_id).first()
+
+
 def get_user(user_id):
-    user = User.query.filter_by(user_id=user_id).first()
+    user = _get_user_row(user_id)
     if not user:
         raise InvalidUsage('no such user_id')
     return user
@@ -78,14 +97,14 @@ def user_deactivated(user_id):
 
 
 def user_exists(user_id):
-    user = User.query.filter_by(user_id=user_id).first()
+    user = _get_user_row(user_id)
     return True if user else False
 
 
 def is_onboarded(user_id):
     """returns whether the user has an account or None if there's no such user."""
     try:
-        return User.query.filter_by(user_id=user_id).first().onboarded
+        return _get_user_row(user_id).onboarded
     except Exception as e:
         print(e)
         return None
@@ -237,7 +256,7 @@ def create_ticket(name,email, category, sub_category, description,user_id, platf
 def update_user_app_version(user_id, app_ver):
     """update the user app version"""
     try:
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = _get_user_app_data_row(user_id)
         userAppData.app_ver = app_ver
         db.session.add(userAppData)
         db.session.commit()
@@ -247,9 +266,9 @@ def update_user_app_version(user_id, app_ver):
 
 
 def get_user_inapp_balance(user_id):
-    spend = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = true;" % user_id).first()['total'] or 0
-    income = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = false;" % user_id).first()['total'] or 0
-    return income - spend
+    """returns the kin the user earned from the server minus the kin spent on offers, from the balance ledger"""
+    from .user_balance import get_user_balance
+    return get_user_balance(user_id)
 
 
 def set_should_solve_captcha(user_id, value=0):
@@ -261,7 +280,7 @@ def set_should_solve_captcha(user_id, value=0):
     """
     try:
 
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = _get_user_app_data_row(user_id)
         userAppData.should_solve_captcha_ternary = value
         db.session.add(userAppData)
         db.session.commit()
@@ -275,19 +294,21 @@ def set_should_solve_captcha(user_id, value=0):
 def autoswitch_captcha(user_id):
     """promotes user's captcha state from 0 to 1, iff it was 0"""
     statement = '''update public.user_app_data set should_solve_captcha_ternary = 1 where public.user_app_data.user_id = '%s' and public.user_app_data.should_solve_captcha_ternary = 0;'''
+    write_back_user_context(user_id)
     db.engine.execute(statement % user_id)
+    expire_user_context(user_id)
 
 
 
 def should_pass_captcha(user_id):
     """returns True iff the client must pass captcha test. older clients are auto-exempt"""
 
-    user_app_data = UserAppData.query.filter_by(user_id=user_id).one()
+    user_app_data = _get_user_app_data_row(user_id)
     client_version = user_app_data.app_ver
     ternary = user_app_data.should_solve_captcha_ternary
     os_type = get_user_os_type(user_id)
 
-    if os_type == OS_ANDROID and LooseVersion(client_version) < LooseVersion(config.CAPTCHA_MIN_CLIENT_VERSION_ANDROID):
+    if os_type == OS_ANDROID and version_lt(client_version, config.CAPTCHA_MIN_CLIENT_VERSION_ANDROID):
         return False
     if os_type == OS_IOS:  # all ios clients are exempt
         return False
@@ -300,7 +321,7 @@ def should_pass_captcha(user_id):
 def captcha_solved(user_id):
     """lower the captcha flag for this user and add it to the history"""
     try:
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = _get_user_app_data_row(user_id)
         now = arrow.utcnow().timestamp
         if userAppData.should_solve_captcha_ternary < 1:
             log.info('captcha_solved: user %s doesnt need to solve captcha' % user_id)
@@ -362,18 +383,25 @@ def automatically_raise_captcha_flag(user_id):
 
 def update_ip_address(user_id, ip_address):
     try:
-        userAppData = UserAppData.query.filter_by(user_id=user_id).first()
+        userAppData = _get_user_app_data_row(user_id)
         if userAppData.ip_address == ip_address:
             # nothing to update
             return
 
-        userAppData.ip_address = ip_address
+        country_iso_code = userAppData.country_iso_code
         try:
-            userAppData.country_iso_code = app.geoip_reader.get(ip_address)['country']['iso_code']
+            country_iso_code = app.geoip_reader.get(ip_address)['country']['iso_code']
         except Exception as e:
             log.error('could not calc country iso code for %s' % ip_address)
-        db.session.add(userAppData)
-        db.session.commit()
+        ctx = get_user_context(user_id)
+        if ctx is not None:
+            # the ip address can wait for the end of the request
+            ctx.defer_app_data_update(ip_address=ip_address, country_iso_code=country_iso_code)
+        else:
+            userAppData.ip_address = ip_address
+            userAppData.country_iso_code = country_iso_code
+            db.session.add(userAppData)
+            db.session.commit()
     except Exception as e:
         log.error('update_ip_address: e: %s' % e)
         raise InvalidUsage('cant set user ip address')
@@ -382,13 +410,13 @@ def update_ip_address(user_id, ip_address):
 
 
 def get_user_country_code(user_id):
-    return UserAppData.query.filter_by(user_id=user_id).one().country_iso_code  # can be null
+    return _get_user_app_data_row(user_id).country_iso_code  # can be null
 
 
 def get_next_task_memo(user_id, cat_id):
     """returns the next memo for this user and cat_id"""
     try:
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+        user_app_data = _get_user_app_data_row(user_id)
         next_memo = user_app_data.next_task_memo_dict.get(cat_id, None)
         if next_memo is None:  # set a value
             return generate_and_save_next_task_memo(user_app_data, cat_id)
@@ -402,7 +430,7 @@ def get_and_replace_next_task_memo(user_id, task_id, cat_id=None):
     """return the memo for this user and replace it with another"""
     try:
         memo = None
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+        user_app_data = _get_user_app_data_row(user_id)
         from .task2 import get_cat_id_for_task_id
         cat_id = cat_id if cat_id else get_cat_id_for_task_id(task_id)
         if user_app_data.next_task_memo_dict[cat_id]:
@@ -435,7 +463,7 @@ def list_all_users_app_data():
 
 
 def get_user_app_data(user_id):
-    user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+    user_app_data = _get_user_app_data_row(user_id)
     if not user_app_data:
         raise InvalidUsage('no such user_id')
     return user_app_data
@@ -443,12 +471,12 @@ def get_user_app_data(user_id):
 
 def get_user_tz(user_id):
     """return the user timezone"""
-    return User.query.filter_by(user_id=user_id).one().time_zone
+    return _get_user_row(user_id).time_zone
 
 
 def get_user_os_type(user_id):
     """return the user os_type"""
-    return User.query.filter_by(user_id=user_id).one().os_type
+    return _get_user_row(user_id).os_type
 
 
 def package_id_to_push_env(package_id):
@@ -461,7 +489,7 @@ def package_id_to_push_env(package_id):
 def get_user_push_data(user_id):
     """returns the os_type, token and push_env for the given user_id"""
     try:
-        user = User.query.filter_by(user_id=user_id).first()
+        user = _get_user_row(user_id)
     except Exception as e:
         log.error('Error: could not get push data for user %s' % user_id)
         return None, None, None
@@ -581,7 +609,7 @@ def store_next_task_results_ts(user_id, task_id, timestamp_str, cat_id=None):
             cat_id = get_cat_id_for_task_id(task_id)
 
         # stored as string, can be None
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+        user_app_data = _get_user_app_data_row(user_id)
         user_app_data.next_task_ts_dict[cat_id] = timestamp_str
         db.session.add(user_app_data)
 
@@ -593,7 +621,7 @@ def store_next_task_results_ts(user_id, task_id, timestamp_str, cat_id=None):
 def get_next_task_results_ts(user_id, cat_id):
     """return the task_result_ts field for the given user and task category"""
     try:
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
+        user_app_data = _get_user_app_data_row(user_id)
         if user_app_data is None:
             return None
         return user_app_data.next_task_ts_dict.get(cat_id, 0)  # can be None
@@ -640,14 +668,16 @@ def get_users_for_engagement_push(scheme):
     end = time.time()
     diff = end - start
     log.info("engage-push: num of users to process %d, query took : %s" % (len(all_pushable_users), diff))
+    min_android_version_key = version_key("1.4.0")
+    min_ios_version_key = version_key("1.2.1")
     for user in all_pushable_users:
         try:
             from .blacklisted_phone_numbers import is_userid_blacklisted
 
-            if user.os_type == OS_ANDROID and LooseVersion(user.app_ver) <= LooseVersion("1.4.0"):
+            if user.os_type == OS_ANDROID and version_key(user.app_ver) <= min_android_version_key:
                 skipped_users['old_version'].append(user.user_id)
                 continue
-            elif user.os_type == OS_IOS and LooseVersion(user.app_ver) <= LooseVersion("1.2.1"):
+            elif user.os_type == OS_IOS and version_key(user.app_ver) <= min_ios_version_key:
                 skipped_users['old_version'].append(user.user_id)
                 continue
             elif is_userid_blacklisted(user.user_id):
@@ -738,25 +768,54 @@ def get_address_by_userid(user_id):
         raise
 
 
+def get_phone_blind_index(phone_number):
+    """returns the blind index of the given (un-enc) phone number: a keyed hash by which users are looked up"""
+    return app.phone_blind_index.digest(phone_number)
+
+
+def _enc_phone_number_for_lookup(phone_number):
+    """returns the encrypted phone number to fall back to in _by_phone_number, or None once the fallback is off"""
+    if not config.PHONE_BLIND_INDEX_FALLBACK:
+        return None
+    return app.encryption.encrypt(phone_number)
+
+
+def _by_phone_number(phone_blind_index, enc_phone_number):
+    """returns the filter of the users with the given phone number.
+
+    users that predate the blind index have none until backfill_phone_blind_indexes sets it, so while
+    PHONE_BLIND_INDEX_FALLBACK is on, they are matched by their encrypted phone number instead. turn it off
+    once the backfill is done.
+    """
+    if phone_blind_index is None:
+        return User.enc_phone_number == enc_phone_number
+    if not config.PHONE_BLIND_INDEX_FALLBACK or enc_phone_number is None:
+        return User.phone_blind_index == phone_blind_index
+    return or_(User.phone_blind_index == phone_blind_index,
+               and_(User.phone_blind_index == None, User.enc_phone_number == enc_phone_number))
+
+
 def set_user_phone_number(user_id, number):
     """sets a phone number to the user's entry"""
     try:
         user = get_user(user_id)
+        phone_blind_index = get_phone_blind_index(number)
         encrypted_number = app.encryption.encrypt(number)
         # allow (and ignore) re-submissions of the SAME number, but reject new numbers
         if user.enc_phone_number is not None:
-            if user.enc_phone_number == encrypted_number:
+            if user.phone_blind_index == phone_blind_index or (user.phone_blind_index is None and user.enc_phone_number == encrypted_number):
                 return  # all good, do nothing
             else:
                 log.error('refusing to overwrite phone number for user_id %s' % user_id)
                 raise InvalidUsage('trying to overwrite an existing phone number with a different one')
         else:
             user.enc_phone_number = encrypted_number
+            user.phone_blind_index = phone_blind_index
             db.session.add(user)
             db.session.commit()
 
         # does this number belong to another user? if so, de-activate the old user.
-        deactivate_by_enc_phone_number(encrypted_number, user_id)
+        deactivate_by_phone_blind_index(phone_blind_index, encrypted_number, user_id)
 
     except Exception as e:
         log.error('cant add phone number %s to user_id: %s. Exception: %s' % (number, user_id, e))
@@ -765,8 +824,7 @@ def set_user_phone_number(user_id, number):
 
 def get_active_user_id_by_phone(phone_number):
     try:
-        encrypted_phone_number = app.encryption.encrypt(phone_number)
-        user = User.query.filter_by(enc_phone_number=encrypted_phone_number).filter_by(deactivated=False).first()
+        user = User.query.filter(_by_phone_number(get_phone_blind_index(phone_number), _enc_phone_number_for_lookup(phone_number))).filter_by(deactivated=False).first()
         if user is None:
             return None
         else:
@@ -776,9 +834,9 @@ def get_active_user_id_by_phone(phone_number):
         raise
 
 
-def get_active_user_id_by_enc_phone(enc_phone_number):
+def get_active_user_id_by_phone_blind_index(phone_blind_index, enc_phone_number):
     try:
-        user = User.query.filter_by(enc_phone_number=enc_phone_number).filter_by(deactivated=False).first()
+        user = User.query.filter(_by_phone_number(phone_blind_index, enc_phone_number)).filter_by(deactivated=False).first()
         if user is None:
             return None
         else:
@@ -788,9 +846,9 @@ def get_active_user_id_by_enc_phone(enc_phone_number):
         raise
 
 
-def get_user_ids_by_enc_phone(enc_phone_number):
+def get_user_ids_by_phone_blind_index(phone_blind_index, enc_phone_number):
     try:
-        users = User.query.filter_by(enc_phone_number=enc_phone_number).all()
+        users = User.query.filter(_by_phone_number(phone_blind_index, enc_phone_number)).all()
         return [user.user_id for user in users]
     except Exception as e:
         log.error('cant get user_ids by enc phone. Exception: %s' % e)
@@ -808,7 +866,7 @@ def get_unenc_phone_number_by_user_id(user_id):
 
 def get_enc_phone_number_by_user_id(user_id):
     try:
-        user = User.query.filter_by(user_id=user_id).first()
+        user = _get_user_row(user_id)
         if user is None:
             return None
         else:
@@ -818,6 +876,18 @@ def get_enc_phone_number_by_user_id(user_id):
         raise
 
 
+def get_phone_blind_index_by_user_id(user_id):
+    try:
+        user = _get_user_row(user_id)
+        if user is None:
+            return None
+        else:
+            return user.phone_blind_index  # can be None
+    except Exception as e:
+        log.error('cant get user phone blind index by user_id. Exception: %s' % e)
+        raise
+
+
 def is_user_phone_verified(user_id):
     """return true iff the user passed phone-verification"""
     return get_enc_phone_number_by_user_id(user_id) is not None
@@ -825,8 +895,7 @@ def is_user_phone_verified(user_id):
 
 def get_all_user_id_by_phone(phone_number):
     try:
-        encrypted_number = app.encryption.encrypt(phone_number)
-        users = User.query.filter_by(enc_phone_number=encrypted_number).all()
+        users = User.query.filter(_by_phone_number(get_phone_blind_index(phone_number), _enc_phone_number_for_lookup(phone_number))).all()
         return [user.user_id for user in users]
     except Exception as e:
         log.error('cant get user(s) address by phone. Exception: %s' % e)
@@ -842,26 +911,27 @@ def match_phone_number_to_address(phone_number, sender_user_id):
         log.error('should never happen: cant get user\'s phone number. user_id: %s' % sender_user_id)
 
     sender_unenc_phone_number = app.encryption.decrypt(sender_enc_phone_number)
-    enc_phone_num_1 = app.encryption.encrypt(parse_phone_number(phone_number, sender_unenc_phone_number))
-    parsed_address = get_address_by_enc_phone_number(enc_phone_num_1)
+    parsed_phone_number = parse_phone_number(phone_number, sender_unenc_phone_number)
+    phone_blind_index_1 = get_phone_blind_index(parsed_phone_number)
+    parsed_address = get_address_by_phone_blind_index(phone_blind_index_1, _enc_phone_number_for_lookup(parsed_phone_number))
 
     if parsed_address is None:
         # special handling for Israeli numbers: perhaps the number was stored in the db with a leading zero.
         # in the db: +9720527702891
         # from the client: 0527702891
-        enc_phone_num_2 = app.encryption.encrypt('+972' + phone_number)
-        parsed_address = get_address_by_enc_phone_number(enc_phone_num_2)
+        phone_blind_index_2 = get_phone_blind_index('+972' + phone_number)
+        parsed_address = get_address_by_phone_blind_index(phone_blind_index_2, _enc_phone_number_for_lookup('+972' + phone_number))
         if parsed_address:
-            log.info('match_phone_number_to_address: applied special israeli-number logic to parse number: %s' % enc_phone_num_2)
+            log.info('match_phone_number_to_address: applied special israeli-number logic to parse number: %s' % phone_blind_index_2)
 
     return parsed_address
 
 
-def get_address_by_enc_phone_number(enc_phone_number):
+def get_address_by_phone_blind_index(phone_blind_index, enc_phone_number):
     try:
-        user = User.query.filter(User.enc_phone_number==enc_phone_number).filter_by(deactivated=False).first()
+        user = User.query.filter(_by_phone_number(phone_blind_index, enc_phone_number)).filter_by(deactivated=False).first()
         if user is None:
-            log.error('cant find user for encrypted phone number: %s' % enc_phone_number)
+            log.error('cant find user for phone blind index: %s' % phone_blind_index)
             return None
         else:
             return user.public_address  # can be None
@@ -870,20 +940,22 @@ def get_address_by_enc_phone_number(enc_phone_number):
         raise
 
 
-def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=False):
+def deactivate_by_phone_blind_index(phone_blind_index, enc_phone_number, new_user_id, activate_user=False):
     """deactivate any active user with the given phone number except the one with user_id
 
     this function deactivates the previous active user with the given phone number AND
     also duplicates his history into the new user.
     """
     new_user_id = str(new_user_id)
+    write_back_user_context(new_user_id)
 
     if activate_user: # used in backup-restore
         log.info('activating user %s prior to deactivating all other user_ids' % new_user_id)
         db.engine.execute("update public.user set deactivated=false where user_id='%s'" % new_user_id)
+        expire_user_context(new_user_id)
     try:
         # find candidates to de-activate (except user_id)
-        users = User.query.filter(User.enc_phone_number == enc_phone_number).filter(User.user_id != new_user_id).filter(User.deactivated == False).all()
+        users = User.query.filter(_by_phone_number(phone_blind_index, enc_phone_number)).filter(User.user_id != new_user_id).filter(User.deactivated == False).all()
         if users is []:
             return None  # nothing to do
         else:
@@ -903,9 +975,11 @@ def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=
                 # also delete the new user's history and plant the old user's history instead
                 db.engine.execute("delete from public.user_task_results where user_id='%s'" % UUID(new_user_id))
                 db.engine.execute("update public.user_task_results set user_id='%s' where user_id='%s'" % (UUID(new_user_id), user_id_to_deactivate))
+                expire_user_context(user_id_to_deactivate)
+            expire_user_context(new_user_id)
 
     except Exception as e:
-        log.error('cant deactivate_by_phone_number. Exception: %s' % e)
+        log.error('cant deactivate_by_phone_blind_index. Exception: %s' % e)
         raise
 
 
@@ -917,7 +991,7 @@ def get_associated_user_ids(user_id):
     if user.enc_phone_number is None:
         return [user_id]
     else:
-        users = User.query.filter(User.enc_phone_number == user.enc_phone_number).all()
+        users = User.query.filter(_by_phone_number(user.phone_blind_index, user.enc_phone_number)).all()
         return [str(user.user_id) for user in users]
 
 
@@ -934,10 +1008,14 @@ def nuke_user_data(phone_number, nuke_all=False):
     for user_id in user_ids:
         db.engine.execute("delete from good where tx_hash in (select tx_hash from transaction where user_id='%s')" % user_id)
         db.engine.execute("delete from public.transaction where user_id='%s'" % user_id)
+        db.engine.execute("delete from public.user_balance where user_id='%s'" % user_id)  # re-seeded on the next read
+        from .tx_history import invalidate_tx_history
+        invalidate_tx_history(user_id)
         db.engine.execute("delete from public.user_task_results where user_id='%s'" % user_id)
         db.engine.execute('''update public.user_app_data set completed_tasks_dict='{}'::json where user_id=\'%s\'''' % user_id)
         db.engine.execute('''update public.user_app_data set next_task_memo_dict='{}'::json where user_id=\'%s\'''' % user_id)
         db.engine.execute('''update public.user_app_data set next_task_ts_dict='{}'::json where user_id=\'%s\'''' % user_id)
+        expire_user_context(user_id)
 
     # also erase the backup hints for the phone
     db.engine.execute("delete from phone_backup_hints where enc_phone_number='%s'" % app.encryption.encrypt(phone_number))
@@ -963,10 +1041,10 @@ def get_user_config(user_id):
     # turn off phone verification for older clients:
     disable_phone_verification = False
     disable_backup_nag = False
-    if os_type == OS_ANDROID and LooseVersion(user_app_data.app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
+    if os_type == OS_ANDROID and version_le(user_app_data.app_ver, config.BLOCK_ONBOARDING_ANDROID_VERSION):
         disable_phone_verification = True
         disable_backup_nag = True
-    elif os_type == OS_IOS and LooseVersion(user_app_data.app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
+    elif os_type == OS_IOS and version_le(user_app_data.app_ver, config.BLOCK_ONBOARDING_IOS_VERSION):
         disable_phone_verification = True
         disable_backup_nag = True
 
@@ -1092,7 +1170,7 @@ def restore_user_by_address(current_user_id, address):
 
     # 3. activate the original user, deactivate the current one and
     # 4. copy the tasks from the current_user_id back onto the original user_id
-    deactivate_by_enc_phone_number(curr_enc_phone_number, original_user_id, True)
+    deactivate_by_phone_blind_index(get_phone_blind_index_by_user_id(current_user_id), curr_enc_phone_number, original_user_id, True)
 
     # copy the (potentially new device data and new push token to the old user)
     if not migrate_restored_user_data(current_user_id, original_user_id):
@@ -1141,7 +1219,6 @@ def migrate_restored_user_data(temp_user_id, restored_user_id):
 
 def should_block_user_by_client_version(user_id):
     """determines whether this user_id should be blocked based on the client version"""
-    from distutils.version import LooseVersion
     try:
         os_type = get_user_os_type(user_id)
         client_version = get_user_app_data(user_id).app_ver
@@ -1150,11 +1227,11 @@ def should_block_user_by_client_version(user_id):
         return False
     else:
         if os_type == OS_ANDROID:
-            if LooseVersion(client_version) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
+            if version_le(client_version, config.BLOCK_ONBOARDING_ANDROID_VERSION):
                 log.info('should block android version (%s), config: %s' % (client_version, config.BLOCK_ONBOARDING_ANDROID_VERSION))
                 return True
         else: # OS_IOS
-            if LooseVersion(client_version) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
+            if version_le(client_version, config.BLOCK_ONBOARDING_IOS_VERSION):
                 log.info('should block ios version (%s), config: %s' % (client_version, config.BLOCK_ONBOARDING_IOS_VERSION))
                 return True
     return False
@@ -1210,6 +1287,8 @@ def delete_all_user_data(user_id, are_u_sure=False):
     delete_user_goods = '''delete from good where good.order_id in (select tx_info->>'memo' as order_id from transaction where user_id='%s');'''
     delete_user_transactions = '''delete from transaction where user_id='%s';'''
     delete_user_orders = '''delete from public.order where user_id='%s';'''
+    delete_user_balances = '''delete from public.user_balance where user_id='%s' or user_id in (select receiver_user_id from p2_p_transaction where sender_user_id='%s') or user_id in (select sender_user_id from p2_p_transaction where receiver_user_id='%s');'''
+    select_p2p_counterparts = '''select receiver_user_id from p2_p_transaction where sender_user_id='%s' and receiver_user_id is not null union select sender_user_id from p2_p_transaction where receiver_user_id='%s';'''
     delete_p2p_txs_sent = '''delete from p2_p_transaction where sender_user_id='%s';'''
     delete_p2p_txs_received = '''delete from p2_p_transaction where receiver_user_id='%s';'''
     delete_phone_backup_hints = '''delete from phone_backup_hints where enc_phone_number in (select enc_phone_number from public.user where user_id='%s');'''
@@ -1223,7 +1302,7 @@ def delete_all_user_data(user_id, are_u_sure=False):
     if not enc_phone:
         log.error('refusing to delete data for user with no phone number')
         return
-    uids = get_user_ids_by_enc_phone(enc_phone)
+    uids = get_user_ids_by_phone_blind_index(get_phone_blind_index_by_user_id(user_id), enc_phone)
     log.info('WARNING: will delete all data of the following %s user_ids: %s' % (len(uids), uids))
     if not are_u_sure:
         log.error('refusing to delete users. if youre sure, send with force flag')
@@ -1237,7 +1316,13 @@ def delete_all_user_data(user_id, are_u_sure=False):
         db.engine.execute(delete_user_orders % uid)
         log.info('deleting txs...')
         db.engine.execute(delete_user_transactions % uid)
+        log.info('deleting balances...')  # the balances of the p2p counterparts are re-seeded on their next read
+        db.engine.execute(delete_user_balances % (uid, uid, uid))
         log.info('deleting p2p txs...')
+        from .tx_history import invalidate_tx_history
+        counterpart_ids = [row[0] for row in db.engine.execute(select_p2p_counterparts % (uid, uid)).fetchall()]
+        for user_id in [uid] + counterpart_ids:
+            invalidate_tx_history(user_id)
         db.engine.execute(delete_p2p_txs_sent % uid)
         db.engine.execute(delete_p2p_txs_received % uid)
         log.info('deleting backup hints...')
@@ -1252,12 +1337,46 @@ def delete_all_user_data(user_id, are_u_sure=False):
         log.info('done with user_id: %s' % uid)
 
 
+BACKFILL_PHONE_BLIND_INDEXES_STATEMENT = '''
+UPDATE public.user SET phone_blind_index = batch.phone_blind_index
+FROM (SELECT unnest(CAST(:user_ids AS uuid[])) AS user_id, unnest(CAST(:phone_blind_indexes AS varchar[])) AS phone_blind_index) batch
+WHERE public.user.user_id = batch.user_id;
+'''
+
+
+def backfill_phone_blind_indexes(batch_size=1000):
+    """set the phone_blind_index of the users that predate it. returns the number of users that were updated
+
+    the column and its index are added by helpers/migrate_user_phone_blind_index.py, before the deploy.
+    """
+    updated, failed_user_ids = 0, []
+    while True:
+        rows = db.engine.execute(text('''SELECT user_id, enc_phone_number FROM public.user
+                                         WHERE enc_phone_number IS NOT NULL AND phone_blind_index IS NULL AND user_id <> ALL(CAST(:failed_user_ids AS uuid[]))
+                                         LIMIT :batch_size;'''), failed_user_ids=failed_user_ids, batch_size=batch_size).fetchall()
+        if not rows:
+            break
+        user_ids, phone_blind_indexes = [], []
+        for row in rows:
+            try:
+                phone_blind_indexes.append(get_phone_blind_index(app.encryption.decrypt(row['enc_phone_number'])))
+                user_ids.append(str(row['user_id']))
+            except Exception as e:
+                log.error('backfill_phone_blind_indexes: cant decrypt the phone number of user_id %s. e: %s' % (row['user_id'], e))
+                failed_user_ids.append(str(row['user_id']))
+        if user_ids:
+            db.engine.execute(text(BACKFILL_PHONE_BLIND_INDEXES_STATEMENT).execution_options(autocommit=True),
+                              user_ids=user_ids, phone_blind_indexes=phone_blind_indexes)
+        updated = updated + len(user_ids)
+    log.info('backfilled %s phone blind indexes. %s users failed' % (updated, len(failed_user_ids)))
+    if not failed_user_ids:
+        log.info('all the users have a phone blind index - PHONE_BLIND_INDEX_FALLBACK can be turned off')
+    return updated
+
+
 def count_registrations_for_phone_number(phone_number):
     """returns the number of registrations for the given unenc phone number"""
-    enc_phone_number = app.encryption.encrypt(phone_number)
-    count_users_with_enc_phone_number = '''select count(*) from public.user where enc_phone_number='%s';'''
-    count = db.engine.execute(count_users_with_enc_phone_number % enc_phone_number).scalar()
-    return count if count else 0
+    return User.query.filter(_by_phone_number(get_phone_blind_index(phone_number), _enc_phone_number_for_lookup(phone_number))).count()
 
 
 def count_missing_txs():
@@ -1281,8 +1400,7 @@ def re_register_all_users():
             log.info('skipping user with ios client')
             continue
         user_app_data = get_user_app_data(user.user_id)
-        from distutils.version import LooseVersion
-        if user_app_data.app_ver is None or LooseVersion(user_app_data.app_ver) < LooseVersion('1.2.1'):
+        if user_app_data.app_ver is None or version_lt(user_app_data.app_ver, '1.2.1'):
             log.info('skipping user with client ver %s' % user_app_data.app_ver)
 
         sleep(0.5)  # lets not choke the server. this can really hurt us if done too fast.
@@ -0,0 +1,163 @@
+"""the user balance ledger: a running total of each user's kin, kept next to the transactions.
+
+the in-app balance used to be computed with two SUM(amount) scans over the user's transactions on every
+offers list and booking. the ledger row is updated by the very statement that inserts a tx (see create_tx and
+create_p2p_tx, which use user_balance_ctes), so reading the balance is a single primary-key lookup. a single
+statement is needed since in prod the engine runs in autocommit mode - where every statement commits on its own.
+
+a user with no ledger row yet (say, a user that predates the ledger) gets one seeded from the transaction
+tables on the first update or read. backfill_user_balances seeds all the missing rows at once, and
+check_user_balances compares the ledger with the transaction tables - and optionally fixes it.
+
+note that, like before, p2p txs are not a part of the in-app balance: they're kept in their own columns.
+"""
+import logging as log
+
+from sqlalchemy import text
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db
+from kinappserver.utils import gauge_metric, increment_metric
+
+
+class UserBalance(db.Model):
+    """the kin a user earned from the server and spent on offers, and the p2p kin sent and received"""
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=True, nullable=False)
+    earned = db.Column(db.BigInteger(), nullable=False, default=0)
+    spent = db.Column(db.BigInteger(), nullable=False, default=0)
+    p2p_sent = db.Column(db.BigInteger(), nullable=False, default=0)
+    p2p_received = db.Column(db.BigInteger(), nullable=False, default=0)
+    update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<user_id: %s, earned: %s, spent: %s, p2p_sent: %s, p2p_received: %s, update_at: %s>' % (self.user_id, self.earned, self.spent, self.p2p_sent, self.p2p_received, self.update_at)
+
+
+# the balance of each user, as computed from the transaction tables
+ACTUAL_BALANCES_QUERY = '''
+    SELECT u.user_id,
+        coalesce(tx.earned, 0) AS earned, coalesce(tx.spent, 0) AS spent,
+        coalesce(sent.amount, 0) AS p2p_sent, coalesce(received.amount, 0) AS p2p_received
+    FROM public.user u
+    LEFT JOIN (SELECT user_id, sum(amount) FILTER (WHERE incoming_tx = false) AS earned, sum(amount) FILTER (WHERE incoming_tx = true) AS spent
+               FROM transaction GROUP BY user_id) tx ON tx.user_id = u.user_id
+    LEFT JOIN (SELECT sender_user_id, sum(amount) AS amount FROM p2_p_transaction GROUP BY sender_user_id) sent ON sent.sender_user_id = u.user_id
+    LEFT JOIN (SELECT receiver_user_id, sum(amount) AS amount FROM p2_p_transaction WHERE receiver_user_id IS NOT NULL GROUP BY receiver_user_id) received ON received.receiver_user_id = u.user_id
+'''
+
+# a new row is seeded from the (committed) transaction tables. an existing row is incremented.
+# two concurrent first-time updates are safe: the second one waits on the first one's insert, then increments.
+ADD_TO_USER_BALANCE_STATEMENT = '''
+INSERT INTO user_balance (user_id, earned, spent, p2p_sent, p2p_received, update_at)
+SELECT CAST(:user_id AS uuid),
+    (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:user_id AS uuid) AND incoming_tx = false),
+    (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:user_id AS uuid) AND incoming_tx = true),
+    (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE sender_user_id = CAST(:user_id AS uuid)),
+    (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE receiver_user_id = CAST(:user_id AS uuid)),
+    now()
+ON CONFLICT (user_id) DO UPDATE SET
+    earned = user_balance.earned + :earned,
+    spent = user_balance.spent + :spent,
+    p2p_sent = user_balance.p2p_sent + :p2p_sent,
+    p2p_received = user_balance.p2p_received + :p2p_received,
+    update_at = now()
+RETURNING earned, spent;
+'''
+
+
+# the same as ADD_TO_USER_BALANCE_STATEMENT, as a CTE of the statement that inserts the tx. a statement doesn't see
+# its own inserts, so a new row is seeded from the transaction tables plus the new amounts. %(after)s makes each
+# CTE wait for the previous one, so the rows of a p2p tx's users are always locked in the same order
+ADD_TO_USER_BALANCE_CTE = '''
+balance_%(i)s AS (
+    INSERT INTO user_balance (user_id, earned, spent, p2p_sent, p2p_received, update_at)
+    SELECT CAST(:balance_user_id_%(i)s AS uuid),
+        (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:balance_user_id_%(i)s AS uuid) AND incoming_tx = false) + :earned_%(i)s,
+        (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:balance_user_id_%(i)s AS uuid) AND incoming_tx = true) + :spent_%(i)s,
+        (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE sender_user_id = CAST(:balance_user_id_%(i)s AS uuid)) + :p2p_sent_%(i)s,
+        (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE receiver_user_id = CAST(:balance_user_id_%(i)s AS uuid)) + :p2p_received_%(i)s,
+        now()
+    %(after)s
+    ON CONFLICT (user_id) DO UPDATE SET
+        earned = user_balance.earned + :earned_%(i)s,
+        spent = user_balance.spent + :spent_%(i)s,
+        p2p_sent = user_balance.p2p_sent + :p2p_sent_%(i)s,
+        p2p_received = user_balance.p2p_received + :p2p_received_%(i)s,
+        update_at = now()
+    RETURNING user_id
+)'''
+
+
+def user_balance_ctes(amounts):
+    """returns the CTEs (and their params) that add the amounts of a new tx to the balances of its users.
+
+    amounts is a dict of user_id: a dict of earned/spent/p2p_sent/p2p_received amounts. the CTEs are meant for
+    the WITH clause of the statement that inserts the tx, so the tx and the balances are committed together.
+    """
+    ctes = []
+    params = {}
+    for i, user_id in enumerate(sorted(amounts, key=lambda user_id: str(user_id).lower())):
+        user_amounts = amounts[user_id]
+        after = 'FROM (SELECT count(*) FROM balance_%s) AS previous' % (i - 1) if i else ''
+        ctes.append(ADD_TO_USER_BALANCE_CTE % {'i': i, 'after': after})
+        params['balance_user_id_%s' % i] = str(user_id)
+        for column in ('earned', 'spent', 'p2p_sent', 'p2p_received'):
+            params['%s_%s' % (column, i)] = int(user_amounts.get(column, 0))
+    return ','.join(ctes), params
+
+
+def get_user_balance(user_id):
+    """returns the in-app balance of the given user: the kin earned from the server minus the kin spent on offers"""
+    row = db.engine.execute(text('SELECT earned, spent FROM user_balance WHERE user_id = CAST(:user_id AS uuid);'), user_id=str(user_id)).first()
+    if row is None:
+        # no ledger row yet: seed it from the transaction tables
+        increment_metric('user-balance-seeded')
+        row = db.engine.execute(text(ADD_TO_USER_BALANCE_STATEMENT).execution_options(autocommit=True),
+                                user_id=str(user_id), earned=0, spent=0, p2p_sent=0, p2p_received=0).first()
+    return row['earned'] - row['spent']
+
+
+def backfill_user_balances():
+    """create the ledger rows of all the users that don't have one yet. returns the number of rows created"""
+    res = db.engine.execute(text('''INSERT INTO user_balance (user_id, earned, spent, p2p_sent, p2p_received, update_at)
+                                    SELECT actual.*, now() FROM (%s) actual
+                                    ON CONFLICT (user_id) DO NOTHING;''' % ACTUAL_BALANCES_QUERY).execution_options(autocommit=True))
+    log.info('backfilled %s user balances' % res.rowcount)
+    return res.rowcount
+
+
+def check_user_balances(fix=False):
+    """compare the ledger with the transaction tables and return the user_ids whose balance doesn't match.
+
+    the comparison runs in a single snapshot, in which each tx and its ledger update are either both visible or
+    both missing - so txs that are being created while the check runs don't show up as mismatches.
+    with fix=True, the balances of these users are recomputed.
+    """
+    rows = db.engine.execute('''SELECT b.user_id FROM user_balance b JOIN (%s) actual ON actual.user_id = b.user_id
+                                WHERE (b.earned, b.spent, b.p2p_sent, b.p2p_received) IS DISTINCT FROM
+                                      (actual.earned, actual.spent, actual.p2p_sent, actual.p2p_received);''' % ACTUAL_BALANCES_QUERY).fetchall()
+    user_ids = [str(row['user_id']) for row in rows]
+    gauge_metric('user-balance-mismatches', len(user_ids))
+    if user_ids:
+        log.error('found %s user balances that dont match the transactions: %s' % (len(user_ids), user_ids))
+
+    if fix:
+        for user_id in user_ids:
+            fix_user_balance(user_id)
+    return user_ids
+
+
+def fix_user_balance(user_id):
+    """recompute the balance of the given user from the transaction tables"""
+    with db.engine.begin() as conn:
+        # lock the row first: txs that are created from now on wait for the fix, and the ones that were
+        # committed before it are all visible to the next statement
+        conn.execute(text('SELECT 1 FROM user_balance WHERE user_id = CAST(:user_id AS uuid) FOR UPDATE;'), user_id=user_id)
+        conn.execute(text('''UPDATE user_balance SET
+                                 earned = (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:user_id AS uuid) AND incoming_tx = false),
+                                 spent = (SELECT coalesce(sum(amount), 0) FROM transaction WHERE user_id = CAST(:user_id AS uuid) AND incoming_tx = true),
+                                 p2p_sent = (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE sender_user_id = CAST(:user_id AS uuid)),
+                                 p2p_received = (SELECT coalesce(sum(amount), 0) FROM p2_p_transaction WHERE receiver_user_id = CAST(:user_id AS uuid)),
+                                 update_at = now()
+                             WHERE user_id = CAST(:user_id AS uuid);'''), user_id=user_id)
+    log.info('fixed the balance of user_id %s' % user_id)
@@ -0,0 +1,115 @@
+"""a request-scoped identity map for the user's rows.
+
+a single public request used to re-load the User, UserAppData and PushAuthToken rows of the same user
+dozens of times, once per helper. the UserContext loads all three rows in one joined query, the first time
+they are needed in a request, and the models.user helpers read (and modify) these same objects.
+
+fields that can wait (such as the ip address) are deferred, and are written back once, when the request ends,
+with a targeted update of just these fields. outside of a request (rq jobs, payment threads) there's no context and the helpers query the db.
+"""
+from flask import g, has_request_context
+from sqlalchemy import text
+from sqlalchemy.orm.attributes import set_committed_value
+import logging as log
+
+from kinappserver import db, app
+
+
+class UserContext(object):
+    """the rows of a single user, loaded once per request"""
+
+    def __init__(self, user_id, user, user_app_data, push_auth_token):
+        self.user_id = user_id
+        self.user = user
+        self.user_app_data = user_app_data
+        self.push_auth_token = push_auth_token
+        self.deferred_app_data = {}  # the user_app_data fields to write back when the request ends
+
+    @property
+    def dirty(self):
+        return bool(self.deferred_app_data)
+
+    def defer_app_data_update(self, **values):
+        """set the given user_app_data fields now, and write them back when the request ends"""
+        for name, value in values.items():
+            # not a change of the session: committing the session must not write them
+            set_committed_value(self.user_app_data, name, value)
+        self.deferred_app_data.update(values)
+
+    def write_back(self):
+        """write the deferred fields now. only these fields are updated - the session isn't committed"""
+        if not self.deferred_app_data:
+            return
+        values, self.deferred_app_data = self.deferred_app_data, {}
+        assignments = ', '.join('%s = :%s' % (name, name) for name in sorted(values))
+        db.engine.execute(text('UPDATE user_app_data SET %s WHERE user_id = CAST(:user_id AS uuid);' % assignments).execution_options(autocommit=True),
+                          user_id=str(self.user_id), **values)
+
+    def expire(self):
+        """forget the loaded values. used after raw sql updates to these rows"""
+        self.write_back()  # dont lose the deferred changes
+        for obj in (self.user, self.user_app_data, self.push_auth_token):
+            if obj is not None:
+                db.session.expire(obj)
+
+
+def load_user_context(user_id):
+    """load the user's rows with a single joined query. returns None if there's no such user"""
+    from .user import User, UserAppData
+    from .push_auth_token import PushAuthToken
+    row = db.session.query(User, UserAppData, PushAuthToken)\
+        .outerjoin(UserAppData, UserAppData.user_id == User.user_id)\
+        .outerjoin(PushAuthToken, PushAuthToken.user_id == User.user_id)\
+        .filter(User.user_id == user_id).first()
+    if row is None:
+        return None
+    return UserContext(user_id, row[0], row[1], row[2])
+
+
+def get_user_context(user_id):
+    """returns the UserContext of the given user_id for the current request, or None if there isn't one"""
+    if user_id is None or not has_request_context():
+        return None
+
+    contexts = g.setdefault('user_contexts', {})
+    key = str(user_id)
+    if key not in contexts:
+        try:
+            contexts[key] = load_user_context(user_id)
+        except Exception as e:
+            # let the helpers fall back to the db (and fail there, as they always did)
+            log.error('cant load user context for user_id %s. e: %s' % (user_id, e))
+            return None
+    return contexts[key]
+
+
+def write_back_user_context(user_id):
+    """write the user's deferred changes now. call this before modifying the user's rows with raw sql,
+    so the raw statement doesn't overwrite them"""
+    if user_id is None or not has_request_context():
+        return
+    ctx = g.get('user_contexts', {}).get(str(user_id))
+    if ctx:
+        ctx.write_back()
+
+
+def expire_user_context(user_id):
+    """call this after modifying the user's rows with raw sql"""
+    if user_id is None or not has_request_context():
+        return
+    ctx = g.get('user_contexts', {}).get(str(user_id))
+    if ctx:
+        ctx.expire()
+
+
+@app.after_request
+def write_back_user_contexts(response):
+    """write back the deferred changes of all the user contexts of this request"""
+    contexts = g.get('user_contexts', None)
+    for ctx in (contexts or {}).values():
+        if ctx is not None and ctx.dirty:
+            try:
+                ctx.write_back()
+            except Exception as e:
+                log.error('failed to write back the user context of user_id %s. e: %s' % (ctx.user_id, e))
+    return response
@@ -0,0 +1,79 @@
+"""a bounded pool of payment workers, one pool per server process.
+
+task rewards used to be paid from a new thread per payment. the dispatcher runs them on a fixed number of
+worker threads (by default, one per stellar channel - more can't send in parallel anyway), reports the queue
+depth and drains the pending payments when the process shuts down. when the pool is full, payments overflow
+to the fast rq queue rather than piling up inside the web worker.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logging as log
+
+from kinappserver.utils import gauge_metric, increment_metric
+
+
+class PaymentDispatcher(object):
+    """runs payments on a fixed-size thread pool, with a bounded number of pending payments"""
+
+    def __init__(self, num_of_workers, max_queue_size):
+        # threads are only started on the first submit, so creating the pool before uwsgi forks is safe
+        self.num_of_workers = num_of_workers
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=num_of_workers)
+        self._lock = threading.Lock()
+        self._pending = 0  # submitted payments that are yet to complete, including the running ones
+        self._draining = False
+
+    def submit(self, func, *args):
+        """run func(*args) on the pool. returns False if the pool is full or draining"""
+        with self._lock:
+            if self._draining or self._pending >= self.num_of_workers + self.max_queue_size:
+                return False
+            self._pending = self._pending + 1
+            pending = self._pending
+
+        self._report(pending)
+        self._executor.submit(self._run, func, args)
+        return True
+
+    def _run(self, func, args):
+        from kinappserver import db
+        try:
+            func(*args)
+        except Exception as e:
+            log.error('payment dispatcher: %s%s failed. e: %s' % (func.__name__, args, e))
+        finally:
+            # the pool threads are long-lived: dont keep their db session (and connection) between payments
+            db.session.remove()
+            with self._lock:
+                self._pending = self._pending - 1
+                pending = self._pending
+            self._report(pending)
+
+    def _report(self, pending):
+        tags = 'pid:%s' % os.getpid()
+        gauge_metric('payment-queue-depth', max(pending - self.num_of_workers, 0), tags)
+        gauge_metric('payment-in-flight', min(pending, self.num_of_workers), tags)
+
+    def pending(self):
+        """returns the number of submitted payments that are yet to complete"""
+        with self._lock:
+            return self._pending
+
+    def drain(self, timeout_secs):
+        """stop accepting payments and wait (up to timeout_secs) for the pending ones to complete"""
+        with self._lock:
+            self._draining = True
+        self._executor.shutdown(wait=False)
+
+        deadline = time.time() + timeout_secs
+        while self.pending() > 0 and time.time() < deadline:
+            time.sleep(0.1)
+
+        if self.pending() > 0:
+            log.error('payment dispatcher: shutting down with %s pending payments' % self.pending())
+            increment_metric('payment-dispatcher-lost', self.pending())
+        else:
+            log.info('payment dispatcher: drained all the pending payments')
@@ -30,6 +30,12 @@ def get_encrpytion_creds():
     return encryption_key, iv
 
 
+def get_blind_index_key():
+    """returns the key of the phone number blind index from ssm, or None. the server doesn't start without it"""
+    env = os.environ.get('ENV', 'test')
+    return get_ssm_parameter('/config/' + env + '/encryption/blind-index-key', config.KMS_KEY_AWS_REGION)
+
+
 def get_truex_creds(force_prod=False):
     env = os.environ.get('ENV', 'test')
 
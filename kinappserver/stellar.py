@@ -1,11 +1,206 @@
 from kinappserver import app, config
-from kinappserver.utils import InvalidUsage, increment_metric
-from time import sleep
+from kinappserver.utils import InvalidUsage, InternalError, increment_metric, gauge_metric
+from contextlib import contextmanager
+import copy
 import kin
 import requests
 import random
+import time
+import uuid
 import logging as log
 ASSET_NAME = 'KIN'
+CHANNEL_LEASE_POLL_INTERVAL_SECS = 0.05
+
+
+class Channel(object):
+    """a stellar channel account, and its sequence number while it's leased"""
+
+    def __init__(self, seed):
+        from stellar_base.keypair import Keypair
+        self.keypair = Keypair.from_seed(seed)
+        self.address = self.keypair.address().decode()
+        self.sequence = None  # unknown: fetched from horizon on the next use
+        self.lease_token = None
+
+
+CHANNEL_LEASE_REDIS_KEY = 'stellar-channel-lease:%s'
+CHANNEL_SEQUENCE_REDIS_KEY = 'stellar-channel-sequence:%s'
+
+# take the lease of the first free channel, and return the index of the channel and its cached sequence number.
+# KEYS holds the lease key and the sequence key of each channel, in this order
+LEASE_CHANNEL_SCRIPT = """
+for i = 1, #KEYS, 2 do
+    if redis.call('set', KEYS[i], ARGV[1], 'NX', 'PX', ARGV[2]) then
+        return {(i - 1) / 2, redis.call('get', KEYS[i + 1])}
+    end
+end
+return nil
+"""
+_lease_channel_script = None
+
+# give the lease back, and cache the channel's sequence number for its next lessee (or drop it if it's unknown).
+# a lease that expired in the meantime may already belong to someone else, so it's left alone.
+RELEASE_CHANNEL_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('del', KEYS[2])
+else
+    redis.call('set', KEYS[2], ARGV[2])
+end
+redis.call('del', KEYS[1])
+return 1
+"""
+_release_channel_script = None
+
+
+class ChannelScheduler(object):
+    """leases the channels to concurrent senders, one sender per channel at a time - across all the processes.
+
+    txs are sent from the leased channel (which pays the fee) with operations on behalf of the base account.
+    the leases are kept in redis, so all the server processes (which share the same channel seeds) take turns
+    on the channels. a channel's sequence number is cached in redis along with its lease and incremented by
+    its current lessee, and is fetched from horizon again after every tx_bad_seq (or a submission with an
+    unknown result).
+
+    with no channel seeds, the txs are sent and signed by the base account itself - which is then leased
+    like a channel.
+    """
+
+    def __init__(self, base_seed, channel_seeds, horizon_uri, network):
+        from stellar_base.keypair import Keypair
+        from stellar_base.horizon import Horizon
+        self.base_keypair = Keypair.from_seed(base_seed)
+        self.base_address = self.base_keypair.address().decode()
+        self.network = network  # a key of stellar_base.network.NETWORKS
+        self.horizon = Horizon(horizon_uri)
+        self.channels = [Channel(seed) for seed in channel_seeds or [base_seed]]
+        self._next = random.randrange(len(self.channels))  # spread the processes over the channels
+
+    def _try_lease(self):
+        """lease a free channel, or return None if they are all taken"""
+        global _lease_channel_script
+        if _lease_channel_script is None:
+            _lease_channel_script = app.redis.register_script(LEASE_CHANNEL_SCRIPT)
+
+        # start from a different channel every time, so all the channels get used
+        self._next = (self._next + 1) % len(self.channels)
+        channels = self.channels[self._next:] + self.channels[:self._next]
+        token = uuid.uuid4().hex
+        keys = []
+        for channel in channels:
+            keys.extend([CHANNEL_LEASE_REDIS_KEY % channel.address, CHANNEL_SEQUENCE_REDIS_KEY % channel.address])
+        res = _lease_channel_script(keys=keys, args=[token, int(config.STELLAR_CHANNEL_LEASE_TTL_SECS * 1000)])
+        if not res:
+            return None
+
+        # the channel objects are shared by the threads of this process, so the lessee gets its own copy
+        channel = copy.copy(channels[int(res[0])])
+        channel.lease_token = token
+        channel.sequence = int(res[1]) if res[1] else None
+        return channel
+
+    def _release(self, channel):
+        global _release_channel_script
+        if _release_channel_script is None:
+            _release_channel_script = app.redis.register_script(RELEASE_CHANNEL_SCRIPT)
+        try:
+            _release_channel_script(keys=[CHANNEL_LEASE_REDIS_KEY % channel.address, CHANNEL_SEQUENCE_REDIS_KEY % channel.address],
+                                    args=[channel.lease_token, '' if channel.sequence is None else channel.sequence])
+        except Exception as e:
+            # the lease expires by itself
+            log.error('failed to release channel %s. e: %s' % (channel.address, e))
+
+    @contextmanager
+    def lease(self, timeout_secs):
+        """lease the next free channel. raises InternalError if no channel was freed in time"""
+        start = time.time()
+        channel = self._try_lease()
+        while channel is None:
+            if time.time() - start > timeout_secs:
+                increment_metric('channel-lease-timeout')
+                raise InternalError('no free stellar channel after %s secs' % timeout_secs)
+            time.sleep(CHANNEL_LEASE_POLL_INTERVAL_SECS)
+            channel = self._try_lease()
+        gauge_metric('channel-lease-wait-ms', int((time.time() - start) * 1000))
+        try:
+            yield channel
+        finally:
+            self._release(channel)
+
+    def submit(self, operations, memo_text=None):
+        """submit a tx with the given operations, signed by the base account, on the next free channel.
+
+        returns the tx_hash, or raises InternalError if the tx failed.
+        """
+        with self.lease(config.STELLAR_CHANNEL_LEASE_TIMEOUT_SECS) as channel:
+            tags = 'channel:%s' % channel.address
+            for attempt in range(config.STELLAR_CHANNEL_BAD_SEQ_ATTEMPTS):
+                if channel.sequence is None:
+                    channel.sequence = int(self.horizon.account(channel.address)['sequence'])
+                    increment_metric('channel-sequence-sync', 1, tags)
+
+                try:
+                    res = self.horizon.submit(self._build_tx(channel, operations, memo_text))
+                except Exception:
+                    # the tx may or may not have made it to the ledger
+                    channel.sequence = None
+                    raise
+
+                if res.get('hash'):
+                    channel.sequence = channel.sequence + 1
+                    increment_metric('channel-txs', 1, tags)
+                    return res['hash']
+
+                result_code = res.get('extras', {}).get('result_codes', {}).get('transaction')
+                if result_code == 'tx_bad_seq':
+                    # the channel was used outside of its lease: resync and try again
+                    log.info('channel %s: bad sequence %s. resyncing' % (channel.address, channel.sequence))
+                    increment_metric('channel-bad-seq', 1, tags)
+                    channel.sequence = None
+                    continue
+
+                if result_code == 'tx_failed':
+                    # the tx was applied (and failed), so it did consume a sequence number
+                    channel.sequence = channel.sequence + 1
+                increment_metric('channel-tx-failed', 1, tags)
+                raise InternalError('tx failed on channel %s: %s' % (channel.address, res.get('extras', {}).get('result_codes')))
+
+            raise InternalError('tx failed on channel %s: bad sequence' % channel.address)
+
+    def _build_tx(self, channel, operations, memo_text=None):
+        """returns the signed tx envelope, as xdr"""
+        from stellar_base.memo import NoneMemo, TextMemo
+        from stellar_base.transaction import Transaction
+        from stellar_base.transaction_envelope import TransactionEnvelope
+        tx = Transaction(channel.address, opts={
+            'sequence': channel.sequence,  # the tx gets the next sequence number
+            'memo': TextMemo(memo_text) if memo_text else NoneMemo(),
+            'fee': 100 * len(operations),
+            'operations': operations,
+        })
+        envelope = TransactionEnvelope(tx, opts={'network_id': self.network})
+        envelope.sign(channel.keypair)
+        if channel.address != self.base_address:
+            envelope.sign(self.base_keypair)
+        return envelope.xdr()
+
+    def payment_op(self, public_address, amount):
+        """returns a kin payment operation from the base account to the given address"""
+        from stellar_base.asset import Asset
+        from stellar_base.operation import Payment
+        return Payment({'source': self.base_address,
+                        'destination': public_address,
+                        'asset': Asset(ASSET_NAME, config.STELLAR_KIN_ISSUER_ADDRESS),
+                        'amount': str(amount)})
+
+    def create_account_op(self, public_address, starting_balance):
+        """returns an operation that creates the given account, funded by the base account"""
+        from stellar_base.operation import CreateAccount
+        return CreateAccount({'source': self.base_address,
+                              'destination': public_address,
+                              'starting_balance': str(starting_balance)})
 
 
 def create_account(public_address, initial_xlm_amount):
@@ -13,7 +208,9 @@ def create_account(public_address, initial_xlm_amount):
     #TODO all repeating logic?
     print('creating account with balance:%s' % initial_xlm_amount)
     try:
-        return app.kin_sdk.create_account(public_address, starting_balance=initial_xlm_amount)
+        # sent through the channel scheduler, like the payments, so the sdk never touches the channels
+        scheduler = app.channel_scheduler
+        return scheduler.submit([scheduler.create_account_op(public_address, initial_xlm_amount)])
     except Exception as e:
         increment_metric('create_account_error')
         print('caught exception creating account for address %s' % (public_address))
@@ -33,10 +230,9 @@ def send_kin(public_address, amount, memo=None):
         return False, None
 
     print('sending kin to address: %s' % public_address) #TODO REMOVE
-    from stellar_base.asset import Asset
     try:
-        kin_asset = Asset(ASSET_NAME, config.STELLAR_KIN_ISSUER_ADDRESS)
-        return app.kin_sdk._send_asset(kin_asset, public_address, amount, memo)
+        scheduler = app.channel_scheduler
+        return scheduler.submit([scheduler.payment_op(public_address, amount)], memo)
     except Exception as e:
         increment_metric('send_kin_error')
         print('caught exception sending %s kin to address %s' % (amount, public_address))
@@ -74,30 +270,24 @@ def send_kin_with_payment_service(public_address, amount, memo=None):
         print(e)
 
 
+def get_transaction_data(tx_hash):
+    """returns the tx data of the given tx_hash, or None if horizon doesn't have it (yet)"""
+    try:
+        return app.kin_sdk.get_transaction_data(tx_hash)
+    except kin.ResourceNotFoundError as e:
+        return None
+
+
 def extract_tx_payment_data(tx_hash):
     """ensures that the given tx_hash is a valid payment tx,
        and return a dict with the memo, amount and to_address"""
     if tx_hash is None:
         raise InvalidUsage('invlid params')
 
-    # get the tx_hash data. this might take a second,
-    # so retry while 'Resource Missing' is recevied
-    count = 0
-    tx_data = None
-    while (count < config.STELLAR_TIMEOUT_SEC):
-        try:
-            tx_data = app.kin_sdk.get_transaction_data(tx_hash)
-
-        except kin.ResourceNotFoundError as e:
-            count = count + 1
-            sleep(1)
-        else:
-            break
-
-
+    # get the tx_hash data. this might take a second, so wait for the tx with the shared
+    # tx waiter, which polls horizon for all the waiting requests at once
+    tx_data = app.tx_waiter.wait(tx_hash)
     if tx_data is None:
-        print('could not get tx_data for tx_hash: %s. waited %s seconds' % (tx_hash, count))
-        increment_metric('tx_data_timeout')
         return False, {}
 
     if len(tx_data.operations) != 1:
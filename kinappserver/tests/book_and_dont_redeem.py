@@ -216,5 +216,20 @@ class Tester(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 1, 'unallocated': 1}})
 
+        # a good whose order row is gone is released too
+        resp = self.app.post('/offer/book',
+                    data=json.dumps({
+                    'id': offerid}),
+                    headers={USER_ID_HEADER: str(userid1)},
+                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.engine.execute('delete from "order";')
+        db.engine.execute("update good set updated_at = now() - interval '1 hour';")
+        resp = self.app.get('/good/release_unclaimed')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['released'], 1)
+        resp = self.app.get('/good/inventory')
+        self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 1, 'unallocated': 1}})
+
 if __name__ == '__main__':
     unittest.main()
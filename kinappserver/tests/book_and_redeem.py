@@ -385,6 +385,7 @@ class Tester(unittest.TestCase):
                     headers={USER_ID_HEADER: str(userid1)},
                     content_type='application/json')
         self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.data)['message'], 'goods_unavailable')
 
         resp = self.app.post('/good/add',
             data=json.dumps({
@@ -5,7 +5,7 @@ import json
 import testing.postgresql
 
 import kinappserver
-from kinappserver import db
+from kinappserver import db, models
 from kinappserver.models.transaction import create_tx
 
 import logging as log
@@ -240,6 +240,101 @@ class Tester(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 2, 'unallocated': 1}})
 
+        # a drift is corrected by the reconciler only when two runs in a row see it
+        kinappserver.app.redis.delete('inventory-drift:%s' % offer['id'])
+        kinappserver.app.redis.hincrby('inventory:%s' % offer['id'], 'available', 5)
+        resp = self.app.post('/good/inventory/reconcile')
+        self.assertEqual(json.loads(resp.data)['drifted'], 0)
+        resp = self.app.post('/good/inventory/reconcile')
+        self.assertEqual(json.loads(resp.data)['drifted'], 1)
+        resp = self.app.get('/good/inventory')
+        self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 2, 'unallocated': 1}})
+
+    def test_create_goods(self):
+        """test adding many goods at once"""
+        offer = { 'id': '0',
+                  'type': 'gift-card',
+                  'type_image_url': "https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png",
+                  'domain': 'music',
+                  'title': 'offer_title',
+                  'desc': 'offer_desc',
+                  'image_url': 'image_url',
+                  'price': 8,
+                  'address': 'the address',
+                  'skip_image_test': True,
+                  'provider':
+                    {'name': 'om-nom-nom-food', 'image_url': 'http://inter.webs/horsie.jpg'},
+                }
+
+        resp = self.app.post('/offer/add',
+                            data=json.dumps({
+                            'offer': offer}),
+                            headers={},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.post('/good/add',
+                    data=json.dumps({
+                    'offer_id': offer['id'],
+                    'good_type': 'code',
+                    'value': 'abcd'}),
+                    headers={},
+                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # codes that already exist, or appear twice, are skipped
+        resp = self.app.post('/good/add',
+                    data=json.dumps({
+                    'offer_id': offer['id'],
+                    'good_type': 'code',
+                    'values': ['abcd', 'efgh', 'ijkl', 'efgh']}),
+                    headers={},
+                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['duplicates'], 2)
+
+        resp = self.app.get('/good/inventory')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 3, 'unallocated': 3}})
+
+        # the hashes of goods that predate them are backfilled
+        db.engine.execute('update good set code_hash = null;')
+        self.assertEqual(models.backfill_code_hashes(batch_size=2), 0)
+        self.assertTrue(models.does_code_exist('ijkl'))
+        self.assertFalse(models.does_code_exist('mnop'))
+
+        # bulk loading a stream of codes
+        resp = self.app.post('/good/add/bulk?offer_id=%s&format=csv' % offer['id'],
+                    data='ijkl\nmnop\n"qr,st"\nmnop\n',
+                    headers={},
+                    content_type='text/csv')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['duplicates'], 2)
+        self.assertTrue(models.does_code_exist('qr,st'))
+
+        resp = self.app.post('/good/add/bulk?offer_id=%s&format=ndjson' % offer['id'],
+                    data='"uvwx"\n"qr,st"\n',
+                    headers={},
+                    content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['duplicates'], 1)
+
+        resp = self.app.get('/good/inventory')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['inventory'], {offer['id']: {'total': 6, 'unallocated': 6}})
+
+        resp = self.app.get('/good/inventory/report')
+        self.assertEqual(resp.status_code, 200)
+        report = json.loads(resp.data)['inventory'][offer['id']]
+        self.assertEqual((report['total'], report['unallocated'], report['allocated_in_window']), (6, 6, 0))
+        self.assertEqual(report['hours_left'], None)
+
 
 if __name__ == '__main__':
     unittest.main()
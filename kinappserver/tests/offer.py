@@ -351,6 +351,12 @@ class Tester(unittest.TestCase):
         self.assertEqual((data['offers'][2]['price']), 100)
         self.assertEqual((data['offers'][3]['price']), 2500) # ios task
 
+        # client versions that reach the same version thresholds share a catalog
+        self.assertIs(models.get_client_catalog('android', '1.0'), models.get_client_catalog('android', '1.3'))
+        self.assertIsNot(models.get_client_catalog('android', '1.0'), models.get_client_catalog('android', '1.5'))
+        self.assertEqual(len(models.get_client_catalog('android', '99.99').offers), 6)
+        self.assertEqual(len(models.get_client_catalog('android', '100.1').offers), 6)
+
 
         
 
@@ -0,0 +1,58 @@
+import threading
+import unittest
+
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db
+from kinappserver.payment_dispatcher import PaymentDispatcher
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_payment_dispatcher(self):
+        """test the bounded payments pool"""
+        release = threading.Event()
+        paid = []
+
+        def pay(amount):
+            release.wait(5)
+            paid.append(amount)
+
+        # 2 workers + 1 queued payment, and then the pool is full
+        dispatcher = PaymentDispatcher(2, 1)
+        self.assertTrue(dispatcher.submit(pay, 1))
+        self.assertTrue(dispatcher.submit(pay, 2))
+        self.assertTrue(dispatcher.submit(pay, 3))
+        self.assertFalse(dispatcher.submit(pay, 4))
+        self.assertEqual(dispatcher.pending(), 3)
+
+        # drain waits for all the pending payments, and then refuses new ones
+        release.set()
+        dispatcher.drain(5)
+        self.assertEqual(dispatcher.pending(), 0)
+        self.assertEqual(sorted(paid), [1, 2, 3])
+        self.assertFalse(dispatcher.submit(pay, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def add_payment(self, user_id, task_id, memo):
+        payment = models.PaymentOutbox()
+        payment.user_id = user_id
+        payment.task_id = task_id
+        payment.memo = memo
+        payment.address = 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ'
+        payment.amount = 10
+        payment.send_push = False
+        db.session.add(payment)
+        db.session.commit()
+
+    def test_payment_outbox(self):
+        """test the payment outbox states"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(userid),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        self.add_payment(userid, '1', 'memo-1')
+        self.add_payment(userid, '2', 'memo-2')
+
+        # a payment is claimed only once
+        self.assertTrue(models.claim_payment('memo-1'))
+        self.assertFalse(models.claim_payment('memo-1'))
+
+        models.confirm_payment('memo-1', 'tx-hash-1')
+        self.assertEqual(models.get_outbox_payment('memo-1').state, models.PAYMENT_STATE_CONFIRMED)
+        self.assertEqual(models.get_outbox_payment('memo-1').tx_hash, 'tx-hash-1')
+
+        # the worker claims the pending payments, and a failed payment goes back to pending
+        payments = models.claim_pending_payments(10, 0)
+        self.assertEqual([payment['memo'] for payment in payments], ['memo-2'])
+        self.assertEqual(models.claim_pending_payments(10, 0), [])
+        models.fail_payment('memo-2')
+        db.session.expire_all()
+        self.assertEqual(models.get_outbox_payment('memo-2').state, models.PAYMENT_STATE_PENDING)
+
+        # until it fails too many times
+        for i in range(kinappserver.config.PAYMENT_OUTBOX_MAX_ATTEMPTS - 1):
+            self.assertEqual(len(models.claim_pending_payments(10, 0)), 1)
+            models.fail_payment('memo-2')
+        db.session.expire_all()
+        self.assertEqual(models.get_outbox_payment('memo-2').state, models.PAYMENT_STATE_FAILED)
+        self.assertEqual(models.claim_pending_payments(10, 0), [])
+
+        # a payment that was sent is never retried: it stays submitted until it's flagged as stale
+        self.add_payment(userid, '3', 'memo-3')
+        self.assertTrue(models.claim_payment('memo-3'))
+        models.record_payment_tx('memo-3', 'tx-hash-3')
+        models.fail_payment('memo-3')
+        db.session.expire_all()
+        self.assertEqual(models.get_outbox_payment('memo-3').state, models.PAYMENT_STATE_SUBMITTED)
+        self.assertEqual(models.claim_pending_payments(10, 0), [])
+        self.assertEqual(models.fail_stale_payments(0), 1)
+        db.session.expire_all()
+        self.assertEqual(models.get_outbox_payment('memo-3').state, models.PAYMENT_STATE_FAILED)
+
+        counts = models.report_payment_outbox()
+        self.assertEqual(counts[models.PAYMENT_STATE_CONFIRMED], 1)
+        self.assertEqual(counts[models.PAYMENT_STATE_FAILED], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -119,6 +119,28 @@ class Tester(unittest.TestCase):
 
         print('all users: %s' %models.list_all_users())
 
+        # both users are found by the phone number's blind index - only user2 is active
+        self.assertEqual(sorted(str(user_id) for user_id in models.get_all_user_id_by_phone('+9720528802120')), sorted([str(userid), str(userid2)]))
+        self.assertEqual(str(models.get_active_user_id_by_phone('+9720528802120')), str(userid2))
+        self.assertEqual(models.count_registrations_for_phone_number('+9720528802120'), 2)
+
+        # users that predate the blind index are found by their encrypted number until the backfill sets it
+        db.engine.execute("update public.user set phone_blind_index=null where user_id='%s'" % userid)
+        self.assertEqual(models.count_registrations_for_phone_number('+9720528802120'), 2)
+        db.engine.execute("update public.user set phone_blind_index=null")
+        self.assertEqual(str(models.get_active_user_id_by_phone('+9720528802120')), str(userid2))
+        self.assertEqual(sorted(models.get_associated_user_ids(str(userid2))), sorted([str(userid), str(userid2)]))
+
+        # with the fallback off, they are only found once the backfill sets it
+        kinappserver.config.PHONE_BLIND_INDEX_FALLBACK = False
+        try:
+            self.assertEqual(models.count_registrations_for_phone_number('+9720528802120'), 0)
+            self.assertEqual(models.backfill_phone_blind_indexes(), 2)
+            self.assertEqual(str(models.get_active_user_id_by_phone('+9720528802120')), str(userid2))
+            self.assertEqual(models.count_registrations_for_phone_number('+9720528802120'), 2)
+        finally:
+            kinappserver.config.PHONE_BLIND_INDEX_FALLBACK = True
+
         # user2 re-updates his phone number to a different number. should fail
         phone_num = '+9720528802121'
         resp = self.app.post('/user/firebase/update-id-token',
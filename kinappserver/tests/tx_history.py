@@ -0,0 +1,120 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+USER_ID_HEADER = "X-USERID"
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_tx_history_pages(self):
+        """test walking the tx history with a cursor"""
+        userid = uuid.uuid4()
+        friend_userid = uuid.uuid4()
+        for user_id in (userid, friend_userid):
+            resp = self.app.post('/user/register',
+                                 data=json.dumps({
+                                     'user_id': str(user_id),
+                                     'os': 'android',
+                                     'device_model': 'samsung8',
+                                     'device_id': '234234',
+                                     'time_zone': '05:00',
+                                     'token': 'fake_token',
+                                     'app_ver': '1.0'}),
+                                 headers={},
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+        address = 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ'
+        friend_address = 'GBDUPSZP4APH3PNFIMYMTHIGCQQ2GKTPRBDTPCORALYRYJZJ35O2LOBL'
+        db.engine.execute("update public.user set public_address='%s' where user_id='%s'" % (address, userid))
+        db.engine.execute("update public.user set public_address='%s' where user_id='%s'" % (friend_address, friend_userid))
+
+        models.create_tx('tx-0', userid, address, False, 10, {'task_id': '0', 'memo': 'memo-0'})
+        models.create_p2p_tx('p2p-0', userid, friend_userid, address, friend_address, 5, None)
+        for i in range(1, 5):
+            models.create_tx('tx-%s' % i, userid, address, False, 10, {'task_id': str(i), 'memo': 'memo-%s' % i})
+        models.create_tx('tx-5', userid, address, True, 10, {'offer_id': 'no-such-offer', 'order_id': 'order-1'})
+        models.create_p2p_tx('p2p-1', friend_userid, userid, friend_address, address, 3, None)
+
+        tx_hashes = []
+        cursor = None
+        while True:
+            url = '/user/transactions?limit=4' + ('&cursor=%s' % cursor if cursor else '')
+            resp = self.app.get(url, headers={USER_ID_HEADER: str(userid)})
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            self.assertEqual(data['status'], 'ok')
+            self.assertTrue(len(data['txs']) <= 4)
+            tx_hashes.extend([tx['tx_hash'] for tx in data['txs']])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        # all the server and p2p txs, newest first, each one once
+        self.assertEqual(tx_hashes, ['p2p-1', 'tx-5', 'tx-4', 'tx-3', 'tx-2', 'tx-1', 'p2p-0', 'tx-0'])
+
+        # the details of unknown tasks and offers get the default text
+        resp = self.app.get('/user/transactions?limit=3', headers={USER_ID_HEADER: str(userid)})
+        txs = json.loads(resp.data)['txs']
+        self.assertEqual(txs[0]['type'], 'p2p')
+        self.assertTrue(txs[0]['client_received'])
+        self.assertEqual(txs[1]['title'], 'unknown offer')
+        self.assertEqual(txs[2]['title'], 'Delayed Kin')
+
+        resp = self.app.get('/user/transactions?cursor=not-a-cursor', headers={USER_ID_HEADER: str(userid)})
+        self.assertEqual(resp.status_code, 400)
+
+        # the history is cached, and new txs are written through to the cache
+        self.assertEqual(kinappserver.app.redis.llen(models.TX_HISTORY_REDIS_KEY % userid), 9)  # 8 txs and the end marker
+        models.create_tx('tx-6', userid, address, False, 10, {'task_id': '6', 'memo': 'memo-6'})
+        self.assertEqual(kinappserver.app.redis.llen(models.TX_HISTORY_REDIS_KEY % userid), 10)
+        resp = self.app.get('/user/transactions?limit=2', headers={USER_ID_HEADER: str(userid)})
+        self.assertEqual([tx['tx_hash'] for tx in json.loads(resp.data)['txs']], ['tx-6', 'p2p-1'])
+
+        # the cache keys don't depend on the case of the user_id header
+        resp = self.app.get('/user/transactions?limit=1', headers={USER_ID_HEADER: str(userid).upper()})
+        self.assertEqual([tx['tx_hash'] for tx in json.loads(resp.data)['txs']], ['tx-6'])
+        models.create_tx('tx-7', userid, address, False, 10, {'task_id': '7', 'memo': 'memo-7'})
+        resp = self.app.get('/user/transactions?limit=1', headers={USER_ID_HEADER: str(userid).upper()})
+        self.assertEqual([tx['tx_hash'] for tx in json.loads(resp.data)['txs']], ['tx-7'])
+
+        # a page beyond the cached window is read from the db
+        kinappserver.config.TX_HISTORY_CACHE_SIZE = 3
+        models.invalidate_tx_history(userid)
+        try:
+            resp = self.app.get('/user/transactions?limit=2', headers={USER_ID_HEADER: str(userid)})
+            cursor = json.loads(resp.data)['next_cursor']
+            resp = self.app.get('/user/transactions?limit=2&cursor=%s' % cursor, headers={USER_ID_HEADER: str(userid)})
+            self.assertEqual([tx['tx_hash'] for tx in json.loads(resp.data)['txs']], ['p2p-1', 'tx-5'])
+        finally:
+            kinappserver.config.TX_HISTORY_CACHE_SIZE = 200
+
+
+if __name__ == '__main__':
+    unittest.main()
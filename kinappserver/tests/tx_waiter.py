@@ -0,0 +1,76 @@
+import unittest
+
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db
+from kinappserver import tx_waiter
+from kinappserver.tx_waiter import TxWaiter
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_tx_waiter(self):
+        """test the shared tx waiter"""
+        lookups = []
+
+        def fetch(tx_hash):
+            lookups.append(tx_hash)
+            if tx_hash == 'missing':
+                return None
+            if tx_hash == 'broken':
+                raise Exception('horizon is down')
+            # the tx shows up on the 3rd lookup
+            return {'tx_hash': tx_hash} if lookups.count(tx_hash) >= 3 else None
+
+        waiter = TxWaiter(fetch, 10, 1, 4)
+
+        # waiters of the same tx_hash share the lookups
+        future1 = waiter.register('found')
+        future2 = waiter.register('found')
+        self.assertIs(future1, future2)
+        self.assertEqual(waiter.wait('found'), {'tx_hash': 'found'})
+        self.assertEqual(lookups.count('found'), 3)
+
+        # txs that dont show up in time resolve with None, and errors are raised to the waiters
+        self.assertIsNone(waiter.wait('missing'))
+        with self.assertRaises(Exception):
+            waiter.wait('broken')
+
+        # a failed round doesn't stop the poller
+        gauges = []
+
+        def failing_gauge(*args, **kwargs):
+            gauges.append(args)
+            if len(gauges) < 3:
+                raise Exception('statsd is down')
+
+        original_gauge = tx_waiter.gauge_metric
+        tx_waiter.gauge_metric = failing_gauge
+        try:
+            self.assertEqual(waiter.wait('found-later'), {'tx_hash': 'found-later'})
+        finally:
+            tx_waiter.gauge_metric = original_gauge
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_user_balance(self):
+        """test the user balance ledger"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(userid),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # a user with no txs gets an empty ledger row
+        self.assertEqual(models.get_user_inapp_balance(userid), 0)
+
+        address = 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ'
+        models.create_tx('tx-1', userid, address, False, 100, {'task_id': '1', 'memo': 'memo-1'})
+        models.create_tx('tx-2', userid, address, False, 50, {'task_id': '2', 'memo': 'memo-2'})
+        models.create_tx('tx-3', userid, address, True, 30, {'offer_id': '1', 'order_id': 'order-1'})
+        self.assertEqual(models.get_user_inapp_balance(userid), 120)
+
+        # a tx that failed to be stored doesn't change the balance
+        models.create_tx('tx-1', userid, address, False, 100, {'task_id': '1', 'memo': 'memo-1'})
+        self.assertEqual(models.get_user_inapp_balance(userid), 120)
+        self.assertEqual(models.check_user_balances(), [])
+
+        # a drifted balance is found and fixed
+        db.engine.execute("update user_balance set earned = 0 where user_id='%s'" % userid)
+        self.assertEqual(models.check_user_balances(fix=True), [str(userid)])
+        self.assertEqual(models.get_user_inapp_balance(userid), 120)
+        self.assertEqual(models.check_user_balances(), [])
+
+        # a missing row is backfilled
+        db.engine.execute("delete from user_balance where user_id='%s'" % userid)
+        self.assertEqual(models.backfill_user_balances(), 1)
+        self.assertEqual(models.get_user_inapp_balance(userid), 120)
+
+        # a new tx of a user with no ledger row seeds the row - including the new tx
+        db.engine.execute("delete from user_balance where user_id='%s'" % userid)
+        models.create_tx('tx-4', userid, address, False, 10, {'task_id': '4', 'memo': 'memo-4'})
+        self.assertEqual(models.get_user_inapp_balance(userid), 130)
+        self.assertEqual(models.check_user_balances(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
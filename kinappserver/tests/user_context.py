@@ -0,0 +1,83 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+
+USER_ID_HEADER = "X-USERID"
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_user_context(self):
+        """test the request-scoped user context"""
+        userid = uuid.uuid4()
+
+        # register an android with a token
+        resp = self.app.post('/user/register',
+                             data=json.dumps({
+                                 'user_id': str(userid),
+                                 'os': 'android',
+                                 'device_model': 'samsung8',
+                                 'device_id': '234234',
+                                 'time_zone': '05:00',
+                                 'token': 'fake_token',
+                                 'app_ver': '1.0'}),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # outside of a request there's no context
+        self.assertIsNone(models.get_user_context(userid))
+
+        with kinappserver.app.test_request_context():
+            ctx = models.get_user_context(userid)
+            self.assertIsNotNone(ctx)
+            self.assertIsNotNone(ctx.push_auth_token)
+
+            # the helpers share the context's rows
+            self.assertIs(models.get_user(userid), ctx.user)
+            self.assertIs(models.get_user_app_data(userid), ctx.user_app_data)
+            self.assertIs(models.get_user_context(str(userid)), ctx)
+            self.assertEqual(models.get_user_os_type(userid), 'android')
+
+            # the ip address is written back at the end of the request
+            models.update_ip_address(userid, '1.2.3.4')
+            self.assertTrue(ctx.dirty)
+            self.assertEqual(models.get_user_app_data(userid).ip_address, '1.2.3.4')
+            models.write_back_user_context(userid)
+            self.assertFalse(ctx.dirty)
+            self.assertEqual(db.engine.execute("select ip_address from user_app_data where user_id='%s'" % userid).scalar(), '1.2.3.4')
+
+            # raw sql updates expire the context
+            models.autoswitch_captcha(userid)
+            self.assertEqual(models.get_user_app_data(userid).should_solve_captcha_ternary, 1)
+
+            # unknown users have no context
+            self.assertIsNone(models.get_user_context(uuid.uuid4()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -54,6 +54,18 @@ class Tester(unittest.TestCase):
         self.assertEqual(send_push, send_push_r)
         self.assertEqual(timestamp_r, timestamp)
 
+    def test_version_keys(self):
+        """test the parsed version keys order like LooseVersion"""
+        from kinappserver.version_utils import version_key, version_lt, version_le, version_ge, version_gt
+        self.assertEqual(version_key('1.2.10'), (1, 2, 10))
+        self.assertEqual(version_key('1.2.10'), version_key('1.2.10'))
+        self.assertTrue(version_lt('1.9', '1.10'))
+        self.assertTrue(version_lt('1.2', '1.2.0'))
+        self.assertTrue(version_le('1.4.0', '1.4.0'))
+        self.assertTrue(version_ge('2.0', '1.10.3'))
+        self.assertTrue(version_gt('1.2a', '1.2'))
+        self.assertFalse(version_gt('0.1', '0.1'))
+
 
 
 
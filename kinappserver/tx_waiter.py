@@ -0,0 +1,99 @@
+"""a shared waiter for transactions that are yet to appear on horizon.
+
+redeeming an offer used to poll horizon from the request thread, once a second for up to STELLAR_TIMEOUT_SEC.
+with the waiter, requests register the tx_hash they wait for and block on a future, and a single background
+poller looks up all the registered tx_hashes in each round - concurrently, as horizon has no lookup of several
+tx_hashes at once - and resolves their waiters. requests for the same tx_hash share a single lookup.
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import logging as log
+
+from kinappserver.utils import gauge_metric, increment_metric
+
+WAIT_MARGIN_SECS = 10  # how long past the tx's deadline a request waits for the poller before giving up on it
+
+
+class TxWaiter(object):
+    """resolves the registered tx_hashes with their tx data, as soon as horizon has them"""
+
+    def __init__(self, fetch, poll_interval_ms, timeout_secs, max_concurrent_lookups):
+        # fetch(tx_hash) returns the tx data, or None if horizon doesn't have the tx (yet)
+        self._fetch = fetch
+        self.poll_interval_ms = poll_interval_ms
+        self.timeout_secs = timeout_secs
+        self.max_concurrent_lookups = max_concurrent_lookups
+        self._lock = threading.Lock()
+        self._waiters = {}  # tx_hash: (future, deadline)
+        # both started on the first wait, so creating the waiter before uwsgi forks is safe
+        self._poller = None
+        self._lookups = None
+
+    def register(self, tx_hash):
+        """returns a future that resolves with the tx data - or with None, if the tx wasn't found in time"""
+        with self._lock:
+            if tx_hash in self._waiters:
+                return self._waiters[tx_hash][0]
+            future = Future()
+            self._waiters[tx_hash] = (future, time.time() + self.timeout_secs)
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+        return future
+
+    def wait(self, tx_hash):
+        """blocks until the tx data is available and returns it, or None on timeout"""
+        try:
+            return self.register(tx_hash).result(timeout=self.timeout_secs + WAIT_MARGIN_SECS)
+        except TimeoutError:
+            # the poller should have resolved the tx by its deadline. dont hold the request forever if it didnt
+            log.error('tx waiter: the poller didnt resolve tx_hash %s in time' % tx_hash)
+            increment_metric('tx-waiter-stuck')
+            return None
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._poller = None
+                    return
+                waiters = list(self._waiters.items())
+
+            # the poller must not die while there are waiters: a failed round is retried in the next one
+            try:
+                self._poll_round(waiters)
+            except Exception as e:
+                log.error('tx waiter: failed to poll %s txs. e: %s' % (len(waiters), e))
+            time.sleep(self.poll_interval_ms / 1000.0)
+
+    def _lookup(self, tx_hash):
+        """returns (tx_data, exception) of the given tx_hash"""
+        try:
+            return self._fetch(tx_hash), None
+        except Exception as e:
+            log.error('tx waiter: failed to get the tx data for tx_hash %s. e: %s' % (tx_hash, e))
+            return None, e
+
+    def _poll_round(self, waiters):
+        if self._lookups is None:
+            self._lookups = ThreadPoolExecutor(max_workers=self.max_concurrent_lookups)
+        gauge_metric('tx-waiters', len(waiters))
+        results = self._lookups.map(self._lookup, [tx_hash for tx_hash, _ in waiters])
+        for (tx_hash, (future, deadline)), (tx_data, exception) in zip(waiters, results):
+            if exception is not None:
+                self._resolve(tx_hash, exception=exception)
+            elif tx_data is not None:
+                self._resolve(tx_hash, tx_data)
+            elif time.time() > deadline:
+                print('could not get tx_data for tx_hash: %s. waited %s seconds' % (tx_hash, self.timeout_secs))
+                increment_metric('tx_data_timeout')
+                self._resolve(tx_hash, None)
+
+    def _resolve(self, tx_hash, tx_data=None, exception=None):
+        with self._lock:
+            future, _ = self._waiters.pop(tx_hash)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(tx_data)
@@ -38,10 +38,13 @@ def generate_memo(is_manual=False):
     return KINIT_MEMO_PREFIX + env + str(uuid4().hex[:ORDER_ID_LENGTH])  # generate a memo string and send it to the client
 
 
-def increment_metric(metric_name, count=1):
+def increment_metric(metric_name, count=1, tags_str=''):
     """increment a counter with the given name and value"""
     # set env to undefined for local tests (which do not emit stats, as there's no agent)
-    statsd.increment(metric_name, count, tags=['app:kinit,env:%s' % config.DEPLOYMENT_ENV])
+    tags = 'app:kinit,env:%s' % config.DEPLOYMENT_ENV
+    if tags_str:
+        tags = tags + ',' + tags_str
+    statsd.increment(metric_name, count, tags=[tags])
 
 
 def gauge_metric(metric_name, value, tags_str=''):
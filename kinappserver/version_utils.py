@@ -0,0 +1,49 @@
+"""parsed, interned client-version keys.
+
+client app versions and configured minimum versions are compared all over the server, many times
+in per-task, per-offer and per-user loops. rather than building LooseVersion objects on every
+comparison, each version string is parsed exactly once into a tuple key and the result is cached.
+
+the keys order exactly like distutils' LooseVersion: '1.10' > '1.9', '1.2' < '1.2.0' < '1.2a'.
+
+this module has no dependencies so it can be imported by stand-alone scripts.
+"""
+import re
+from functools import lru_cache
+
+# the number of distinct version strings seen in the wild is small. keep plenty of room.
+VERSION_KEY_CACHE_SIZE = 4096
+
+_component_re = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
+
+
+@lru_cache(maxsize=VERSION_KEY_CACHE_SIZE)
+def version_key(version):
+    """return the comparable (tuple) key of the given version string"""
+    components = [x for x in _component_re.split(version) if x and x != '.']
+    for i, component in enumerate(components):
+        try:
+            components[i] = int(component)
+        except ValueError:
+            pass
+    return tuple(components)
+
+
+def version_lt(version, other):
+    """returns True if version < other"""
+    return version_key(version) < version_key(other)
+
+
+def version_le(version, other):
+    """returns True if version <= other"""
+    return version_key(version) <= version_key(other)
+
+
+def version_ge(version, other):
+    """returns True if version >= other"""
+    return version_key(version) >= version_key(other)
+
+
+def version_gt(version, other):
+    """returns True if version > other"""
+    return version_key(version) > version_key(other)
@@ -16,7 +16,7 @@ from kinappserver.stellar import send_kin
 from kinappserver.utils import InvalidUsage, InternalError, increment_metric, gauge_metric,\
     sqlalchemy_pool_status
 from kinappserver.models import add_task, add_category, send_engagement_push, \
-    create_tx, add_offer, set_offer_active, create_good, list_inventory, release_unclaimed_goods, \
+    create_tx, add_offer, set_offer_active, create_good, create_goods, ingest_goods, backfill_code_hashes, list_inventory, get_inventory_report, reconcile_inventory, release_unclaimed_goods, \
     get_users_for_engagement_push, list_user_transactions, get_task_details, set_delay_days, \
     get_address_by_userid, send_compensated_push, nuke_user_data, send_push_auth_token, init_bh_creds, create_bh_offer, \
     get_task_results, get_user_report, get_user_tx_report, get_user_goods_report, \
@@ -27,7 +27,8 @@ from kinappserver.models import add_task, add_category, send_engagement_push, \
     remove_task_from_completed_tasks, switch_task_ids, delete_task, block_user_from_truex_tasks, \
     unblock_user_from_truex_tasks, set_update_available_below, set_force_update_below, \
     update_categories_extra_data, task20_migrate_tasks, add_discovery_app, set_discovery_app_active, \
-    add_discovery_app_category, get_user, blacklist_enc_phone_number, is_enc_phone_number_blacklisted
+    add_discovery_app_category, get_user, blacklist_enc_phone_number, is_enc_phone_number_blacklisted, \
+    backfill_user_balances, check_user_balances, backfill_phone_blind_indexes
 
 
 @app.route('/health', methods=['GET'])
@@ -141,17 +142,50 @@ def add_good_api():
         offer_id = payload.get('offer_id', None)
         good_type = payload.get('good_type', None)
         value = payload.get('value', None)
-        if None in (offer_id, good_type, value):
+        values = payload.get('values', None)  # a list of codes, to add many goods at once
+        if None in (offer_id, good_type) or (value is None and values is None):
             raise InvalidUsage('invalid params')
     except Exception as e:
         print('exception: %s' % e)
         raise InvalidUsage('bad-request')
+    if values is not None:
+        created = create_goods(offer_id, good_type, [str(code) for code in values])
+        return jsonify(status='ok', created=created, duplicates=len(values) - created)
     if create_good(offer_id, good_type, value):
         return jsonify(status='ok')
     else:
         raise InvalidUsage('failed to add good')
 
 
+@app.route('/good/add/bulk', methods=['POST'])
+def bulk_add_goods_api():
+    """internal endpoint used to load many goods at once.
+
+    the body is a stream of codes - a csv with a code per line, or ndjson with a json string per line - and the
+    offer_id, good_type and format (csv/ndjson) are passed as query params.
+    """
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    offer_id = request.args.get('offer_id', None)
+    good_type = request.args.get('good_type', 'code')
+    input_format = request.args.get('format', 'csv')
+    if offer_id is None or input_format not in ('csv', 'ndjson'):
+        raise InvalidUsage('invalid params')
+
+    inserted, duplicates = ingest_goods(offer_id, good_type, request.stream, input_format)
+    return jsonify(status='ok', inserted=inserted, duplicates=duplicates)
+
+
+@app.route('/good/code-hash/backfill', methods=['GET'])
+def backfill_code_hashes_api():
+    """internal endpoint used to set the code hash of goods that predate it, in the background"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    app.rq_slow.enqueue_call(func=backfill_code_hashes, args=())
+    return jsonify(status='ok')
+
+
 @app.route('/good/inventory', methods=['GET'])
 def inventory_api():
     """internal endpoint used to list the goods inventory"""
@@ -161,6 +195,31 @@ def inventory_api():
     return jsonify(status='ok', inventory=list_inventory())
 
 
+@app.route('/good/inventory/report', methods=['GET'])
+def inventory_report_api():
+    """internal endpoint used to report the goods inventory and the allocation velocity of each offer, from the db"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    try:
+        window_mins = int(request.args.get('window_mins', 60))
+        if window_mins <= 0:
+            raise ValueError('window_mins must be positive')
+    except ValueError:
+        raise InvalidUsage('bad-request')
+    return jsonify(status='ok', window_mins=window_mins, inventory=get_inventory_report(window_mins))
+
+
+@app.route('/good/inventory/reconcile', methods=['POST'])
+def reconcile_inventory_api():
+    """internal endpoint used to fix the inventory counters, should they drift from the db"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    drifted = reconcile_inventory()
+    return jsonify(status='ok', drifted=drifted)
+
+
 @app.route('/stats/db', methods=['GET'])
 def dbstats_api():
     """internal endpoint used to retrieve the number of db connections"""
@@ -726,6 +785,44 @@ def get_missing_txs_endpoint():
     return jsonify(status='ok')
 
 
+@app.route('/payments/outbox/process', methods=['GET'])
+def process_payment_outbox_endpoint():
+    """pay the outbox payments that need a retry. called periodically by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    from .views_public import process_payment_outbox
+    app.rq_slow.enqueue_call(func=process_payment_outbox, args=())
+    return jsonify(status='ok')
+
+
+@app.route('/users/balances/backfill', methods=['GET'])
+def backfill_user_balances_endpoint():
+    """create the missing balance ledger rows, in the background"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    app.rq_slow.enqueue_call(func=backfill_user_balances, args=())
+    return jsonify(status='ok')
+
+
+@app.route('/users/balances/check', methods=['GET'])
+def check_user_balances_endpoint():
+    """compare the balance ledger with the transactions in the background. pass fix=true to fix the mismatches"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    fix = request.args.get('fix', 'false') == 'true'
+    app.rq_slow.enqueue_call(func=check_user_balances, args=(fix,))
+    return jsonify(status='ok')
+
+
+@app.route('/users/phone-blind-index/backfill', methods=['GET'])
+def backfill_phone_blind_indexes_endpoint():
+    """set the phone blind index of the users that predate it, in the background"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    app.rq_slow.enqueue_call(func=backfill_phone_blind_indexes, args=())
+    return jsonify(status='ok')
+
+
 @app.route('/users/migrate-restored-user', methods=['POST'])
 def migrate_restored_user():
     # TODO remove me later
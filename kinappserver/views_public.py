@@ -1,17 +1,17 @@
 """
 The Kin App Server public API is defined here.
 """
-from threading import Thread
 from uuid import UUID
 from flask_cors import CORS, cross_origin
-from flask import request, jsonify, abort
+from flask import request, jsonify, abort, Response
 from kinappserver.views_common import get_source_ip, extract_headers, limit_to_acl
 from flask_api import status
 import redis_lock
 import arrow
+import json
 import logging as log
-from distutils.version import LooseVersion
 from .utils import OS_ANDROID, OS_IOS, random_percent, passed_captcha
+from .version_utils import version_le
 
 from kinappserver import app, config, stellar, utils, ssm
 from .push import send_please_upgrade_push_2, send_country_not_supported
@@ -19,15 +19,16 @@ from kinappserver.stellar import create_account, send_kin, send_kin_with_payment
 from kinappserver.utils import InvalidUsage, InternalError, errors_to_string, increment_metric, gauge_metric, MAX_TXS_PER_USER, extract_phone_number_from_firebase_id_token,\
     sqlalchemy_pool_status, get_global_config, write_payment_data_to_cache, read_payment_data_from_cache
 from kinappserver.models import create_user, update_user_token, update_user_app_version, \
-    store_task_results, add_task, is_onboarded, \
+    store_task_results, commit_task_results, add_task, is_onboarded, \
     set_onboarded, send_push_tx_completed, \
     create_tx, get_reward_for_task, add_offer, \
-    get_offers_for_user, set_offer_active, create_order, process_order, \
+    get_offers_json_for_user, set_offer_active, book_offer, process_order, \
     create_good, list_inventory, release_unclaimed_goods, \
-    list_user_transactions, get_redeemed_items, get_offer_details, get_task_details,\
+    get_redeemed_goods_page, get_cached_redeemed_goods, cache_redeemed_goods,\
+    get_tx_history_page,\
     add_p2p_tx,add_app2app_tx, set_user_phone_number, match_phone_number_to_address, user_deactivated,\
     handle_task_results_resubmission, reject_premature_results, get_address_by_userid,\
-    list_p2p_transactions_for_user_id, nuke_user_data, send_push_auth_token, ack_auth_token, is_user_authenticated, is_user_phone_verified, init_bh_creds, create_bh_offer,\
+    nuke_user_data, send_push_auth_token, ack_auth_token, is_user_authenticated, is_user_phone_verified, init_bh_creds, create_bh_offer,\
     get_task_results, get_user_config, get_user_report, get_task_by_id, get_truex_activity, get_and_replace_next_task_memo,\
     scan_for_deauthed_users, user_exists, get_user_id_by_truex_user_id, store_next_task_results_ts, is_in_acl,\
     get_email_template_by_type, get_unauthed_users, get_all_user_id_by_phone, get_backup_hints, generate_backup_questions_list, store_backup_hints, \
@@ -35,12 +36,10 @@ from kinappserver.models import create_user, update_user_token, update_user_app_
     should_block_user_by_client_version, deactivate_user, get_user_os_type, should_block_user_by_phone_prefix, count_registrations_for_phone_number, \
     update_ip_address, should_block_user_by_country_code, is_userid_blacklisted, should_allow_user_by_phone_prefix, should_pass_captcha, \
     captcha_solved, get_user_tz, do_captcha_stuff, get_personalized_categories_header_message, get_categories_for_user, \
-    task20_migrate_user_to_tasks2, should_force_update, is_update_available, should_reject_out_of_order_tasks, count_immediate_tasks
-
-def get_payment_lock_name(user_id, task_id):
-    """generate a user and task specific lock for payments."""
-    return "pay:%s-%s" % (user_id, task_id)
-
+    task20_migrate_user_to_tasks2, should_force_update, is_update_available, should_reject_out_of_order_tasks, count_immediate_tasks, \
+    claim_payment, claim_pending_payments, record_payment_tx, confirm_payment, fail_payment, fail_stale_payments, report_payment_outbox, \
+    start_async_redeem, get_redeem_status, REDEEM_STATUS_PENDING, REDEEM_STATUS_OK, \
+    BOOKING_ERROR_OFFER_INACTIVE, BOOKING_ERROR_GOODS_UNAVAILABLE, BOOKING_ERROR_MAX_OFFERS, BOOKING_ERROR_NOT_ENOUGH_KIN, BOOKING_ERROR_COOLDOWN
 
 @app.route('/user/app-launch', methods=['POST'])
 def app_launch():
@@ -418,19 +417,31 @@ def post_user_task_results_endpoint():
         print('tipping value %s for task_id %s' % (tip, task_id))
         delta = delta + (-1 * tip)  # tip has a negative affect on the delta
 
-    # this should never fail for application-level reasons:
-    if not store_task_results(user_id, task_id, results):
-        raise InternalError('cant save results for userid %s' % user_id)
+    amount = get_reward_for_task(task_id)
+    if not amount:
+        print('could not figure reward amount for task_id: %s' % task_id)
+        raise InternalError('cant find reward for task_id %s' % task_id)
+    amount = amount + delta
 
-    try:
-        # create a redis lock to prevent multiple payments for the same user_id and task_id:
-        if not redis_lock.Lock(app.redis, get_payment_lock_name(user_id, task_id), expire=60).acquire(blocking=False):
-            print('aborting payment - user %s currently being payed for task_id %s' % (user_id, task_id))
-            return jsonify(status='error', info='already_compensating'), status.HTTP_400_BAD_REQUEST
+    # this should never fail for application-level reasons.
+    # stores the results, advances the user to the next task, replaces the memo and queues the payment - in a single statement
+    # if the payment can't be queued (no memo, or already queued for this task), nothing is written
+    memo, payment_queued = commit_task_results(user_id, task_id, results, address=address, amount=amount, send_push=send_push)
 
-        memo = get_and_replace_next_task_memo(user_id, task_id)
+    if memo is None:
+        log.error('cant pay user_id %s for task_id %s - the user has no memo for the task\'s category' % (user_id, task_id))
+        return jsonify(status='error', info='no_memo'), status.HTTP_400_BAD_REQUEST
+
+    # the payment outbox holds a single payment per user and task
+    if not payment_queued:
+        print('aborting payment - user %s already being payed for task_id %s' % (user_id, task_id))
+        return jsonify(status='error', info='already_compensating'), status.HTTP_400_BAD_REQUEST
+
+    try:
         do_captcha_stuff(user_id) # raise captcha flag if needed
-        split_payment(address, task_id, send_push, user_id, memo, delta)
+        # pay right away. if this fails, the outbox worker retries the payment
+        if claim_payment(memo):
+            split_payment(address, task_id, send_push, user_id, memo, delta)
 
     except Exception as e:
         print('exception: %s' % e)
@@ -441,12 +452,8 @@ def post_user_task_results_endpoint():
     return jsonify(status='ok', memo=str(memo))
 
 
-def split_payment(address, task_id, send_push, user_id, memo, delta):
-    """this function calls either the payment service or the internal sdk to pay the user
-
-    this function will eventually be replaced, once we're sure the payment service is working
-    as intended.
-    """
+def should_use_payment_service(user_id):
+    """determine whether to pay the user with the payment service or with the internal sdk"""
     use_payment_service = False
     try:
         phone_number = get_unenc_phone_number_by_user_id(user_id)
@@ -458,13 +465,47 @@ def split_payment(address, task_id, send_push, user_id, memo, delta):
                 use_payment_service = True
     except Exception as e:
         log.error('cant determine whether to use the payment service for user_id %s. defaulting to no' % user_id)
+    return use_payment_service
+
+
+def split_payment(address, task_id, send_push, user_id, memo, delta):
+    """this function calls either the payment service or the internal sdk to pay the user
 
-    if use_payment_service:
+    this function will eventually be replaced, once we're sure the payment service is working
+    as intended.
+    """
+    if should_use_payment_service(user_id):
         reward_address_for_task_internal_payment_service(address, task_id, send_push, user_id, memo, delta)
     else:
         reward_and_push(address, task_id, send_push, user_id, memo, delta)
 
 
+def process_payment_outbox():
+    """pay the outbox payments that weren't paid right away, or that need a retry.
+
+    runs as an rq job, so the payments are sent synchronously (and not on the payments pool). any number of
+    these jobs can run at the same time - each claims its own batch of payments.
+    """
+    fail_stale_payments(config.PAYMENT_OUTBOX_SUBMITTED_TIMEOUT_SECS)
+    payments = claim_pending_payments(config.PAYMENT_OUTBOX_BATCH_SIZE, config.PAYMENT_OUTBOX_RETRY_DELAY_SECS)
+    log.info('processing %s payments from the outbox' % len(payments))
+    for payment in payments:
+        user_id, task_id, memo = payment['user_id'], payment['task_id'], payment['memo']
+        try:
+            # the amount was fixed when the results were stored: pass it on as a delta from the task's reward
+            delta = payment['amount'] - get_reward_for_task(task_id)
+            if should_use_payment_service(user_id):
+                reward_address_for_task_internal_payment_service(payment['address'], task_id, payment['send_push'], user_id, memo, delta)
+            else:
+                reward_address_for_task_internal(payment['address'], task_id, payment['send_push'], user_id, memo, delta)
+        except Exception as e:
+            log.error('failed to pay the outbox payment with memo %s. e: %s' % (memo, e))
+            fail_payment(memo)
+    increment_metric('payment-outbox-retried', len(payments))
+    report_payment_outbox()
+    return len(payments)
+
+
 @app.route('/user/category/<cat_id>/tasks', methods=['GET'])
 def get_next_task_for_categories_endpoint(cat_id):
     return get_next_task_internal(cat_ids=[cat_id])
@@ -539,7 +580,7 @@ def get_next_task_internal(cat_ids=[]):
 
 @app.route('/user/transactions', methods=['GET'])
 def get_transactions_api():
-    """return a list of the last X txs for this user
+    """return a page of the user's txs, newest first
 
     each item in the list contains:
         - the tx_hash
@@ -547,94 +588,70 @@ def get_transactions_api():
         - amount of kins transferred
         - date
         - title and additional details
+
+    the optional 'limit' param caps the page size (at most MAX_TXS_PER_USER, the default). pass the returned
+    'next_cursor' as the 'cursor' param to get the next page. next_cursor is null on the last page.
     """
-    detailed_txs = []
     try:
         user_id, auth_token = extract_headers(request)
-        server_txs = [{'type': 'server', 'tx_hash': tx.tx_hash, 'amount': tx.amount, 'client_received': not tx.incoming_tx, 'tx_info': tx.tx_info, 'date': arrow.get(tx.update_at).timestamp} for tx in list_user_transactions(user_id, MAX_TXS_PER_USER)]
+        limit = max(1, min(int(request.args.get('limit', MAX_TXS_PER_USER)), MAX_TXS_PER_USER))
+        cursor = request.args.get('cursor', None)
 
+        # the user's recent history is served from its cache, older pages come from the db
+        txs, next_cursor = get_tx_history_page(user_id, limit, cursor)
 
-        # get the offer, task details
-        for tx in server_txs:
-            details = get_offer_details(tx['tx_info']['offer_id']) if not tx['client_received'] else get_task_details(tx['tx_info']['task_id'])
-            detailed_txs.append({**tx, **details})
-
-        # get p2p details
-        import emoji
-        from .models import AppDiscovery
-        apps = AppDiscovery.query.all()
-        
-        kin_from_a_friend_text=emoji.emojize(':party_popper: Kin from a friend')
-        p2p_txs = []
-        for tx in list_p2p_transactions_for_user_id(user_id, MAX_TXS_PER_USER):
-            is_app2app = tx.receiver_app_sid is not None
-            if is_app2app:
-                d_app = list(filter(lambda item: item.sid == tx.receiver_app_sid, apps))
-                title = 'Sent Kin to %s' % d_app[0].name
-                p2p_txs.append({'title': title,
-                    'description': 'You sent %sKIN to %s' % (tx.amount, d_app[0].name),
-                    'provider': {'image_url': d_app[0].meta_data['icon_url'], 'name': d_app[0].name},
-                    'type': 'p2p',
-                    'tx_hash': tx.tx_hash,
-                    'amount': tx.amount,
-                    'client_received': str(tx.receiver_user_id).lower() == str(user_id).lower(),
-                    'tx_info': {'memo': 'na', 'task_id': '-1'},
-                    'date': arrow.get(tx.update_at).timestamp})
-            else:
-                title = kin_from_a_friend_text if str(tx.receiver_user_id).lower() == str(user_id).lower() else 'Kin to a friend'
-                p2p_txs.append({'title': kin_from_a_friend_text if str(tx.receiver_user_id).lower() == str(user_id).lower() else 'Kin to a friend',
-                    'description': 'a friend sent you %sKIN' % tx.amount,
-                    'provider': {'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/poll_logo_kin.png', 'name': 'friend'},
-                    'type': 'p2p',
-                    'tx_hash': tx.tx_hash,
-                    'amount': tx.amount,
-                    'client_received': str(tx.receiver_user_id).lower() == str(user_id).lower(),
-                    'tx_info': {'memo': 'na', 'task_id': '-1'},
-                    'date': arrow.get(tx.update_at).timestamp})
-
-        # merge txs:
-        detailed_txs = detailed_txs + p2p_txs
-
-        # sort by date
-        detailed_txs = sorted(detailed_txs, key=lambda k: k['date'], reverse=True)
-        if len(detailed_txs) > MAX_TXS_PER_USER:
-            detailed_txs = detailed_txs[:MAX_TXS_PER_USER]
-
+    except InvalidUsage:
+        raise
     except Exception as e:
         log.error('cant get txs for user')
         print(e)
         return jsonify(status='error', txs=[])
 
-    return jsonify(status='ok', txs=detailed_txs)
+    # the txs are already serialized: splice them into the response
+    return Response('{"status": "ok", "txs": [%s], "next_cursor": %s}' % (','.join(txs), json.dumps(next_cursor)), mimetype='application/json')
 
 
 @app.route('/user/redeemed', methods=['GET'])
 def user_redeemed_api():
-    """return the list of offers that were redeemed by this user
+    """return a page of the offers that were redeemed by this user, newest first
 
     each item in the list contains:
         - the actual redeemed item (i.e. the code
         - localized time
         - info about the offer that was redeemed
 
-        essentially, this is a 3-way join between the good, user and offer tables
-        that is implemented iteratively. the implementation can be made more efficient
+    with no params, all the redeemed goods are returned, from a per-user cache. the optional 'limit' param
+    returns a page instead (of at most MAX_TXS_PER_USER goods): pass the returned 'next_cursor' as the 'cursor'
+    param to get the next page.
     """
-
     redeemed_goods = []
+    next_cursor = None
     try:
         user_id, auth_token = extract_headers(request)
-        incoming_txs_hashes = [tx.tx_hash for tx in list_user_transactions(user_id) if tx.incoming_tx]
-        # get an array of the goods and add details from the offer table:
-        for good in get_redeemed_items(incoming_txs_hashes):
-            # merge two dicts (python 3.5)
-            redeemed_goods.append({**good, **get_offer_details(good['offer_id'])})
-
+        limit = request.args.get('limit', None)
+        cursor = request.args.get('cursor', None)
+        if limit is not None or cursor is not None:
+            limit = max(1, min(int(limit or MAX_TXS_PER_USER), MAX_TXS_PER_USER))
+        else:
+            cached, generation = get_cached_redeemed_goods(user_id)
+            if cached is not None:
+                increment_metric('redeemed-goods-cache-hit')
+                return Response(cached, mimetype='application/json')
+            increment_metric('redeemed-goods-cache-miss')
+
+        redeemed_goods, next_cursor = get_redeemed_goods_page(user_id, limit, cursor)
+        if limit is None:
+            serialized = json.dumps({'status': 'ok', 'redeemed': redeemed_goods, 'next_cursor': None})
+            cache_redeemed_goods(user_id, serialized, generation)
+            return Response(serialized, mimetype='application/json')
+
+    except InvalidUsage:
+        raise
     except Exception as e:
         log.error('cant get redeemed items for user')
         print(e)
 
-    return jsonify(status='ok', redeemed=redeemed_goods)
+    return jsonify(status='ok', redeemed=redeemed_goods, next_cursor=next_cursor)
 
 
 @app.route('/user/onboard', methods=['POST'])
@@ -749,10 +766,10 @@ def register_api():
             # turn off phone verfication for older clients:
             disable_phone_verification = False
             disable_backup_nag = False
-            if os == OS_ANDROID and LooseVersion(app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_ANDROID_VERSION):
+            if os == OS_ANDROID and version_le(app_ver, config.BLOCK_ONBOARDING_ANDROID_VERSION):
                     disable_phone_verification = True
                     disable_backup_nag = True
-            elif os == OS_IOS and LooseVersion(app_ver) <= LooseVersion(config.BLOCK_ONBOARDING_IOS_VERSION):
+            elif os == OS_IOS and version_le(app_ver, config.BLOCK_ONBOARDING_IOS_VERSION):
                     disable_phone_verification = True
                     disable_backup_nag = True
 
@@ -776,8 +793,12 @@ def register_api():
 
 
 def reward_and_push(public_address, task_id, send_push, user_id, memo, delta):
-    """create a thread to perform this function in the background"""
-    Thread(target=reward_address_for_task_internal, args=(public_address, task_id, send_push, user_id, memo, delta)).start()
+    """pay for the task in the background, on the payments pool - or on the fast rq queue if the pool is full"""
+    args = (public_address, task_id, send_push, user_id, memo, delta)
+    if not app.payment_dispatcher.submit(reward_address_for_task_internal, *args):
+        log.info('payments pool is full - enqueuing the payment for user_id %s and task_id %s' % (user_id, task_id))
+        increment_metric('payment-overflow')
+        app.rq_fast.enqueue_call(func=reward_address_for_task_internal, args=args)
 
 
 def reward_address_for_task_internal(public_address, task_id, send_push, user_id, memo, delta=0):
@@ -801,18 +822,26 @@ def reward_address_for_task_internal(public_address, task_id, send_push, user_id
         # send the moneys
         print('calling send_kin: %s, %s' % (public_address, amount))
         tx_hash = send_kin(public_address, amount, memo)
-        create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': memo})
+        if not tx_hash:
+            raise InternalError('no tx_hash')
     except Exception as e:
         print('caught exception sending %s kins to %s - exception: %s:' % (amount, public_address, e))
         increment_metric('outgoing_tx_failed')
+        fail_payment(memo)  # the outbox worker retries the payment
         raise InternalError('failed sending %s kins to %s' % (amount, public_address))
-    finally:  # TODO dont do this if we fail with the tx
-        if tx_hash and send_push:
-            send_push_tx_completed(user_id, tx_hash, amount, task_id, memo)
-        try:
-            redis_lock.Lock(app.redis, get_payment_lock_name(user_id, task_id)).release()
-        except Exception as e:
-            log.error('failed to release payment lock for user_id %s and task_id %s' % (user_id, task_id))
+
+    # the user was paid: this payment must never be retried. if it can't be confirmed, it stays submitted
+    # and fail_stale_payments flags it for a manual review
+    try:
+        record_payment_tx(memo, tx_hash)
+        create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': memo})
+        confirm_payment(memo, tx_hash)
+    except Exception as e:
+        log.error('sent %s kins to %s in tx %s, but failed to confirm the payment with memo %s. e: %s' % (amount, public_address, tx_hash, memo, e))
+        increment_metric('payment-confirm-failed')
+
+    if send_push:
+        send_push_tx_completed(user_id, tx_hash, amount, task_id, memo)
 
 
 
@@ -874,16 +903,13 @@ def get_offers_api():
         print('blocked user_id %s from getting offers - blocked country code' % user_id)
         return jsonify(offers=[], status='error', reason='denied'),  status.HTTP_403_FORBIDDEN
 
-    return jsonify(offers=get_offers_for_user(user_id))
+    # the offers array is already serialized: splice it into the response as is
+    return Response(b'{"offers":' + get_offers_json_for_user(user_id) + b'}', mimetype='application/json')
 
 
 @app.route('/offer/book', methods=['POST'])
 def book_offer_api():
     """books an offer by a user"""
-    from .models.user import get_user_inapp_balance
-    from .models.offer import get_cost_and_address, get_locked_offers
-    from .models.good import goods_avilable
-
     payload = request.get_json(silent=True)
     try:
         user_id, auth_token = extract_headers(request)
@@ -893,17 +919,6 @@ def book_offer_api():
         if not utils.is_valid_client(user_id, payload.get('validation-token', None)):
             if config.SERVERSIDE_CLIENT_VALIDATION_ENABLED:
                 raise InvalidUsage('bad-request')
-
-        locked_offers_ids = get_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE)
-        user_balance = get_user_inapp_balance(user_id)
-        kin_cost, address = get_cost_and_address(offer_id)
-
-        if not goods_avilable(offer_id):
-            raise InvalidUsage('goods_unavailable')
-        if user_balance < kin_cost:
-            raise InvalidUsage('not_enough_kin')
-        if str(offer_id) in locked_offers_ids:
-            raise InvalidUsage('max offers reached')
     except Exception as e:
         log.error(e)
         raise e
@@ -935,12 +950,23 @@ def book_offer_api():
         print('blocked user_id %s from booking goods - user_id blacklisted' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
-    order_id, error_code = create_order(user_id, offer_id)
+    # the offer, time-limit and balance checks, the good allocation and the order are all done in one statement
+    order_id, reason = book_offer(user_id, offer_id)
     if order_id:
         increment_metric('offers_booked')
         return jsonify(status='ok', order_id=order_id)
+    elif reason == BOOKING_ERROR_OFFER_INACTIVE:
+        raise InvalidUsage('offer is not active')
+    elif reason == BOOKING_ERROR_GOODS_UNAVAILABLE:
+        raise InvalidUsage('goods_unavailable')
+    elif reason == BOOKING_ERROR_MAX_OFFERS:
+        raise InvalidUsage('max offers reached')
+    elif reason == BOOKING_ERROR_NOT_ENOUGH_KIN:
+        raise InvalidUsage('not_enough_kin')
+    elif reason == BOOKING_ERROR_COOLDOWN:
+        return jsonify(status='error', reason=errors_to_string(utils.ERROR_ORDERS_COOLDOWN)), status.HTTP_400_BAD_REQUEST
     else:
-        return jsonify(status='error', reason=errors_to_string(error_code)), status.HTTP_400_BAD_REQUEST
+        return jsonify(status='error', reason=errors_to_string(utils.ERROR_NO_GOODS)), status.HTTP_400_BAD_REQUEST
 
 
 @app.route('/offer/redeem', methods=['POST'])
@@ -953,12 +979,19 @@ def purchase_api():
     try:
         user_id, auth_token = extract_headers(request)
         tx_hash = payload.get('tx_hash', None)
+        process_async = payload.get('async', False)  # optional
         if None in (user_id, tx_hash):
             raise InvalidUsage('invalid param')
     except Exception as e:
         print('exception: %s' % e)
         raise InvalidUsage('bad-request')
 
+    if process_async:
+        # dont hold the connection while waiting for the tx: the client polls the status endpoint instead
+        if start_async_redeem(user_id, tx_hash):
+            return jsonify(status=REDEEM_STATUS_PENDING, status_url='/offer/redeem/%s' % tx_hash), status.HTTP_202_ACCEPTED
+        return redeem_status_api(tx_hash)
+
     try:
         # process the tx_hash, provided its not already being processed by another server
         lock = redis_lock.Lock(app.redis, 'redeem:%s' % tx_hash)
@@ -975,6 +1008,27 @@ def purchase_api():
             lock.release()
 
 
+@app.route('/offer/redeem/<tx_hash>', methods=['GET'])
+def redeem_status_api(tx_hash):
+    """return the status of an async redeem request: 202 while its pending, and the goods once its done"""
+    try:
+        user_id, auth_token = extract_headers(request)
+        if user_id is None:
+            raise InvalidUsage('invalid param')
+    except Exception as e:
+        print('exception: %s' % e)
+        raise InvalidUsage('bad-request')
+
+    redeem_status, goods = get_redeem_status(user_id, tx_hash)
+    if redeem_status is None:
+        return jsonify(status='error', reason='unknown tx_hash'), status.HTTP_404_NOT_FOUND
+    if redeem_status == REDEEM_STATUS_PENDING:
+        return jsonify(status=REDEEM_STATUS_PENDING, status_url='/offer/redeem/%s' % tx_hash), status.HTTP_202_ACCEPTED
+    if redeem_status != REDEEM_STATUS_OK:
+        raise InvalidUsage('cant redeem with tx_hash:%s' % tx_hash)
+    return jsonify(status='ok', goods=goods)
+
+
 @app.route('/user/transaction/app2app', methods=['POST'])
 def report_app2app_tx_api():
     """endpoint used by the client to report successful p2p txs"""
@@ -1361,6 +1415,7 @@ def payment_service_callback_endpoint():
 
                 # retrieve the user_id and task_id from the cache
                 user_id, task_id, request_timestamp, send_push = read_payment_data_from_cache(memo)
+                confirm_payment('1-kit-%s' % memo, tx_hash)
 
                 # compare the timestamp from the callback with the one from the original request, and
                 # post as a gauge  metric for tracking
@@ -1381,15 +1436,12 @@ def payment_service_callback_endpoint():
                 if tx_hash and send_push:
                         send_push_tx_completed(user_id, tx_hash, amount, task_id, memo)
 
-                try:
-                    redis_lock.Lock(app.redis, get_payment_lock_name(user_id, task_id)).release()
-                except Exception as e:
-                    log.error('failed to release payment lock for user_id %s and task_id %s' % (user_id, task_id))
-
             else:
                 print('received failed tx from the payment service: %s' % payload)
-                #TODO implement some retry mechanism here
                 increment_metric('payment-callback-failed')
+                # the outbox worker retries the payment
+                if val.get('id', None):
+                    fail_payment('1-kit-%s' % val['id'])
         else:
             print('should never happen: unhandled callback from the payment service: %s' % payload)
 